@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+RTIR4REST Benchmarks
+--------------------
+
+Runs RTIR4REST against the in-process FakeRT server and reports
+throughput, latency and round trips (HTTP requests) per operation.
+
+>>> Usage <<<
+python benchmark.py
+python benchmark.py --tickets 50000 --latency 0.005 --workers 16
+python benchmark.py --only search,autocreate > bench_output.txt
+"""
+
+import argparse
+import sys
+import time
+
+from fakert import FakeRT
+from rtir4rest import (BulkIntake, RTIR4REST, IPIndex, MemoryTransport, Ticket, parse_rt_ids, parse_rt_records,
+                       parse_rt_search, parse_rt_status, rt_body, rt_kv_lines)
+
+USER, PASSWORD = 'root', 'password'
+
+
+def percentile(values, pct):
+    """pct percentile of a list of numbers (nearest rank)."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+class Result():
+    """Measurements of one benchmark."""
+
+    def __init__(self, name, ops, seconds, latencies, requests):
+        self.name = name
+        self.ops = ops
+        self.seconds = seconds
+        self.latencies = latencies
+        self.requests = requests
+
+    def row(self):
+        ops_s = self.ops / self.seconds if self.seconds else 0.0
+        rt_op = self.requests / float(self.ops) if self.ops else 0.0
+        return '%-42s %8d %9.3f %10.1f %9.2f %9.2f %8.3f' % (
+            self.name, self.ops, self.seconds, ops_s,
+            percentile(self.latencies, 50) * 1000, percentile(self.latencies, 95) * 1000, rt_op)
+
+
+def measure(rt, name, ops, fn):
+    """Run fn(i) for i in range(ops), timing each call and counting server requests."""
+    rt.reset_stats()
+    latencies = []
+    started = time.perf_counter()
+    for i in range(ops):
+        t = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - t)
+    seconds = time.perf_counter() - started
+    return Result(name, ops, seconds, latencies, rt.total_requests())
+
+
+def measure_batch(rt, name, ops, fn):
+    """Run fn() once for a batch of ops operations (latency = batch time / ops)."""
+    rt.reset_stats()
+    started = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - started
+    return Result(name, ops, seconds, [seconds / ops] * ops, rt.total_requests())
+
+
+def client(rt, **kwargs):
+    rtir = RTIR4REST(USER, PASSWORD, rt.url, **kwargs)
+    if not rtir.login():
+        raise SystemExit('Cannot login to FakeRT')
+    return rtir
+
+
+def bench_search(rt, args):
+    rtir = client(rt)
+    query = "(Status='new' OR Status='open')"
+    n = len(rt.tickets)
+    yield measure(rt, 'search_tickets (%d results)' % n, 3, lambda i: rtir.search_tickets(query))
+    yield measure(rt, 'iter_search (%d results)' % n, 3, lambda i: sum(1 for _ in rtir.iter_search(query)))
+    yield measure(rt, 'get_all_new_open_tickets_idlist', 3, lambda i: rtir.get_all_new_open_tickets_idlist())
+    yield measure_batch(rt, 'search_tickets_full (per ticket)', n,
+                        lambda: sum(1 for _ in rtir.search_tickets_full(query)))
+
+
+def bench_fields(rt, args):
+    ids = [str(i) for i in range(1, min(args.ops, len(rt.tickets)) + 1)]
+    rtir = client(rt, cache_size=len(ids))
+    items = ['Owner', 'Status', 'Subject', 'CF.{IP}', 'LastUpdated']
+    yield measure(rt, 'get_ticket_item x5 (cold cache)', len(ids),
+                  lambda i: [rtir.get_ticket_item(ids[i], item) for item in items])
+    yield measure(rt, 'get_ticket_item x5 (warm cache)', len(ids),
+                  lambda i: [rtir.get_ticket_item(ids[i], item) for item in items])
+    raw = rtir.get_ticket_info(ids[0], raw=True)
+    yield measure(rt, 'Ticket.from_text (parse only)', args.ops * 10, lambda i: Ticket.from_text(raw))
+
+
+def bench_autocreate(rt, args):
+    rtir = client(rt)
+    yield measure(rt, 'autocreate_ticket', args.ops,
+                  lambda i: rtir.autocreate_ticket('abuse%d@example.org' % i, 'Report %d' % i,
+                                                   'Dear abuse team', 'auto', '10.0.%d.%d' % (i // 250, i % 250), 'Spam'))
+
+
+def bench_intake(rt, args):
+    rtir = client(rt, workers=args.workers)
+    specs = [('abuse%d@example.org' % i, 'Flood %d' % i, 'Dear abuse team', 'auto', '10.9.%d.%d' % (i // 250, i % 250), 'Spam')
+             for i in range(args.ops * 5)]
+    intake = BulkIntake(rtir, workers=args.workers, report=False)
+    yield measure_batch(rt, 'BulkIntake.run (%d workers)' % args.workers, len(specs), lambda: intake.run(specs))
+
+
+def bench_close(rt, args):
+    rtir = client(rt, workers=args.workers)
+    open_ids = [str(t.id) for t in rt.tickets.values() if t.fields['Status'] != 'resolved']
+    serial, batch = open_ids[:args.ops], open_ids[args.ops:args.ops * 2]
+    yield measure(rt, 'take_comment_close_ticket (serial)', len(serial),
+                  lambda i: rtir.take_comment_close_ticket(serial[i], 'Spam'))
+    yield measure_batch(rt, 'take_comment_close_tickets (%d workers)' % args.workers, len(batch),
+                        lambda: rtir.take_comment_close_tickets(batch, 'Spam'))
+
+
+def bench_ipindex(rt, args):
+    for i in range(args.ops * 10):
+        rt.add_ticket('abuse@example.org', 'IP %d' % i, 'Report', IP='10.%d.%d.%d' % (i // 65536, (i // 256) % 256, i % 256))
+    rtir = client(rt)
+    query = "(Status='new' OR Status='open')"
+    index = []
+    yield measure(rt, 'IPIndex.build (%d tickets)' % len(rt.tickets), 1,
+                  lambda i: index.append(IPIndex.build(rtir, query, statuses=('new', 'open'))))
+    addresses = ['10.0.%d.%d' % (i % 16, i % 256) for i in range(args.ops * 50)]
+    yield measure(rt, 'IPIndex.lookup (address)', len(addresses), lambda i: index[0].lookup(addresses[i]))
+    yield measure(rt, 'IPIndex.lookup (/24 network)', args.ops, lambda i: index[0].lookup('10.0.%d.0/24' % (i % 16)))
+    yield measure(rt, 'RT search per address', args.ops,
+                  lambda i: rtir.search_ticket_ids("'CF.{IP}' = '%s'" % addresses[i]))
+
+
+def bench_parser(rt, args):
+    rtir = client(rt)
+    query = "(Status='new' OR Status='open')"
+    tickets = list(rtir.search_tickets_full(query))
+    status = 'RT/4.2.9 200 Ok'
+    bulk = status + '\n\n' + '\n\n--\n\n'.join(rt_body(t.raw) for t in tickets) + '\n'
+    bulk_bytes = bulk.encode('utf-8')
+    search = status + '\n\n' + ''.join('%d: %s\n' % (t.id, t.subject) for t in tickets)
+    ids = status + '\n\n' + ''.join('ticket/%d\n' % t.id for t in tickets)
+    label = '(%d tickets, %d KB)' % (len(tickets), len(bulk_bytes) // 1024)
+    yield measure(rt, 'parse_rt_records str ' + label, 10, lambda i: sum(1 for _ in parse_rt_records(bulk)))
+    yield measure(rt, 'parse_rt_records bytes ' + label, 10, lambda i: sum(1 for _ in parse_rt_records(bulk_bytes)))
+    yield measure(rt, 'parse_rt_records lines ' + label, 10,
+                  lambda i: sum(1 for _ in parse_rt_records(iter(bulk_bytes.splitlines()))))
+    yield measure(rt, 'Ticket records ' + label, 10,
+                  lambda i: [Ticket(r, c) for r, c in parse_rt_records(bulk, raw=True)])
+    yield measure(rt, 'rt_kv_lines ' + label, 10, lambda i: rt_kv_lines(bulk))
+    yield measure(rt, 'parse_rt_search (%d lines)' % len(tickets), 10, lambda i: list(parse_rt_search(search)))
+    yield measure(rt, 'parse_rt_ids (%d lines)' % len(tickets), 10, lambda i: parse_rt_ids(ids))
+    yield measure(rt, 'parse_rt_status + rt_body ' + label, 1000, lambda i: (parse_rt_status(bulk), rt_body(search)))
+
+
+def bench_transport(rt, args):
+    for name in ('requests', 'urllib3', 'memory'):
+        rtir = client(rt, transport=MemoryTransport(rt.handle) if name == 'memory' else name, single_flight=False)
+        yield measure(rt, 'get_user_info (%s transport)' % name, args.ops * 5, lambda i: rtir.get_user_info('root'))
+        yield measure(rt, 'get_ticket_status (%s transport)' % name, args.ops * 5,
+                      lambda i: rtir.get_ticket_status(str(i % len(rt.tickets) + 1)))
+
+
+BENCHMARKS = [('search', bench_search), ('fields', bench_fields),
+              ('autocreate', bench_autocreate), ('intake', bench_intake), ('close', bench_close), ('ipindex', bench_ipindex),
+              ('parser', bench_parser), ('transport', bench_transport)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='RTIR4REST benchmarks against FakeRT')
+    parser.add_argument('--tickets', type=int, default=10000, help='tickets in the fake RT (default 10000)')
+    parser.add_argument('--ops', type=int, default=200, help='operations per benchmark (default 200)')
+    parser.add_argument('--latency', type=float, default=0.0, help='server latency per request in seconds')
+    parser.add_argument('--workers', type=int, default=8, help='workers for batch benchmarks (default 8)')
+    parser.add_argument('--only', default='', help='comma separated: ' + ','.join(n for n, f in BENCHMARKS))
+    args = parser.parse_args(argv)
+    only = [n.strip() for n in args.only.split(',') if n.strip()]
+    print('FakeRT: %d tickets, %.1f ms latency' % (args.tickets, args.latency * 1000))
+    print('%-42s %8s %9s %10s %9s %9s %8s' % ('benchmark', 'ops', 'seconds', 'ops/s', 'p50 ms', 'p95 ms', 'req/op'))
+    with FakeRT(tickets=args.tickets, latency=args.latency) as rt:
+        for name, bench in BENCHMARKS:
+            if only and name not in only:
+                continue
+            for result in bench(rt, args):
+                print(result.row())
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,684 @@
+# -*- coding: utf-8 -*-
+"""
+FakeRT
+------
+
+In-process stand-in for an RTIR v/4 server speaking the REST 1.0 text
+protocol used by RTIR4REST. Intended for tests and benchmarks only.
+
+>>> Basic Usage <<<
+with FakeRT(tickets=1000) as rt:
+    rtir = RTIR4REST('root','password',rt.url)
+    rtir.login()
+    print(rt.stats())
+"""
+
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+RT_VERSION = 'RT/4.2.9'
+
+LOGIN_OK_HTML = '<html><head><title>RT at a glance</title></head><body></body></html>'
+LOGIN_FAIL_HTML = '<html><head><title>Login</title></head><body>Your username or password is incorrect</body></html>'
+
+TICKET_FIELDS = ['id','Queue','Owner','Creator','Subject','Status','Priority',
+                 'InitialPriority','FinalPriority','Requestors','Cc','AdminCc',
+                 'Created','Starts','Started','Due','Resolved','Told',
+                 'LastUpdated','TimeEstimated','TimeWorked','TimeLeft']
+
+CUSTOM_FIELDS = ['Constituency','How Reported','Reporter Type','IP','Customer',
+                 'Classification','Description','Resolution','Function']
+
+DATE_FIELDS = ('Created','Starts','Started','Due','Resolved','Told','LastUpdated')
+
+DEFAULT_QUEUES = ['General','Incident Reports','Incidents','Investigations','Blocks','Countermeasures']
+
+
+def rt_date(dt):
+    """Format a datetime the way RT 4 renders dates in REST 1.0 output."""
+    if dt is None:
+        return 'Not set'
+    return dt.strftime('%a %b %d %H:%M:%S %Y')
+
+
+class _Query():
+    """Tiny TicketSQL evaluator covering the subset RTIR4REST emits."""
+
+    _token_re = re.compile(r"""\s*(?:(\()|(\))|(AND\b|OR\b)|(>=|<=|!=|=|>|<|LIKE\b)|'([^']*)'|"([^"]*)"|(CF\.\{[^}]*\}|[\w.]+))""", re.I)
+
+    def __init__(self, text):
+        self.tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            m = self._token_re.match(text, pos)
+            if not m or m.end() == pos:
+                raise ValueError('Bad query near: ' + text[pos:pos+20])
+            pos = m.end()
+            if m.group(1): self.tokens.append(('(', None))
+            elif m.group(2): self.tokens.append((')', None))
+            elif m.group(3): self.tokens.append(('BOOL', m.group(3).upper()))
+            elif m.group(4): self.tokens.append(('OP', m.group(4).upper()))
+            elif m.group(5) is not None: self.tokens.append(('VAL', m.group(5)))
+            elif m.group(6) is not None: self.tokens.append(('VAL', m.group(6)))
+            else: self.tokens.append(('WORD', m.group(7)))
+        self.pos = 0
+        self.tree = self._expr() if self.tokens else None
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _next(self):
+        tok = self._peek()
+        self.pos += 1
+        return tok
+
+    def _expr(self):
+        node = self._term()
+        while self._peek() == ('BOOL', 'OR'):
+            self._next()
+            node = ('OR', node, self._term())
+        return node
+
+    def _term(self):
+        node = self._factor()
+        while self._peek() == ('BOOL', 'AND'):
+            self._next()
+            node = ('AND', node, self._factor())
+        return node
+
+    def _factor(self):
+        kind, value = self._next()
+        if kind == '(':
+            node = self._expr()
+            self._next()
+            return node
+        field = value
+        op = self._next()[1]
+        val = self._next()[1]
+        return ('CMP', field, op, val)
+
+    def match(self, ticket):
+        return self.tree is None or self._eval(self.tree, ticket)
+
+    def _eval(self, node, ticket):
+        if node[0] == 'AND':
+            return self._eval(node[1], ticket) and self._eval(node[2], ticket)
+        if node[0] == 'OR':
+            return self._eval(node[1], ticket) or self._eval(node[2], ticket)
+        field, op, val = node[1], node[2], node[3]
+        left = ticket.value(field)
+        if field.lower() == 'id':
+            left, val = int(left), int(val)
+        elif field in DATE_FIELDS or field.lower() in [f.lower() for f in DATE_FIELDS]:
+            left = ticket.dates.get(_canonical(field))
+            if left is None:
+                return False
+            val = _parse_iso(val)
+        else:
+            left, val = str(left).lower(), str(val).lower()
+        if op == '=': return left == val
+        if op == '!=': return left != val
+        if op == '>': return left > val
+        if op == '<': return left < val
+        if op == '>=': return left >= val
+        if op == '<=': return left <= val
+        if op == 'LIKE': return val in left
+        return False
+
+
+def _canonical(field):
+    for f in TICKET_FIELDS:
+        if f.lower() == field.lower():
+            return f
+    return field
+
+
+def _parse_iso(s):
+    s = s.strip()
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Bad date: ' + s)
+
+
+class FakeTicket():
+    """One in-memory ticket with RT-style fields, custom fields and attachments."""
+
+    def __init__(self, tid, queue, subject, requestor, created):
+        self.id = tid
+        self.fields = {'Queue': queue, 'Owner': 'Nobody', 'Creator': 'root',
+                       'Subject': subject, 'Status': 'new', 'Priority': '0',
+                       'InitialPriority': '0', 'FinalPriority': '0',
+                       'Requestors': requestor, 'Cc': '', 'AdminCc': '',
+                       'TimeEstimated': '0', 'TimeWorked': '0', 'TimeLeft': '0'}
+        self.cf = dict((name, '') for name in CUSTOM_FIELDS)
+        self.dates = {'Created': created, 'Starts': None, 'Started': None, 'Due': None,
+                      'Resolved': None, 'Told': None, 'LastUpdated': created}
+        self.attachments = []
+        self.history = []
+
+    def value(self, field):
+        if field.lower() == 'id':
+            return self.id
+        if field.startswith('CF.{'):
+            return self.cf.get(field[4:-1], '')
+        if field.lower() in ('requestor', 'requestor.emailaddress'):
+            field = 'Requestors'  # TicketSQL watcher alias
+        field = _canonical(field)
+        if field in self.dates:
+            return rt_date(self.dates[field])
+        return self.fields.get(field, '')
+
+    def touch(self, when):
+        self.dates['LastUpdated'] = when
+
+    def render(self, fields=None):
+        out = []
+        wanted = None
+        if fields:
+            wanted = set(f.strip().lower() for f in fields)
+        for f in TICKET_FIELDS:
+            if f == 'id':
+                out.append('id: ticket/' + str(self.id))
+                continue
+            if wanted is not None and f.lower() not in wanted:
+                continue
+            out.append(f + ': ' + self.value(f))
+        for name in CUSTOM_FIELDS:
+            key = 'CF.{' + name + '}'
+            if wanted is not None and key.lower() not in wanted:
+                continue
+            val = self.cf.get(name, '')
+            out.append(key + ': ' + val.replace('\n', '\n' + ' ' * (len(key) + 2)))
+        return '\n'.join(out)
+
+
+class FakeRT():
+    """
+    Threaded HTTP server emulating the RTIR REST 1.0 endpoints.
+
+    tickets: number of tickets to pre-create (each with one text/plain message)
+    latency: seconds added to every request, or a dict per endpoint
+             ({'search/ticket': 0.2, 'ticket/<id>/show': 0.02, '*': 0.01})
+    jitter: extra random latency, uniform in [0, jitter]
+    error_rate, error_status: fraction of requests answered with an HTTP error
+    require_cookie: reject HTTP basic auth, only accept the login session
+                    cookie (use expire_sessions() to simulate RT timeouts)
+    """
+
+    def __init__(self, tickets=0, users=None, queues=None, latency=0.0, jitter=0.0,
+                 error_rate=0.0, error_status=502, seed=None, require_cookie=False,
+                 host='127.0.0.1', port=0):
+        self.users = users or {'root': 'password'}
+        self.queues = list(queues or DEFAULT_QUEUES)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.require_cookie = require_cookie
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.tickets = {}
+        self.sessions = {}
+        self.counters = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.next_id = 1
+        self.next_attachment = 1
+        self.clock = datetime(2018, 1, 1, 8, 0, 0)
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+        for n in range(tickets):
+            self.add_ticket('abuse' + str(n % 97) + '@example.org',
+                            'Incident Report #' + str(n + 1),
+                            'Report body ' + str(n + 1) + '\nSecond line.')
+
+    # -- data ------------------------------------------------------------
+
+    def now(self):
+        """Monotonic fake clock, one second per mutation."""
+        with self.lock:
+            self.clock += timedelta(seconds=1)
+            return self.clock
+
+    def add_ticket(self, requestor, subject, text, queue='Incident Reports', **cf):
+        """Create a ticket directly in the store. Returns the numeric id."""
+        with self.lock:
+            tid = self.next_id
+            self.next_id += 1
+            t = FakeTicket(tid, queue, subject, requestor, self.now())
+            for k, v in cf.items():
+                t.cf[k] = v
+            self.tickets[tid] = t
+            self._add_message(t, text, requestor)
+            return tid
+
+    def add_attachment(self, tid, content, content_type='application/octet-stream', creator='root'):
+        """Attach content (str or bytes) to ticket tid. Returns the attachment id."""
+        with self.lock:
+            return self._add_message(self.tickets[tid], content, creator, content_type)
+
+    def _add_message(self, t, text, creator, content_type='text/plain'):
+        parent = self.next_attachment
+        self.next_attachment += 1
+        t.attachments.append({'id': parent, 'type': 'multipart/mixed', 'content': b'', 'creator': creator})
+        aid = self.next_attachment
+        self.next_attachment += 1
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        t.attachments.append({'id': aid, 'type': content_type, 'content': text, 'creator': creator, 'parent': parent})
+        return aid
+
+    def expire_sessions(self):
+        """Drop all logged-in sessions (simulates RT session expiry)."""
+        with self.lock:
+            self.sessions.clear()
+
+    def stats(self):
+        """Snapshot of request counters per endpoint."""
+        with self.lock:
+            return dict(self.counters)
+
+    def total_requests(self):
+        with self.lock:
+            return sum(self.counters.values())
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters.clear()
+            self.bytes_in = self.bytes_out = 0
+
+    # -- server ----------------------------------------------------------
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.server.server_address[1])
+
+    def start(self):
+        handler = type('FakeRTHandler', (_Handler,), {'rt': self})
+        self.server = _Server((self.host, self.port), handler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # -- protocol --------------------------------------------------------
+
+    def count(self, endpoint):
+        with self.lock:
+            self.counters[endpoint] = self.counters.get(endpoint, 0) + 1
+
+    def endpoint(self, path):
+        """Endpoint name of a request path, ids replaced ('ticket/<id>/show')."""
+        if not path.startswith('/REST/1.0'):
+            return 'login'
+        parts = path[len('/REST/1.0'):].strip('/').split('/')
+        if parts[0] == 'ticket' and len(parts) > 1 and parts[1] != 'new':
+            parts[1] = '<id>'
+            if len(parts) == 2:
+                parts.append('show')
+            if len(parts) > 3:
+                parts[3] = '<aid>'
+        elif parts[0] in ('queue', 'user') and len(parts) > 1:
+            parts[1] = '<n>' if parts[0] == 'queue' else '<name>'
+        return '/'.join(parts)
+
+    def _delay(self, endpoint):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(endpoint, latency.get('*', 0.0))
+        return latency + (self.random.random() * self.jitter if self.jitter else 0.0)
+
+    def handle(self, method, path, query, form, headers):
+        """Dispatch one request. Returns (status, body bytes, extra headers)."""
+        path = path.rstrip('/')
+        delay = self._delay(self.endpoint(path))
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.count('error')
+            return self.error_status, b'<html><title>Bad Gateway</title></html>', {}
+        if not path.startswith('/REST/1.0'):
+            self.count('login')
+            return self._login(form)
+        rest = path[len('/REST/1.0'):].strip('/')
+        user = self._authenticate(form, headers)
+        if rest == 'logout':
+            self.count('logout')
+            self._logout(headers)
+            return 200, self._ok(''), {}
+        if user is None:
+            self.count('unauthorized')
+            return 200, (RT_VERSION + ' 401 Credentials required\n').encode(), {}
+        parts = rest.split('/')
+        with self.lock:
+            if parts[0] == 'search' and len(parts) > 1 and parts[1] == 'ticket':
+                self.count('search/ticket')
+                return 200, self._search(query), {}
+            if parts[0] == 'queue':
+                self.count('queue/<n>')
+                return 200, self._queue(parts[1] if len(parts) > 1 else ''), {}
+            if parts[0] == 'user':
+                self.count('user/<name>')
+                return 200, self._user(parts[1] if len(parts) > 1 else user), {}
+            if parts[0] == 'ticket' and len(parts) > 1:
+                if parts[1] == 'new':
+                    self.count('ticket/new')
+                    return 200, self._create(form, user), {}
+                tid = parts[1]
+                action = parts[2] if len(parts) > 2 else 'show'
+                if action == 'attachments':
+                    if len(parts) == 3:
+                        self.count('ticket/<id>/attachments')
+                        return 200, self._attachments(tid), {}
+                    if len(parts) == 5 and parts[4] == 'content':
+                        self.count('ticket/<id>/attachments/<aid>/content')
+                        return 200, self._attachment(tid, parts[3], content_only=True), {}
+                    self.count('ticket/<id>/attachments/<aid>')
+                    return 200, self._attachment(tid, parts[3]), {}
+                self.count('ticket/<id>/' + action)
+                if action == 'show':
+                    return 200, self._show(tid), {}
+                if action == 'edit':
+                    return 200, self._edit(tid, form, user), {}
+                if action == 'comment':
+                    return 200, self._comment(tid, form, user), {}
+                if action == 'take':
+                    return 200, self._take(tid, form, user), {}
+        self.count('unknown')
+        return 200, (RT_VERSION + ' 400 Bad Request\n\n# Unknown endpoint\n').encode(), {}
+
+    def _ok(self, body):
+        return (RT_VERSION + ' 200 Ok\n\n' + body + '\n\n').encode('utf-8')
+
+    def _login(self, form):
+        user, pwd = form.get('user', ''), form.get('pass', '')
+        if user in self.users and self.users[user] == pwd:
+            sid = '%032x' % self.random.getrandbits(128)
+            with self.lock:
+                self.sessions[sid] = user
+            return 200, LOGIN_OK_HTML.encode(), {'Set-Cookie': 'RT_SID_fake.80=' + sid + '; path=/'}
+        return 200, LOGIN_FAIL_HTML.encode(), {}
+
+    def _cookie_sid(self, headers):
+        cookie = headers.get('Cookie', '') or ''
+        m = re.search(r'RT_SID_fake\.80=([0-9a-f]+)', cookie)
+        return m.group(1) if m else None
+
+    def _authenticate(self, form, headers):
+        sid = self._cookie_sid(headers)
+        with self.lock:
+            if sid and sid in self.sessions:
+                return self.sessions[sid]
+        if form.get('user') in self.users and self.users[form.get('user')] == form.get('pass'):
+            return form.get('user')
+        if not self.require_cookie:
+            auth = headers.get('Authorization', '') or ''
+            if auth.startswith('Basic '):
+                import base64
+                try:
+                    user, pwd = base64.b64decode(auth[6:]).decode('utf-8').split(':', 1)
+                except Exception:
+                    return None
+                if self.users.get(user) == pwd:
+                    return user
+        return None
+
+    def _logout(self, headers):
+        sid = self._cookie_sid(headers)
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def _ticket(self, tid):
+        try:
+            return self.tickets.get(int(tid))
+        except ValueError:
+            return None
+
+    def _search(self, query):
+        q = query.get('query', [''])[0]
+        fmt = query.get('format', ['s'])[0]
+        orderby = query.get('orderby', ['+id'])[0]
+        fields = query.get('fields', [''])[0]
+        fields = [f for f in fields.split(',') if f] or None
+        try:
+            matcher = _Query(q)
+        except (ValueError, IndexError) as e:
+            return (RT_VERSION + ' 400 Bad Request\n\n# Invalid query: ' + str(e) + '\n').encode()
+        found = [t for t in self.tickets.values() if matcher.match(t)]
+        key = orderby.lstrip('+-') or 'id'
+        if key.lower() == 'id':
+            found.sort(key=lambda t: t.id)
+        else:
+            found.sort(key=lambda t: (t.dates.get(_canonical(key)) or datetime.min, t.id))
+        if orderby.startswith('-'):
+            found.reverse()
+        if not found:
+            return self._ok('No matching results.')
+        if fmt == 'i':
+            body = '\n'.join('ticket/' + str(t.id) for t in found)
+        elif fmt == 'l':
+            body = '\n\n--\n\n'.join(t.render(fields) for t in found)
+        else:
+            body = '\n'.join(str(t.id) + ': ' + t.fields['Subject'] for t in found)
+        return self._ok(body)
+
+    def _show(self, tid):
+        t = self._ticket(tid)
+        if t is None:
+            return self._ok('# Ticket ' + tid + ' does not exist.')
+        return self._ok(t.render())
+
+    def _attachments(self, tid):
+        t = self._ticket(tid)
+        if t is None:
+            return self._ok('# Ticket ' + tid + ' does not exist.')
+        rows = []
+        for a in t.attachments:
+            size = len(a['content'])
+            ssize = str(size) + 'b' if size < 1024 else '%.1fk' % (size / 1024.0)
+            rows.append(str(a['id']) + ': (Unnamed) (' + a['type'] + ' / ' + ssize + ')')
+        body = 'id: ticket/' + tid + '/attachments\nAttachments: ' + (',\n' + ' ' * 13).join(rows)
+        return self._ok(body)
+
+    def _attachment(self, tid, aid, content_only=False):
+        t = self._ticket(tid)
+        a = None
+        if t is not None:
+            for item in t.attachments:
+                if str(item['id']) == aid:
+                    a = item
+        if a is None:
+            return self._ok('# Invalid attachment id: ' + aid)
+        if content_only:
+            return (RT_VERSION + ' 200 Ok\n\n').encode() + a['content'] + b'\n'
+        text = a['content'].decode('utf-8', 'replace')
+        head = ['id: ' + str(a['id']), 'Subject: ', 'Creator: 12', 'Created: ' + rt_date(t.dates['Created']),
+                'Transaction: ' + str(a['id'] + 1000), 'Parent: ' + str(a.get('parent', 0)),
+                'MessageId: ', 'Filename: ', 'ContentType: ' + a['type'], 'ContentEncoding: none', '',
+                'Headers: Content-Type: ' + a['type'], '',
+                'Content: ' + text.replace('\n', '\n         ')]
+        return self._ok('\n'.join(head))
+
+    def _parse_content(self, form):
+        fields = {}
+        key = None
+        for line in form.get('content', '').split('\n'):
+            if line.startswith(' ') and key is not None:
+                fields[key] += '\n' + line[1:]
+                continue
+            if ':' in line:
+                key, val = line.split(':', 1)
+                key = key.strip()
+                fields[key] = val.strip()
+        return fields
+
+    def _apply(self, t, fields, user):
+        for key, val in fields.items():
+            if key.lower() in ('id', 'action', 'text'):
+                continue
+            if key.startswith('CF-'):
+                t.cf[key[3:]] = val
+            elif key.startswith('CF.{'):
+                t.cf[key[4:-1]] = val
+            elif key == 'Queue':
+                if val not in self.queues and not val.isdigit():
+                    return '# Queue ' + val + ' does not exist.'
+                t.fields['Queue'] = val
+            elif key == 'Status':
+                t.fields['Status'] = val
+                if val == 'resolved':
+                    t.dates['Resolved'] = self.clock
+            elif key == 'Requestor':
+                t.fields['Requestors'] = val
+            elif _canonical(key) in t.fields:
+                t.fields[_canonical(key)] = val
+        return None
+
+    def _create(self, form, user):
+        fields = self._parse_content(form)
+        tid = self.next_id
+        self.next_id += 1
+        t = FakeTicket(tid, fields.get('Queue', 'General'), fields.get('Subject', ''),
+                       fields.get('Requestor', ''), self.now())
+        err = self._apply(t, fields, user)
+        if err:
+            self.next_id -= 1
+            return self._ok(err)
+        self.tickets[tid] = t
+        self._add_message(t, fields.get('Text', ''), user)
+        return self._ok('# Ticket ' + str(tid) + ' created.')
+
+    def _edit(self, tid, form, user):
+        t = self._ticket(tid)
+        if t is None:
+            return self._ok('# Ticket ' + tid + ' does not exist.')
+        err = self._apply(t, self._parse_content(form), user)
+        if err:
+            return self._ok(err)
+        t.touch(self.now())
+        return self._ok('# Ticket ' + tid + ' updated.')
+
+    def _comment(self, tid, form, user):
+        t = self._ticket(tid)
+        if t is None:
+            return self._ok('# Ticket ' + tid + ' does not exist.')
+        fields = self._parse_content(form)
+        t.history.append((fields.get('Action', 'comment'), fields.get('Text', '')))
+        self._add_message(t, fields.get('Text', ''), user)
+        t.touch(self.now())
+        if fields.get('Action', 'comment').lower() == 'correspond':
+            return self._ok('# Correspondence added')
+        return self._ok('# Comments added')
+
+    def _take(self, tid, form, user):
+        t = self._ticket(tid)
+        if t is None:
+            return self._ok('# Ticket ' + tid + ' does not exist.')
+        action = self._parse_content(form).get('Action', 'take').lower()
+        old = t.fields['Owner']
+        if action == 'take' and old != 'Nobody':
+            return self._ok('# You can only take tickets that are unowned')
+        t.fields['Owner'] = user
+        t.touch(self.now())
+        return self._ok('# Owner changed from ' + old + ' to ' + user)
+
+    def _queue(self, qid):
+        try:
+            n = int(qid)
+        except ValueError:
+            n = self.queues.index(qid) + 1 if qid in self.queues else -1
+        if n < 1 or n > len(self.queues):
+            return self._ok('# Queue ' + qid + ' does not exist.')
+        name = self.queues[n - 1]
+        return self._ok('id: queue/' + str(n) + '\nName: ' + name + '\nDescription: ' + name +
+                        ' queue\nCorrespondAddress: \nCommentAddress: \nInitialPriority: 0\n'
+                        'FinalPriority: 0\nDefaultDueIn: 0')
+
+    def _user(self, name):
+        if name not in self.users:
+            return self._ok('# No user named ' + name + ' exists.')
+        return self._ok('id: user/' + str(abs(hash(name)) % 1000) + '\nName: ' + name +
+                        '\nRealName: ' + name.title() + '\nEmailAddress: ' + name + '@example.org\nDisabled: 0')
+
+
+class _Server(ThreadingHTTPServer):
+    """ThreadingHTTPServer that ignores clients dropping connections."""
+
+    def handle_error(self, request, client_address):
+        import sys
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """HTTP glue between http.server and FakeRT.handle()."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    rt = None
+
+    def log_message(self, *args):
+        pass
+
+    def _dispatch(self, method):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query, keep_blank_values=True)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        form = dict((k, v[0]) for k, v in parse_qs(raw.decode('utf-8'), keep_blank_values=True).items())
+        with self.rt.lock:
+            self.rt.bytes_in += len(raw) + len(self.path)
+        status, body, extra = self.rt.handle(method, parts.path, query, form, self.headers)
+        with self.rt.lock:
+            self.rt.bytes_out += len(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in extra.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+
+if __name__ == '__main__':
+    import sys
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    rt = FakeRT(tickets=n, port=port)
+    print('FakeRT listening on', rt.start(), 'with', n, 'tickets (user root / password)')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        rt.stop()
@@ -1,3 +1,18 @@
+import abc
+import bisect
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
 class RTIR4REST():
     # -*- coding: utf-8 -*-
     """
@@ -8,7 +23,8 @@ class RTIR4REST():
     RTIR v/4 (RT for Incident Response by Best Practical) through the REST API 
     interface.
     
-    RTIR4REST uses Requests lib for handling the HTTP(S) Session connections.
+    RTIR4REST uses Requests lib for handling the HTTP(S) Session connections
+    (transport='urllib3' talks to urllib3 directly, see Transport).
     
     >>> Basic Usage <<<
     rtir = RTIR4REST(usr,pwd,url)
@@ -35,10 +51,17 @@ class RTIR4REST():
     get_all_nobody_tickets()
     get_all_new_open_tickets()
     get_all_new_open_tickets_idlist()
+    iter_search()
+    search_ticket_ids()
+    search_tickets_full()
+    search_tickets_range()
     -
     get_queue_info()
-    get_all_queues():
+    get_queue()
+    get_all_queues()
+    resolve_queue()
     -
+    get_ticket()
     get_ticket_info()
     get_ticket_item()
     get_ticket_status()
@@ -48,12 +71,18 @@ class RTIR4REST():
     get_ticket_subject()
     get_ticket_ip()
     get_ticket_message()
+    get_ticket_attachments()
+    get_ticket_messages()
+    download_attachment()
+    cache_stats()
+    stats()
     -
     take_ticket()
     steal_ticket()
     take_or_steal_ticket()
     -
     create_ticket()
+    update_ticket()
     reply_ticket()
     comment_ticket()
     reopen_ticket()
@@ -61,7 +90,31 @@ class RTIR4REST():
     -
     take_comment_close_ticket()
     autocreate_ticket()
+    -
+    map_tickets()
+    close_tickets()
+    comment_tickets()
+    take_comment_close_tickets()
     
+    AsyncRTIR4REST offers the same methods as coroutines (requires aiohttp).
+    Connection pool: pool_connections, pool_maxsize, pool_block, keep_alive,
+    gzip, verify (False, True or a CA bundle path), ssl_context; see pool_stats().
+    ChangeFeed(rtir,query) polls only tickets updated since the last poll.
+    TicketStore(path,rtir) keeps a local SQLite replica for ad-hoc queries.
+    IPIndex maps CF.{IP} addresses and networks to tickets (rtir.ip_index).
+    SessionPool spreads calls over sessions of several service accounts.
+    WriteBehind(rtir) buffers and merges ticket changes, flushed in the background.
+    BulkRunner / python -m rtir4rest bulk applies job files over a process pool.
+    TicketExport / python -m rtir4rest export streams tickets to JSONL, CSV or Parquet.
+    transport='requests' (default), 'urllib3' or a Transport instance such as
+    MemoryTransport(handler) selects the HTTP layer; requests is imported lazily.
+
+    Every request runs under self.retry_policy (RetryPolicy: timeouts, backoff
+    retries, retry budget) and the optional rate_limiter (RateLimiter) and
+    concurrency_limiter (AdaptiveLimiter). Failures print '> Error in ...' and return '' as
+    before; rtir.last_error tells an empty result from a failed one, and
+    raise_errors=True raises RTIRError subclasses instead.
+
     Please see GitHub <https://github.com/BikerDroid/RTIR4REST> for further information.
     
     :copyright: BikerDroid (c) 2016-2018
@@ -69,29 +122,50 @@ class RTIR4REST():
     :Reference: https://rt-wiki.bestpractical.com/wiki/REST
     """
 
-    #import asyncio
-    import requests
-    from requests.packages.urllib3.exceptions import InsecureRequestWarning
-    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-    
     __title__     = 'RTIR4REST'
     __version__   = 'Beta 2.0.1'
     __build__     = 0x01042018
     __author__    = 'BikerDroid <bikerdroid@gmail.com>'
     __copyright__ = 'Copyright (c) 2016-2018, BikerDroid'
 
-    def __init__(self,rtir_user,rtir_password,rtir_full_url,useragent='Mozilla/5.0.2018',proxy_dict={}):
+    def __init__(self,rtir_user,rtir_password,rtir_full_url,useragent='Mozilla/5.0.2018',proxy_dict={},
+                 cache_size=1024,cache_ttl=300,cache_validate=False,workers=8,
+                 retry_policy=None,raise_errors=False,rate_limiter=None,concurrency_limiter=None,
+                 request_stats=None,queue_ttl=3600,ip_index=None,pool_connections=10,pool_maxsize=None,
+                 pool_block=False,keep_alive=True,gzip=True,verify=False,ssl_context=None,relogin=True,
+                 single_flight=True,transport='requests'):
         """Initializing RTIR4REST"""
         self.__loggedin = False
-        self.__requests = self.requests
-        self.__session = self.__requests.Session()
-        self.__session.auth = (rtir_user, rtir_password)
-        self.__session.headers = ({'User-Agent': useragent,'referer': rtir_full_url.rstrip('/')})
+        self.transport = TRANSPORTS[transport]() if isinstance(transport,str) else transport
+        self.transport.setup(rtir_user,rtir_password,
+                             {'User-Agent': useragent,'referer': rtir_full_url.rstrip('/'),
+                              'Accept-Encoding': 'gzip, deflate' if gzip else 'identity',
+                              'Connection': 'keep-alive' if keep_alive else 'close'},
+                             proxies=proxy_dict,verify=verify,ssl_context=ssl_context,
+                             pool_connections=pool_connections,pool_block=pool_block)
+        self.__workers = workers
+        self.__pool_size = 0
+        self.__pool_lock = threading.Lock()
+        self.__size_pool(max(workers,pool_maxsize or 0))
+        self.__relogin_enabled = relogin
+        self.__login_lock = threading.RLock()
+        self.__login_generation = 0
+        self.relogins = 0
+        self.singleflight = SingleFlight() if single_flight else None
         self.__auth = {'user': rtir_user, 'pass': rtir_password}
         self.__rtir_base_url = rtir_full_url.rstrip('/')
         self.__rtir_cookie = ''
-        self.__proxy = proxy_dict
-        self.ticketcache = {}
+        self.ticketcache = TicketCache(cache_size,cache_ttl)
+        self.attachmentcache = TicketCache(cache_size,cache_ttl)
+        self.__cache_validate = cache_validate
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.__raise_errors = raise_errors
+        self.__local = threading.local()
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.request_stats = request_stats or RequestStats()
+        self.queues = QueueDirectory(self,ttl=queue_ttl,workers=workers)
+        self.ip_index = ip_index
         self.__ticket_items = ['id','Queue','Owner','Creator','Subject','Status','Priority',
                                'InitialPriority','FinalPriority','Requestors','Cc','AdminCc',
                                'Created','Starts','Started','Due','Resolved','Told',
@@ -99,49 +173,171 @@ class RTIR4REST():
                                'CF.{Constituency}','CF.{How Reported}','CF.{Reporter Type}',
                                'CF.{IP}','CF.{Customer}','CF.{Classification}',
                                'CF.{Description}','CF.{Resolution}','CF.{Function}']
+        self.__ticket_items_lower = dict((item.lower(),item) for item in self.__ticket_items)
 
-    def login(self):
-        """Function: Login, Create Session, Get Cookie. Returns: True or False"""
-        if not self.__loggedin:
-            surl = self.__rtir_base_url
+    def __size_pool(self,workers):
+        """Grow the HTTP connection pool to at least workers connections per host"""
+        with self.__pool_lock:
+            if workers <= self.__pool_size: return
+            self.transport.resize(workers)
+            self.__pool_size = workers
+
+    def __request(self,surl,data=None,params=None,write=False,stream=False,method='POST',generation=None):
+        """Send one HTTP request under self.retry_policy: timeouts, backoff retries (reads, or writes if policy.retry_writes), RT status check. Raises RTIRError.
+        Identical concurrent reads share one request through self.singleflight; reads of another cache generation do not."""
+        self.__local.error = None
+        if self.singleflight is None or write or stream:
+            return self.__request_retry(surl,data,params,write,stream,method)
+        endpoint = RequestStats.endpoint(surl)
+        if endpoint in ('login','logout'):
+            return self.__request_retry(surl,data,params,write,stream,method)
+        key = (method,surl,repr(params),repr(data),generation)
+        return self.singleflight.do(key,lambda: self.__request_retry(surl,data,params,write,stream,method),endpoint)
+
+    def __request_retry(self,surl,data,params,write,stream,method):
+        """The retry loop of __request()"""
+        policy = self.retry_policy
+        operation = RateLimiter.operation(surl)
+        endpoint = RequestStats.endpoint(surl)
+        generation = self.__login_generation
+        relogged = not self.__relogin_enabled or not self.__loggedin or endpoint in ('login','logout')
+        attempt = 0
+        while True:
+            if not attempt: policy.deposit()
+            retry_after = ''
             try:
-                r = self.__session.post(surl, data=self.__auth, verify=False, proxies=self.__proxy)
-                if 'username or password is incorrect' in r.text:
-                    print('*** Username or Password is incorrect ***')
-                    self.__loggedin = False
-                if '<title>Login</title>' in r.text:
-                    print('*** Failed to Login ***')
-                    self.__loggedin = False
-                if '<title>RT at a glance</title>' in r.text:
-                    self.__rtir_cookie = r.cookies
-                    self.__loggedin = True                
-            except Exception as e:
-                print('> Error in login() :',e)
-                self.__loggedin = False
-        return self.__loggedin
-    
-    def newlogin(self,new_user,new_password):
-        """Used to change current logged-in user to a new person"""
-        self.logout()
-        self.__session.auth = (new_user, new_password)
-        self.__auth = {'user': new_user, 'pass': new_password}
-        surl = self.__rtir_base_url
+                r = self.__send(method, surl, operation, endpoint, data=data, params=params, stream=stream,
+                                timeout=policy.timeout)
+            except RTIRConnectTimeout as e:
+                error, safe = e, True
+            except (RTIRTimeout,RTIRConnectionError) as e:
+                error, safe = e, False
+            else:
+                if r.status_code < 400:
+                    if stream:
+                        r = StreamedResponse(r)
+                        status = parse_rt_status(r.head)
+                    else:
+                        status = parse_rt_status(r.content[:256])
+                    if status[0].startswith('RT/') and status[1] == '401' and not relogged:
+                        relogged = True
+                        if self.__relogin(generation):
+                            r.close()
+                            continue # replay: RT did not run the request
+                    if status[0].startswith('RT/') and status[1] != '200':
+                        r.close()
+                        raise RTIRResponseError(' '.join(status),surl,int(status[1]) if status[1].isdigit() else None)
+                    return r
+                error, safe = RTIRHTTPError('HTTP '+str(r.status_code)+' '+r.reason,surl,r.status_code), False
+                retry_after = r.headers.get('Retry-After','')
+                r.close()
+                if not r.status_code in policy.retry_status:
+                    raise error
+            if not (safe or not write or policy.retry_writes) or not policy.allow_retry(attempt):
+                raise error
+            self.request_stats.retry(endpoint)
+            delay = policy.delay(attempt)
+            if retry_after.isdigit(): delay = max(delay,min(int(retry_after),policy.backoff_max))
+            time.sleep(delay)
+            attempt += 1
+
+    def __send(self,method,surl,operation,endpoint,**kwargs):
+        """transport.request() behind the rate and concurrency limiters, recorded in self.request_stats"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(operation)
+        limiter = self.concurrency_limiter
+        if limiter is not None: limiter.acquire()
+        started = time.monotonic()
+        try:
+            r = self.transport.request(method, surl, **kwargs)
+        except Exception as e:
+            latency = time.monotonic()-started
+            if limiter is not None: limiter.release(latency,True)
+            self.request_stats.record(endpoint,latency,None,0,0,e)
+            raise
+        if kwargs.get('stream'):
+            bytes_in = int(r.headers.get('Content-Length') or 0)
+        else:
+            bytes_in = len(r.content)
+        latency = time.monotonic()-started
+        failed = r.status_code >= 500 or r.status_code == 429
+        if limiter is not None: limiter.release(latency,failed)
+        self.request_stats.record(endpoint,latency,r.status_code,len(r.request.body or '')+len(r.request.url),bytes_in,
+                                  'HTTP '+str(r.status_code) if r.status_code >= 400 else None)
+        return r
+
+    def stats(self):
+        """Per endpoint request statistics: count, errors, retries, bytes, latency histogram"""
+        return self.request_stats.snapshot()
+
+    def pool_stats(self):
+        """Per host connection pool counters: maxsize, connections (opened), idle, in_use, requests and discarded (pool full, counted per host name for the whole process)"""
+        return self.transport.pool_stats()
+
+    def __error(self,where,e,default):
+        """Record e as last_error (and as a failure of the running map_tickets() call), then raise it (raise_errors=True) or print it and return default"""
+        self.__local.error = e
+        failures = getattr(self.__local,'failures',None)
+        if failures is not None: failures.append(e)
+        if self.__raise_errors: raise e
+        print('> Error in '+where+'() :',e)
+        return default
+
+    @property
+    def last_error(self):
+        """Exception of the last failed call in this thread, None if the last request succeeded"""
+        return getattr(self.__local,'error',None)
+
+    @property
+    def ticket_items(self):
+        """Valid ticket item names (get_ticket_item(), TicketExport fields)"""
+        return list(self.__ticket_items)
+
+    @property
+    def user(self):
+        """Name of the logged in user ('' after logout)"""
+        return self.__auth['user'] if self.__auth and self.__loggedin else ''
+
+    def __authenticate(self,where):
+        """POST the credentials to the login page and check the result. Returns: True or False"""
         try:
-            r = self.__session.post(surl, data=self.__auth, verify=False, proxies=self.__proxy)
+            r = self.__request(self.__rtir_base_url, data=self.__auth)
             if 'username or password is incorrect' in r.text:
                 print('*** Username or Password is incorrect ***')
-                self.__loggedin = False
             if '<title>Login</title>' in r.text:
                 print('*** Failed to Login ***')
-                self.__loggedin = False
-            if '<title>RT at a glance</title>' in r.text:
+            self.__loggedin = '<title>RT at a glance</title>' in r.text
+            if self.__loggedin:
                 self.__rtir_cookie = r.cookies
-                self.__loggedin = True                
+                self.__login_generation += 1
         except Exception as e:
-            print('> Error in login() :',e)
             self.__loggedin = False
+            self.__error(where,e,False)
         return self.__loggedin
 
+    def __relogin(self,generation):
+        """Log in again after RT rejected the session, once for all threads that saw the same session expire"""
+        with self.__login_lock:
+            if generation != self.__login_generation: return self.__loggedin
+            self.relogins += 1
+            self.transport.clear_cookies()
+            return self.__authenticate('relogin')
+
+    def login(self):
+        """Function: Login, Create Session, Get Cookie. Returns: True or False"""
+        if not self.__loggedin:
+            with self.__login_lock:
+                if not self.__loggedin: self.__authenticate('login')
+        return self.__loggedin
+    
+    def newlogin(self,new_user,new_password):
+        """Used to change current logged-in user to a new person"""
+        self.logout()
+        self.transport.set_auth(new_user,new_password)
+        self.__auth = {'user': new_user, 'pass': new_password}
+        with self.__login_lock:
+            return self.__authenticate('newlogin')
+
     def logout(self):
         """Function: Clear Session and Cookie. Returns: True or False"""
         if self.__loggedin:
@@ -149,16 +345,15 @@ class RTIR4REST():
             params = ''
             payload = {'content': params}
             try:
-                r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
-                self.__session.close()
+                r = self.__request(surl, data=payload)
+                self.transport.close()
                 self.__rtir_cookie = ''
                 self.__loggedin = False
                 self.__auth = None
-                self.__session.auth = None
+                self.transport.set_auth(None,None)
                 return True
             except Exception as e:
-                print('> Error in logout() :',e)
-                return False
+                return self.__error('logout',e,False)
 
     def __rtir_text_format(self,intxt):
         """Function: Prepare text for RTIR Text (trailing space)"""
@@ -168,38 +363,97 @@ class RTIR4REST():
 
     def response_status(self,text):
         """Function: RTIR Status Response"""
-        s = text.splitlines()[0].split(' ')
-        rtir_version  = s[0].strip()
-        status_code   = s[1].strip()
-        status_string = s[2].strip()
-        return [rtir_version,status_code,status_string]
+        return parse_rt_status(text)
 
     def clean_response(self,text):
         """Function: Remove first two lines of the RTIR response. #1: RT/4.2.9 200 Ok, #2: \n"""
-        if len(text.splitlines()) > 2:
-            return '\n'.join(text.splitlines()[2:]).strip()
-        else:
-            return text.strip()
+        return rt_body(text)
 
     def search_tickets(self,query,raw=False):
         """Function: Search tickets using the RTIR search criteria. Query example: '(Created > "2016-01-01") AND (CF.{Classification} = "Spam")'"""
         if not self.__loggedin: return ''
         surl = self.__rtir_base_url+"/REST/1.0/search/ticket?query="+query
         try:
-            r = self.__session.post(surl, verify=False, proxies=self.__proxy)
+            r = self.__request(surl)
             if raw:
                 return r.text.strip()
             else:
-                s = ''
-                if len(r.text.strip()):
-                    for sline in r.text.strip().splitlines():
-                        if ': ' in sline:
-                            s += sline + '\n'
-                    s = s[:-1]                    
-                return s.strip()
+                return self.__kv_lines(r.text)
         except Exception as e:
-            print('> Error in get_all_new_open_tickets() :',e)
-            return ''
+            return self.__error('search_tickets',e,'')
+
+    def iter_search(self,query,sort=False):
+        """Generator: search tickets and yield (int id, subject) tuples while the response streams in. sort=True returns them in numeric id order."""
+        if not self.__loggedin: return
+        surl = self.__rtir_base_url+'/REST/1.0/search/ticket'
+        params = {'query': query}
+        if sort: params['orderby'] = '+id'
+        try:
+            r = self.__request(surl, params=params, stream=True)
+        except Exception as e:
+            self.__error('iter_search',e,None)
+            return
+        try:
+            for ticketid, subject in parse_rt_search(r.iter_lines()):
+                yield ticketid, subject
+        finally:
+            r.close()
+
+    def __kv_lines(self,text):
+        """Keep only the 'key: value' lines of a response"""
+        return rt_kv_lines(text)
+
+    def search_ticket_ids(self,query):
+        """Search tickets, return a sorted list of int ticket ids (format=i)"""
+        if not self.__loggedin: return []
+        surl = self.__rtir_base_url+'/REST/1.0/search/ticket'
+        params = {'query': query, 'format': 'i', 'orderby': '+id'}
+        try:
+            r = self.__request(surl, params=params)
+        except Exception as e:
+            return self.__error('search_ticket_ids',e,[])
+        return parse_rt_ids(r.text)
+
+    def search_tickets_full(self,query,fields=None,page_size=500,strict=False):
+        """Generator: search tickets and yield Ticket records fetched in bulk (format=l), page_size tickets per request. Full records fill the ticket cache.
+        Stops at the first failed request; strict=True raises its error instead."""
+        if not self.__loggedin: return
+        id_list = self.search_ticket_ids(query)
+        if strict and self.last_error is not None: raise self.last_error
+        for n in range(0,len(id_list),page_size):
+            page = id_list[n:n+page_size]
+            tickets = self.__search_range(query,page[0],page[-1],fields,'search_tickets_full')
+            if tickets is None:
+                if strict: raise self.last_error
+                return
+            for ticket in tickets:
+                yield ticket
+
+    def search_tickets_range(self,query,first_id,last_id,fields=None):
+        """Ticket records (format=l) of the tickets matching query with first_id <= id <= last_id, in one request. fields limits the record fields."""
+        if not self.__loggedin: return []
+        return self.__search_range(query,first_id,last_id,fields,'search_tickets_range') or []
+
+    def __search_range(self,query,first_id,last_id,fields,where):
+        """One format=l search over an id range. Full records fill the ticket cache. Returns None on errors."""
+        surl = self.__rtir_base_url+'/REST/1.0/search/ticket'
+        params = {'query': '('+query+') AND id >= '+str(first_id)+' AND id <= '+str(last_id),
+                  'format': 'l', 'orderby': '+id'}
+        if fields: params['fields'] = ','.join(fields)
+        generation = self.ticketcache.generation()
+        try:
+            r = self.__request(surl, params=params, generation=generation)
+        except Exception as e:
+            return self.__error(where,e,None)
+        status = r.text.split('\n',1)[0]
+        tickets = []
+        for record, chunk in parse_rt_records(r.text,raw=True):
+            if not record.get('id','').startswith('ticket/'): continue
+            ticket = Ticket(record,status+'\n\n'+chunk)
+            if not fields:
+                self.ticketcache.set(str(ticket.id),ticket,ticket.last_updated,generation)
+            tickets.append(ticket)
+        return tickets
 
     def get_all_nobody_tickets(self):
         """Function: Get UnOwned (Nobody), New and Open tickets. Returns: separated string."""
@@ -218,50 +472,54 @@ class RTIR4REST():
     def get_all_new_open_tickets_idlist(self):
         """Get a ID list of new and open tickets of all users"""
         if not self.__loggedin: return []
-        id_list = []
-        scases = self.get_all_new_open_tickets()
-        for sline in scases.splitlines():
-            if ': ' in sline:
-                id_list.append(sline.split(':')[0].strip())
-        id_list.sort()
-        return id_list
+        query = "(Status='new' OR Status='open')"
+        return [str(ticketid) for ticketid, subject in self.iter_search(query,sort=True)]
 
     def get_queue_info(self,queueid=''):
         """Get Queue information list (LF separated)."""
         if not self.__loggedin: return ''
         surl = self.__rtir_base_url+'/REST/1.0/queue/'+queueid
         try:
-            r = self.__session.post(surl, verify=False, proxies=self.__proxy)
-            s = ''
+            r = self.__request(surl)
             if len(r.text.strip()):
                 if 'does not exist' in r.text:
                     return ''
                 else:
-                    for sline in  r.text.strip().splitlines():
-                        if ': ' in sline:
-                            s += sline + '\n'
-                    s = s[:-1]                    
-                    return self.clean_response(s)
+                    return self.__kv_lines(r.text)
         except Exception as e:
-            print('> Error in get_queue_info() :',e)
-            return ''
+            return self.__error('get_queue_info',e,'')
+
+    def get_queue(self,queueid):
+        """Get a queue as a dict of its fields ('id' is the int queue id), None if it does not exist"""
+        if not self.__loggedin: return None
+        surl = self.__rtir_base_url+'/REST/1.0/queue/'+str(queueid)
+        try:
+            r = self.__request(surl, method='GET')
+        except Exception as e:
+            return self.__error('get_queue',e,None)
+        for record in parse_rt_records(r.text):
+            if 'Name' in record and record.get('id','').startswith('queue/'):
+                record['id'] = int(record['id'][6:])
+                return record
+        return None
 
     def get_all_queues(self,queue_id_max=16):
-        """Get All Queues. Returns string: 'id,queue' + \n """
+        """Get All Queues from the cached queue directory (self.queues). Returns string: 'id,queue' + \n """
         if not self.__loggedin: return ''
-        queues_list = ''
-        for queueid in range(0,queue_id_max):
-            surl = self.__rtir_base_url+'/REST/1.0/queue/'+str(queueid)
-            r = self.__session.get(surl, verify=False, proxies=self.__proxy)
-            for s in r.text.split('\n'):
-                if 'Name:' in s:
-                    try:
-                        squeue = s.strip().split(': ')[1].strip()
-                        if squeue:
-                            queues_list += str(queueid)+','+squeue+'\n'
-                    except:
-                        pass
-        return queues_list.strip()
+        try:
+            queues = self.queues.items()
+        except Exception as e:
+            return self.__error('get_all_queues',e,'')
+        return '\n'.join([str(queueid)+','+name for queueid, name in queues if queueid < queue_id_max])
+
+    def resolve_queue(self,queue):
+        """Queue id of a queue name (or id), None if unknown. Uses the cached queue directory."""
+        return self.queues.resolve(queue)
+
+    def __check_queue(self,queue):
+        """Raise RTIRError if the loaded queue directory does not know queue (no network calls)"""
+        if self.queues.known(queue) is False:
+            raise RTIRError('Queue '+str(queue)+' does not exist')
 
     def get_user_info(self,user=''):
         """Get user information. Defaults to logged in user."""
@@ -270,54 +528,83 @@ class RTIR4REST():
             user = self.__auth['user']
         surl = self.__rtir_base_url+'/REST/1.0/user/'+user
         try:
-            r = self.__session.post(surl, verify=False, proxies=self.__proxy)
-            s = ''
-            if len(r.text.strip()):
-                for sline in  r.text.strip().splitlines():
-                    if ': ' in sline:
-                        s += sline + '\n'
-                s = s[:-1]                    
-            return s.strip()
+            r = self.__request(surl)
+            return self.__kv_lines(r.text)
         except Exception as e:
-            print('> Error in get_user_info() :',e)
-            return ''
+            return self.__error('get_user_info',e,'')
+
+    def get_ticket(self,sticketid):
+        """Get the ticket as a parsed Ticket record (None if it does not exist). Served from self.ticketcache when fresh."""
+        if not self.__loggedin: return None
+        if not isinstance(sticketid,str): sticketid = str(sticketid)
+        ticket = self.ticketcache.get(sticketid)
+        if ticket is not None and self.__cache_validate:
+            try:
+                last_updated = self.__ticket_last_updated(sticketid)
+            except Exception as e:
+                return self.__error('get_ticket',e,None)
+            if ticket.last_updated != last_updated:
+                self.__invalidate(sticketid)
+                ticket = None
+        if ticket is None:
+            surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/show'
+            generation = self.ticketcache.generation(sticketid)
+            try:
+                r = self.__request(surl,generation=generation)
+                response = r.text.strip()
+                if not 'id: ticket/' in response:
+                    if 'does not exist' in response: return None
+                    raise RTIRResponseError(rt_body(response).split('\n',1)[0] or 'no ticket in the response',surl)
+            except Exception as e:
+                return self.__error('get_ticket',e,None)
+            ticket = Ticket.from_text(response)
+            self.ticketcache.set(sticketid,ticket,ticket.last_updated,generation)
+        return ticket
 
     def get_ticket_info(self,sticketid,raw=False):
         """Get all information about the ticket."""
         if not self.__loggedin: return ''
-        if not isinstance(sticketid,str): sticketid = str(sticketid)
-        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/show'
         try:
-            if sticketid in self.ticketcache:
-                response = self.ticketcache[sticketid]
-            else:
-                r = self.__session.post(surl, verify=False, proxies=self.__proxy)
-                response = r.text.strip()
-            if raw: return response
-            s = ''
-            if len(response):
-                for sline in  response.splitlines():
-                    if ': ' in sline:
-                        s += sline + '\n'
-                s = s[:-1]
-            self.ticketcache.clear()
-            self.ticketcache[sticketid] = s
-            return s.strip()
+            ticket = self.get_ticket(sticketid)
+            if ticket is None: return ''
+            if raw: return ticket.raw
+            return self.__kv_lines(ticket.raw)
         except Exception as e:
-            self.ticketcache.clear()
-            print('> Error in get_ticket_info() :',e)
-            return ''
+            return self.__error('get_ticket_info',e,'')
+
+    def __invalidate(self,sticketid):
+        """Drop cached data of a changed ticket"""
+        self.ticketcache.invalidate(sticketid)
+        self.attachmentcache.invalidate(sticketid)
+
+    def __ticket_last_updated(self,sticketid):
+        """Fetch only LastUpdated for the ticket (cheap cache validation)"""
+        surl = self.__rtir_base_url+'/REST/1.0/search/ticket?query=id='+sticketid+'&format=l&fields=LastUpdated'
+        r = self.__request(surl)
+        return self.__find_item(r.text,'LastUpdated')
+
+    def __find_item(self,text,item):
+        """Value of the first 'item: value' line in text, or ''"""
+        for sline in text.splitlines():
+            if sline.startswith(item+':'):
+                return sline[len(item)+1:].strip()
+        return ''
+
+    def cache_stats(self):
+        """Ticket cache counters: hits, misses, evictions, size, maxsize"""
+        return self.ticketcache.stats()
 
     def get_ticket_item(self,sticketid,ticketitem):
         """Get the ticket item. Valid ticketitems are in self.__ticket_items """
         if not self.__loggedin: return ''
-        if not ticketitem.lower().strip() in [item.lower() for item in self.__ticket_items]: return ''
-        lines = self.get_ticket_info(sticketid).splitlines()
-        result = ''
-        for s in lines:
-            if ticketitem.lower().strip() in s.lower():
-                if ': ' in s: result = ':'.join(s.split(':')[1:]).strip()
-        return result
+        item = self.__ticket_items_lower.get(ticketitem.lower().strip())
+        if item is None: return ''
+        try:
+            ticket = self.get_ticket(sticketid)
+        except Exception as e:
+            return self.__error('get_ticket_item',e,'')
+        if ticket is None: return ''
+        return ticket.get(item)
 
     def get_ticket_queue(self,sticketid):
         """Get ticket Queue (get_ticket_item helper)"""
@@ -363,55 +650,91 @@ class RTIR4REST():
         """Get ticket Classification (get_ticket_item helper)"""
         return self.get_ticket_item(sticketid,'CF.{Constituency}')
     
-    def get_ticket_message(self,sticketid,content_type='text/plain'):
-        """Get primary message (text/plain) for the ticket"""
+    def get_ticket_attachments(self,sticketid):
+        """Get the ticket attachment index as a list of Attachment records. Cached per ticket."""
+        if not self.__loggedin: return []
+        if not isinstance(sticketid,str): sticketid = str(sticketid)
+        attachments = self.attachmentcache.get(sticketid)
+        if attachments is None:
+            surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/attachments'
+            generation = self.attachmentcache.generation(sticketid)
+            try:
+                r = self.__request(surl,generation=generation)
+            except Exception as e:
+                return self.__error('get_ticket_attachments',e,[])
+            attachments = Attachment.parse_list(r.text)
+            self.attachmentcache.set(sticketid,attachments,'',generation)
+        return attachments
+
+    def get_ticket_message(self,sticketid,content_type='text/plain',first=False):
+        """Get primary message (text/plain) for the ticket: the latest one, or the first one with first=True"""
         if not self.__loggedin: return ''
         if not isinstance(sticketid,str): sticketid = str(sticketid)
-        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/attachments'
         try:
-            r = self.__session.post(surl, verify=False)
+            attachments = [a for a in self.get_ticket_attachments(sticketid) if content_type in a.content_type]
+            if not attachments: return ''
+            surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/attachments/'+str(attachments[0 if first else -1].id)
+            r = self.__request(surl)
         except Exception as e:
-            print('> Error in get_ticket_message(#1) :',e)
-            return ''
-        attachmentid = rawmessage = ''
-        if len(r.text.strip()):
-            for sline in  r.text.strip().splitlines():
-                if content_type in sline:
-                    x = 0
-                    if 'attachments:' in sline.lower():
-                        x = 1
-                    attachmentid = sline.strip().split(':')[x].strip()
-        if len(attachmentid):
-            surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/attachments/'+attachmentid
-            try:
-                r = self.__session.post(surl, verify=False)
-            except Exception as e:
-                print('> Error in get_ticket_message(#2) :',e)
-                return ''
-            rawmessage = '\n'.join(r.text.splitlines()[2:]).strip()
-        return rawmessage
+            return self.__error('get_ticket_message',e,'')
+        return rt_body(r.text)
 
     def get_ticket_message_id_list(self,sticketid,content_type='text/plain'):
         """Get message id list (text/plain) for the ticket"""
         if not self.__loggedin: return ''
+        try:
+            attachments = self.get_ticket_attachments(sticketid)
+        except Exception as e:
+            return self.__error('get_ticket_message_id_list',e,'')
+        return ','.join([str(a.id) for a in attachments if content_type in a.content_type])
+
+    def get_ticket_messages(self,sticketid,ids=None,content_type='text/plain',workers=None):
+        """Get several messages concurrently. ids defaults to all content_type attachments. Returns OrderedDict id -> message."""
+        if not self.__loggedin: return OrderedDict()
         if not isinstance(sticketid,str): sticketid = str(sticketid)
-        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/attachments'
+        if ids is None:
+            ids = self.get_ticket_message_id_list(sticketid,content_type).split(',')
+        ids = [str(messageid) for messageid in ids if str(messageid)]
+        if not ids: return OrderedDict()
+        workers = min(workers or self.__workers,len(ids))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            messages = pool.map(lambda messageid: self.get_ticket_message_by_id(sticketid,messageid),ids)
+            return OrderedDict(zip(ids,messages))
+
+    def download_attachment(self,sticketid,attachmentid,out,chunk_size=65536):
+        """Stream the raw attachment content to out (file path or binary file object) in chunks. Returns bytes written."""
+        if not self.__loggedin: return 0
+        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+str(sticketid)+'/attachments/'+str(attachmentid)+'/content'
         try:
-            r = self.__session.post(surl, verify=False, proxies=self.__proxy)
+            r = self.__request(surl, stream=True)
         except Exception as e:
-            print('> Error in get_ticket_message(#1) :',e)
-            return ''
-        attachmentid = attachmentlist = ''
-        if len(r.text.strip()):
-            for sline in r.text.strip().splitlines():
-                if content_type in sline:
-                    x = 0
-                    if 'attachments:' in sline.lower():
-                        x = 1
-                    attachmentid = sline.strip().split(':')[x].strip()
-                    if len(attachmentid):
-                        attachmentlist += attachmentid+','
-        return attachmentlist[:-1]
+            return self.__error('download_attachment',e,0)
+        fout = open(out,'wb') if isinstance(out,str) else out
+        written = 0
+        try:
+            head = b''
+            tail = b''
+            for chunk in r.iter_content(chunk_size):
+                if head is not None:
+                    head += chunk
+                    if not b'\n\n' in head: continue
+                    status, chunk = head.split(b'\n\n',1)
+                    if parse_rt_status(status)[1] != '200':
+                        raise RTIRResponseError(status.decode('utf-8','replace'),surl)
+                    head = None
+                chunk = tail+chunk
+                tail = chunk[-1:]
+                fout.write(chunk[:-1])
+                written += len(chunk)-1
+            if tail and tail != b'\n': # RT appends one newline to the content
+                fout.write(tail)
+                written += 1
+        except Exception as e:
+            return self.__error('download_attachment',e,written)
+        finally:
+            r.close()
+            if isinstance(out,str): fout.close()
+        return written
 
     def get_ticket_message_by_id(self,sticketid,smessageid,content_type='text/plain'):
         """Get message by id for the ticket"""
@@ -419,16 +742,10 @@ class RTIR4REST():
         if not isinstance(sticketid,str): sticketid = str(sticketid)
         surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/attachments/'+smessageid
         try:
-            r = self.__session.post(surl, verify=False, proxies=self.__proxy)
+            r = self.__request(surl)
         except Exception as e:
-            print('> Error in get_ticket_message(#1) :',e)
-            return ''
-        if len(r.text.strip()):
-            message = ''
-            for sline in r.text.strip().splitlines():
-                if 'RT/' in sline: continue
-                message += sline+'\n'
-        return message
+            return self.__error('get_ticket_message_by_id',e,'')
+        return ''.join([sline+'\n' for sline in r.text.strip().splitlines() if not 'RT/' in sline])
 
     def take_ticket(self,sticketid):
         """Take UNowned ticket"""
@@ -437,11 +754,11 @@ class RTIR4REST():
         params = 'Action: take'
         payload = {'content': params}
         try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
+            r = self.__request(surl, data=payload, write=True)
+            self.__invalidate(sticketid)
             return r.text.strip()
         except Exception as e:
-            print('> Error in take_ticket() :',e)
-            return ''
+            return self.__error('take_ticket',e,'')
 
     def steal_ticket(self,sticketid):
         """Steal Owned ticket"""
@@ -450,11 +767,11 @@ class RTIR4REST():
         params = 'Action: steal'
         payload = {'content': params}
         try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
+            r = self.__request(surl, data=payload, write=True)
+            self.__invalidate(sticketid)
             return r.text.strip()
         except Exception as e:
-            print('> Error in steal_ticket() :',e)
-            return ''
+            return self.__error('steal_ticket',e,'')
 
     def take_or_steal_ticket(self,sticketid):
         """Take or Steal ticket depending on ownership"""
@@ -477,19 +794,24 @@ class RTIR4REST():
         params = t_id + action + text
         payload = {'content': params}
         try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
+            r = self.__request(surl, data=payload, write=True)
+            self.__invalidate(sticketid)
             return r.text.strip()
         except Exception as e:
-            print('> Error in comment_ticket() :',e)
-            return ''
+            return self.__error('comment_ticket',e,'')
 
-    def create_ticket(self,abusemail,subj,bodytxt,constituency='',cc='',admincc=''):
-        """Create a new ticket with basic data. Use bodytext='' to autocreate_ticket(). The abuseemail is the Correspondents"""
+    def create_ticket(self,abusemail,subj,bodytxt,constituency='',cc='',admincc='',queue='Incident Reports',fields=None):
+        """Create a new ticket with basic data. Use bodytext='' to autocreate_ticket(). The abuseemail is the Correspondents.
+        fields (TicketEdit or dict) are set in the same request: fields={'CF_IP': '10.0.0.1', 'Status': 'resolved'}"""
         if not self.__loggedin: return ''
+        try:
+            self.__check_queue(queue)
+        except RTIRError as e:
+            return self.__error('create_ticket',e,'')
         surl = self.__rtir_base_url+'/REST/1.0/ticket/new'
         ecc = eadmincc = sip = sconstituency = ''
         t_id = 'id: ticket/new\n'
-        queue = 'Queue: Incident Reports\n'
+        queue = 'Queue: ' + queue + '\n'
         owner = 'Owner: ' + self.__auth['user'] + '\n'
         requestor = 'Requestor: ' + abusemail.strip() + '\n'
         subject = 'Subject: ' + subj.strip() + '\n'
@@ -503,92 +825,81 @@ class RTIR4REST():
         if len(admincc):
             eadmincc = 'AdminCc: ' + admincc.strip() + '\n'
         params = t_id + queue + requestor + owner + ecc + eadmincc + subject + text + customer + reporter_type + ecc + eadmincc
+        if fields: params += TicketEdit(fields).content()
         payload = {'content': params}        
-        try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
-            sticket = r.text.strip().splitlines()[2].split(' ')[2] # '# Ticket 888888 created.'
-            return sticket.strip()  
-        except Exception as e:
-            print('> Error in create_ticket() :',e)
-            return ''
+        policy = self.retry_policy
+        guard = query = None
+        if policy.retry_creates:
+            query = "Requestor = '"+self.__quote(abusemail.strip())+"' AND Subject = '"+self.__quote(subj.strip())+"'"
+            existing = self.search_ticket_ids(query)
+            if self.last_error is None: guard = max(existing or [0]) # no guard, no retry: older tickets must not be adopted
+        attempt = 0
+        while True:
+            try:
+                r = self.__request(surl, data=payload, write=True)
+                sline = rt_body(r.text).split('\n',1)[0] # '# Ticket 888888 created.'
+                if not sline.endswith('created.'): raise RTIRError(sline.lstrip('# '),surl)
+                return sline.split(' ')[2].strip()
+            except (RTIRTimeout,RTIRConnectionError,RTIRHTTPError) as e:
+                if guard is None or (e.status and not e.status in policy.retry_status) or not policy.allow_retry(attempt):
+                    return self.__error('create_ticket',e,'')
+                created = [ticketid for ticketid in self.search_ticket_ids(query) if ticketid > guard]
+                if self.last_error is not None: return self.__error('create_ticket',e,'') # unknown whether it was created
+                if created: return str(created[0])
+                time.sleep(policy.delay(attempt))
+                attempt += 1
+            except Exception as e:
+                return self.__error('create_ticket',e,'')
 
-    def set_ticket_owner(self,sticketid,owner):
-        """Set the owner of the ticket. Must be a valid user."""
+    def __quote(self,value):
+        """Escape a value for a single-quoted TicketSQL string"""
+        return value.replace('\\','\\\\').replace("'","\\'")
+
+    def update_ticket(self,sticketid,edit=None,**fields):
+        """Apply several field changes in one /edit POST. edit: TicketEdit or dict, fields: Owner='x', Status='open', CF_IP='1.2.3.4' (CF_ = CF-)"""
         if not self.__loggedin: return ''
-        self.take_or_steal_ticket(sticketid)
+        if not isinstance(sticketid,str): sticketid = str(sticketid)
+        if not isinstance(edit,TicketEdit):
+            edit = TicketEdit(edit)
+        edit.update(fields)
+        if not len(edit): return ''
         surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/edit'
-        t_id = 'id: ' + sticketid + '\n'
-        sowner = 'Owner: ' + owner + '\n'
-        params = t_id + sowner
-        payload = {'content': params}
+        payload = {'content': edit.content(sticketid)}
         try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
+            r = self.__request(surl, data=payload, write=True)
+            self.__invalidate(sticketid)
             return self.clean_response(r.text)
         except Exception as e:
-            print('> Error in set_ticket_owner() :',e)
-            return ''
+            return self.__error('update_ticket',e,'')
+
+    def set_ticket_owner(self,sticketid,owner):
+        """Set the owner of the ticket. Must be a valid user."""
+        if not self.__loggedin: return ''
+        return self.update_ticket(sticketid,Owner=owner)
 
     def set_ticket_resolution(self,sticketid,resolution):
-        """Set the resolution of the ticket. Queue = Incidents"""
+        """Take and set the resolution of the ticket in one edit"""
         if not self.__loggedin: return ''
-        self.take_or_steal_ticket(sticketid)
-        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/edit'
-        sresolution = 'CF-Resolution: ' + resolution + '\n'
-        params = sresolution
-        payload = {'content': params}
-        try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
-            return self.clean_response(r.text)
-        except Exception as e:
-            print('> Error in set_ticket_resolution() :',e)
-            return ''
+        return self.update_ticket(sticketid,{'Owner': self.__auth['user'],'CF-Resolution': resolution})
 
     def set_ticket_queue(self,sticketid,queue):
-        """Set Queue"""
+        """Set Queue. The name is checked against the queue directory when it is loaded."""
         if not self.__loggedin: return ''
-        self.take_or_steal_ticket(sticketid)
-        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/edit'
-        squeue = 'Queue: ' + queue + '\n'
-        params = squeue
-        payload = {'content': params}
         try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
-            return self.clean_response(r.text)
-        except Exception as e:
-            print('> Error in reopen_ticket() :',e)
-            return ''
+            self.__check_queue(queue)
+        except RTIRError as e:
+            return self.__error('set_ticket_queue',e,'')
+        return self.update_ticket(sticketid,Owner=self.__auth['user'],Queue=queue)
 
     def set_ticket_classification(self,sticketid,classification):
-        """Update ticket classification"""
+        """Take, set Queue: Incidents and the classification in one edit"""
         if not self.__loggedin: return ''
-        self.take_or_steal_ticket(sticketid)
-        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/edit'
-        queue = 'Queue: Incidents\n'
-        sclassification = 'CF-Classification: ' + classification
-        params = queue + sclassification
-        payload = {'content': params}
-        try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
-            return self.clean_response(r.text)
-        except Exception as e:
-            print('> Error in reopen_ticket() :',e)
-            return ''
+        return self.update_ticket(sticketid,{'Owner': self.__auth['user'],'Queue': 'Incidents','CF-Classification': classification})
 
     def set_ticket_ip(self,sticketid,ipaddress):
-        """Update ticket IP-address"""
+        """Take, set Queue: Incidents and the IP-address in one edit"""
         if not self.__loggedin: return ''
-        self.take_or_steal_ticket(sticketid)
-        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/edit'
-        queue = 'Queue: Incidents\n'
-        ip = 'CF-IP: ' + ipaddress
-        params = queue + ip
-        payload = {'content': params}
-        try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
-            return self.clean_response(r.text)
-        except Exception as e:
-            print('> Error in reopen_ticket() :',e)
-            return ''
+        return self.update_ticket(sticketid,{'Owner': self.__auth['user'],'Queue': 'Incidents','CF-IP': ipaddress})
 
     def reply_ticket(self,sticketid,bodytext,cc='',bcc=''):
         """Create a reply and send to requesters via RTIR"""
@@ -605,72 +916,3360 @@ class RTIR4REST():
         params = t_id + action + text + ecc + ebcc
         payload = {'content': params}
         try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
+            r = self.__request(surl, data=payload, write=True)
+            self.__invalidate(sticketid)
             return r.text.strip()
         except Exception as e:
-            print('> Error in reply_ticket() :',e)
-            return ''
+            return self.__error('reply_ticket',e,'')
 
     def reopen_ticket(self,sticketid):
-        """Update ticket status to open"""
+        """Take and set the ticket status to open in one edit"""
         if not self.__loggedin: return ''
-        self.take_or_steal_ticket(sticketid)
-        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/edit'
-        params = 'Status: open'
-        payload = {'content': params}
-        try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
-            return self.clean_response(r.text)
-        except Exception as e:
-            print('> Error in reopen_ticket() :',e)
-            return ''
+        return self.update_ticket(sticketid,Owner=self.__auth['user'],Status='open')
 
     def close_ticket(self,sticketid):
         """Update ticket to Resolved (closed)"""
         if not self.__loggedin: return ''
-        surl = self.__rtir_base_url+'/REST/1.0/ticket/'+sticketid+'/edit'
-        params = 'Status: resolved'
-        payload = {'content': params}
-        try:
-            r = self.__session.post(surl, data=payload, verify=False, proxies=self.__proxy)
-            return self.clean_response(r.text)
-        except Exception as e:
-            print('> Error in close_ticket() :',e)
-            return ''
+        return self.update_ticket(sticketid,Status='resolved')
 
     def take_comment_close_ticket(self,sticketid,comment):
-        """Take/Steal, Comment, and Close the Ticket."""
-        self.take_or_steal_ticket(sticketid)
+        """Comment, then Take and Close the Ticket in one edit (2 requests)."""
         self.comment_ticket(sticketid,comment)
-        return self.close_ticket(sticketid)
+        return self.update_ticket(sticketid,Owner=self.__auth['user'],Status='resolved')
     
     def take_comment_classify_close_ticket(self,sticketid,comment,classification):
-        """Take/Steal, Comment, Classify, and Close the Ticket."""
-        self.take_or_steal_ticket(sticketid)
+        """Comment, then Take, Classify, and Close the Ticket. Owner, Queue, Classification and Status in one edit (2 requests)."""
         self.comment_ticket(sticketid,comment)
-        self.set_ticket_queue(sticketid,'Incidents')
-        self.set_ticket_classification(sticketid,classification)
-        return self.close_ticket(sticketid)
+        edit = TicketEdit().set('Owner',self.__auth['user']).set('Queue','Incidents').set_cf('Classification',classification).set('Status','resolved')
+        return self.update_ticket(sticketid,edit)
     
     def take_reply_comment_classify_close_ticket(self,sticketid,bodytext,comment,classification):
-        """Take/Steal, Comment, Classify, and Close the Ticket."""
-        self.take_or_steal_ticket(sticketid)
+        """Reply, Comment, then Take, Classify, and Close the Ticket. Owner, Queue, Classification and Status in one edit (3 requests)."""
         self.reply_ticket(sticketid,bodytext)
         self.comment_ticket(sticketid,comment)
-        self.set_ticket_queue(sticketid,'Incidents')
-        self.set_ticket_classification(sticketid,classification)
-        return self.close_ticket(sticketid)
+        edit = TicketEdit().set('Owner',self.__auth['user']).set('Queue','Incidents').set_cf('Classification',classification).set('Status','resolved')
+        return self.update_ticket(sticketid,edit)
 
-    def autocreate_ticket(self,email,subject,abusetext,comment,ipaddress,classification):
-        """Create, Reply, Comment, set Incidents as Queue, Classify, Set IP-address, and Close a ticket in one go."""
+    def autocreate_ticket(self,email,subject,abusetext,comment,ipaddress,classification,dedupe=False):
+        """Create, Reply, Comment, set Incidents as Queue, Classify, Set IP-address, and Close a ticket in one go (4 requests).
+        With dedupe=True and self.ip_index set, returns the newest indexed ticket for ipaddress instead of creating one."""
         if not self.__loggedin: return ''
+        if dedupe and self.ip_index is not None:
+            found = self.ip_index.lookup_value(ipaddress)
+            if found: return str(max(found))
         sticketid = self.create_ticket(email,subject,'')
         if len(sticketid):
             self.reply_ticket(sticketid,abusetext)
             self.comment_ticket(sticketid,comment)
-            self.set_ticket_queue(sticketid,'Incidents')
-            self.set_ticket_classification(sticketid,classification)
-            self.set_ticket_ip(sticketid,ipaddress)
-            self.close_ticket(sticketid)
+            edit = TicketEdit().set('Queue','Incidents').set_cf('Classification',classification)
+            edit.set_cf('IP',ipaddress).set('Status','resolved')
+            self.update_ticket(sticketid,edit)
+            if self.ip_index is not None: self.ip_index.created(sticketid,ipaddress,'resolved')
         return sticketid
+
+    def map_tickets(self,fn,ids,*args,workers=None,**kwargs):
+        """Run fn(sticketid,*args,**kwargs) for every ticket id on a thread pool. fn is a callable or a method name ('close_ticket'). Returns a TicketResult per id, in id order."""
+        if isinstance(fn,str): fn = getattr(self,fn)
+        workers = workers or self.__workers
+        self.__size_pool(workers)
+        def run(sticketid):
+            self.__local.failures = []
+            try:
+                value = fn(sticketid,*args,**kwargs)
+            except Exception as e:
+                return TicketResult(sticketid,None,e)
+            finally:
+                failures, self.__local.failures = self.__local.failures, None
+            return TicketResult(sticketid,value,failures[0] if failures else None) # swallowed errors count as failures
+        ids = [str(sticketid) for sticketid in ids]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(run,ids))
+
+    def close_tickets(self,ids,workers=None):
+        """Close (resolve) tickets concurrently. Returns TicketResult list."""
+        return self.map_tickets(self.close_ticket,ids,workers=workers)
+
+    def comment_tickets(self,ids,commenttext,workers=None):
+        """Comment tickets concurrently. Returns TicketResult list."""
+        return self.map_tickets(self.comment_ticket,ids,commenttext,workers=workers)
+
+    def take_comment_close_tickets(self,ids,comment,workers=None):
+        """take_comment_close_ticket() for many tickets concurrently. Returns TicketResult list."""
+        return self.map_tickets(self.take_comment_close_ticket,ids,comment,workers=workers)
 ## End Class
+
+def rt_lines(data):
+    """Lines of a response given as str, bytes or an iterable of str/bytes lines (decoded lazily)"""
+    if isinstance(data,bytes):
+        data = data.decode('utf-8','replace')
+    if isinstance(data,str):
+        return data.splitlines()
+    return (sline.decode('utf-8','replace') if isinstance(sline,bytes) else sline for sline in data)
+
+def parse_rt_status(text):
+    """[version, code, reason] of the 'RT/4.2.9 200 Ok' status line"""
+    if isinstance(text,bytes):
+        text = text[:text.find(b'\n')].decode('utf-8','replace') if b'\n' in text else text.decode('utf-8','replace')
+    sline = text.lstrip().split('\n',1)[0].strip()
+    version, sep, rest = sline.partition(' ')
+    code, sep, reason = rest.partition(' ')
+    return [version,code,reason]
+
+def rt_body(text):
+    """Response text without the status line and the blank line after it"""
+    parts = text.split('\n',2)
+    if len(parts) == 3 and parts[2]:
+        return parts[2].strip()
+    return text.strip()
+
+def rt_content(text):
+    """Content field of an attachment record, with its continuation indentation removed"""
+    lines = rt_lines(text)
+    if not isinstance(lines,list): lines = list(lines)
+    for i, sline in enumerate(lines):
+        if sline.startswith('Content:'): break
+    else:
+        return ''
+    indent = ' '*len('Content: ')
+    content = [lines[i][len('Content:'):].lstrip(' ')]
+    for sline in lines[i+1:]:
+        content.append(sline[len(indent):] if sline.startswith(indent) else sline.lstrip(' '))
+    return '\n'.join(content).rstrip('\n')
+
+def rt_kv_lines(text):
+    """Only the 'key: value' lines of a response, with their indented continuation lines"""
+    kept = []
+    keep = False
+    for sline in rt_lines(text):
+        if sline[:1] in (' ','\t'):
+            if keep and sline.strip(): kept.append(sline.rstrip())
+        else:
+            keep = ': ' in sline and not sline.startswith('#') and not sline.startswith('RT/')
+            if keep: kept.append(sline.rstrip())
+    return '\n'.join(kept).strip()
+
+def parse_rt_ids(text):
+    """Sorted int ids of a format=i search response ('ticket/123' lines)"""
+    id_list = []
+    for sline in rt_lines(text):
+        if sline.startswith('ticket/'):
+            sid = sline[7:].strip()
+            if sid.isdigit(): id_list.append(int(sid))
+    id_list.sort()
+    return id_list
+
+def parse_rt_search(lines):
+    """Generator: (int id, subject) of the '123: Subject' lines of a search response"""
+    for sline in rt_lines(lines):
+        sid, sep, subject = sline.partition(': ')
+        if sep and sid.isdigit():
+            yield int(sid), subject.strip()
+
+def parse_rt_records(lines,raw=False):
+    """
+    Parse RT REST 1.0 'key: value' text into dicts, one per record, in a
+    single pass. Skips the 'RT/x.y.z 200 Ok' status line and '#' comments,
+    joins indented continuation lines with newlines (blank indented lines
+    are kept inside the value) and splits records on '--'. Only the first
+    colon separates key and value. lines may be str, bytes or any iterable
+    of str/bytes lines. raw=True yields (record, record text) tuples.
+    """
+    record = {}
+    rawlines = []
+    key = None
+    parts = None
+    for sline in rt_lines(lines):
+        if not sline:
+            if parts is not None:
+                record[key] = '\n'.join(parts).strip('\n')
+                parts = None
+            key = None
+            continue
+        first = sline[0]
+        if first == ' ' or first == '\t':
+            if key is not None:
+                if parts is None: parts = [record[key]]
+                parts.append(sline.strip())
+                if raw: rawlines.append(sline)
+            elif raw and rawlines:
+                rawlines.append(sline)
+            continue
+        if parts is not None:
+            record[key] = '\n'.join(parts).strip('\n')
+            parts = None
+        if first == '#' or first == 'R' and sline.startswith('RT/'):
+            key = None
+            continue
+        if first == '-' and sline.rstrip() == '--':
+            if record: yield (record,'\n'.join(rawlines)) if raw else record
+            record = {}
+            rawlines = []
+            key = None
+            continue
+        if raw: rawlines.append(sline)
+        key, sep, value = sline.partition(':')
+        if sep:
+            record[key] = value.strip()
+        else:
+            key = None
+    if parts is not None:
+        record[key] = '\n'.join(parts).strip('\n')
+    if record: yield (record,'\n'.join(rawlines)) if raw else record
+
+class Ticket():
+    """
+    Parsed RT ticket record. Standard fields are slots named in snake_case
+    (Ticket.FIELDS maps RT names to slots), custom fields are in .cf keyed
+    by the name inside CF.{...}. ticket.get('Owner') and ticket['CF.{IP}']
+    accept the RT field names.
+    """
+
+    FIELDS = OrderedDict([('Queue','queue'),('Owner','owner'),('Creator','creator'),('Subject','subject'),
+                          ('Status','status'),('Priority','priority'),('InitialPriority','initial_priority'),
+                          ('FinalPriority','final_priority'),('Requestors','requestors'),('Cc','cc'),
+                          ('AdminCc','admin_cc'),('Created','created'),('Starts','starts'),
+                          ('Started','started'),('Due','due'),('Resolved','resolved'),('Told','told'),
+                          ('LastUpdated','last_updated'),('TimeEstimated','time_estimated'),
+                          ('TimeWorked','time_worked'),('TimeLeft','time_left')])
+    __slots__ = ('id','cf','extra','raw') + tuple(FIELDS.values())
+    __lookup = dict([(k.lower(),v) for k,v in FIELDS.items()]+[(v,v) for v in FIELDS.values()])
+
+    def __init__(self,fields,raw=''):
+        self.id = 0
+        self.cf = {}
+        self.extra = None
+        self.raw = raw
+        for slot in self.FIELDS.values():
+            setattr(self,slot,'')
+        for key, value in fields.items():
+            if key == 'id':
+                self.id = int(value.split('/')[-1]) if value.split('/')[-1].isdigit() else 0
+            elif key.startswith('CF.{') and key.endswith('}'):
+                self.cf[key[4:-1]] = value
+            elif key in self.FIELDS:
+                setattr(self,self.FIELDS[key],value)
+            else:
+                if self.extra is None: self.extra = {}
+                self.extra[key] = value
+
+    @classmethod
+    def from_text(cls,text):
+        """Build a Ticket from a 'ticket/<id>/show' response"""
+        for fields in parse_rt_records(text):
+            return cls(fields,text)
+        return cls({},text)
+
+    def get(self,item,default=''):
+        """Field value by RT name ('Owner', 'CF.{IP}', 'CF-IP') or slot name"""
+        if item.lower() == 'id':
+            return str(self.id)
+        if item.startswith('CF.{') and item.endswith('}'):
+            return self.cf.get(item[4:-1],default)
+        if item.startswith('CF-'):
+            return self.cf.get(item[3:],default)
+        slot = self.__lookup.get(item.lower())
+        if slot is not None:
+            return getattr(self,slot)
+        if self.extra is not None:
+            return self.extra.get(item,default)
+        return default
+
+    def __getitem__(self,item):
+        return self.get(item)
+
+    def as_dict(self):
+        """Fields as an ordered dict keyed by RT field names"""
+        d = OrderedDict([('id','ticket/'+str(self.id))])
+        for key, slot in self.FIELDS.items():
+            d[key] = getattr(self,slot)
+        if self.extra: d.update(self.extra)
+        for key, value in self.cf.items():
+            d['CF.{'+key+'}'] = value
+        return d
+
+    def __repr__(self):
+        return '<Ticket #%d %s %r>' % (self.id,self.status,self.subject)
+
+class RTIRError(Exception):
+    """Base class of RTIR4REST errors. .url is the request URL, .status the HTTP or RT status code (or None)."""
+
+    def __init__(self,message,url='',status=None):
+        Exception.__init__(self,message)
+        self.url = url
+        self.status = status
+
+class RTIRTimeout(RTIRError):
+    """Connect or read timeout"""
+
+class RTIRConnectTimeout(RTIRTimeout):
+    """Connect timeout: the request was not sent"""
+
+class RTIRConnectionError(RTIRError):
+    """Connection refused, reset or dropped"""
+
+class RTIRHTTPError(RTIRError):
+    """HTTP status 4xx/5xx from the server or a proxy in front of it"""
+
+class RTIRResponseError(RTIRError):
+    """RT answered with a status line other than '200 Ok' (e.g. 'RT/4.2.9 401 Credentials required')"""
+
+class RetryPolicy():
+    """
+    Timeouts and retries applied to every request.
+
+    connect_timeout, read_timeout: seconds (None waits forever)
+    retries: max retries per request, with exponential backoff
+             (backoff * 2**attempt, capped at backoff_max) and full jitter
+    retry_status: HTTP status codes worth retrying (Retry-After is honoured)
+    retry_writes: also retry edits/comments after read timeouts and 5xx
+                  (they may then be applied twice). Connect timeouts are
+                  always retried since nothing reached the server.
+    retry_creates: retry create_ticket, guarded by a search for a ticket
+                   with the same Requestor and Subject created meanwhile
+    budget, budget_min: retry budget. Every request adds `budget` tokens
+                        (up to budget_min), every retry takes one, so retries
+                        stay below ~budget x requests when RT is failing.
+    """
+
+    def __init__(self,connect_timeout=5,read_timeout=60,retries=3,backoff=0.5,backoff_max=30,
+                 retry_status=(429,502,503,504),retry_writes=False,retry_creates=False,
+                 budget=0.2,budget_min=10):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.retry_status = tuple(retry_status)
+        self.retry_writes = retry_writes
+        self.retry_creates = retry_creates
+        self.budget = budget
+        self.budget_min = budget_min
+        self.__tokens = float(budget_min)
+        self.__lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout,self.read_timeout)
+
+    def deposit(self):
+        """Credit the retry budget for one new request"""
+        with self.__lock:
+            self.__tokens = min(self.__tokens+self.budget,float(self.budget_min))
+
+    def allow_retry(self,attempt):
+        """True if retry number attempt+1 is allowed (and take it from the budget)"""
+        if attempt >= self.retries: return False
+        with self.__lock:
+            if self.__tokens < 1: return False
+            self.__tokens -= 1
+            return True
+
+    def delay(self,attempt):
+        """Seconds to sleep before retry number attempt+1"""
+        return random.uniform(0,min(self.backoff_max,self.backoff*(2**attempt)))
+
+class QueueDirectory():
+    """
+    Cached queue directory: name->id and id->name maps, refreshed after
+    ttl seconds. Discovery probes queue ids in concurrent batches of
+    `workers` and stops after `miss_run` missing ids in a row past the
+    last queue found. Name lookups are case-insensitive.
+
+    rtir.queues.resolve('Incidents')  # -> 3
+    rtir.queues.name(3)               # -> 'Incidents'
+    """
+
+    def __init__(self,rtir,ttl=3600,workers=8,miss_run=8):
+        self.rtir = rtir
+        self.ttl = ttl
+        self.workers = workers
+        self.miss_run = miss_run
+        self.__names = {}
+        self.__ids = {}
+        self.__loaded = None
+        self.__lock = threading.Lock()
+
+    @property
+    def stale(self):
+        """True if never loaded or older than ttl"""
+        return self.__loaded is None or (self.ttl and time.monotonic()-self.__loaded > self.ttl)
+
+    def __store(self,records):
+        names = {}
+        ids = {}
+        for record in records:
+            ids[record['id']] = record['Name']
+            names[record['Name'].lower()] = record['id']
+        with self.__lock:
+            self.__names = names
+            self.__ids = ids
+            self.__loaded = time.monotonic()
+
+    def __probe(self,queueid):
+        """get_queue(); an RT error answer counts as a missing queue, other errors end the refresh"""
+        try:
+            record = self.rtir.get_queue(queueid)
+        except RTIRResponseError:
+            return None
+        error = self.rtir.last_error
+        if isinstance(error,RTIRResponseError): return None
+        if error is not None: raise error
+        return record
+
+    def refresh(self):
+        """Discover all queues now (blocking, concurrent probes)"""
+        records = []
+        start = last = 1
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while start-last <= self.miss_run:
+                batch = list(range(start,start+self.workers))
+                for queueid, record in zip(batch,pool.map(self.__probe,batch)):
+                    if record is not None:
+                        records.append(record)
+                        last = queueid+1
+                start += self.workers
+        self.__store(records)
+
+    async def arefresh(self):
+        """Discover all queues now with an AsyncRTIR4REST client"""
+        import asyncio
+        records = []
+        start = last = 1
+        while start-last <= self.miss_run:
+            batch = list(range(start,start+self.workers))
+            for queueid, record in zip(batch,await asyncio.gather(*[self.rtir.get_queue(n) for n in batch])):
+                if record is not None:
+                    records.append(record)
+                    last = queueid+1
+            start += self.workers
+        self.__store(records)
+
+    def __maps(self,refresh=True):
+        if refresh and self.stale: self.refresh()
+        with self.__lock:
+            return self.__names, self.__ids
+
+    def resolve(self,queue,refresh=True):
+        """Queue id of a name (or numeric id), None if unknown"""
+        names, ids = self.__maps(refresh)
+        if isinstance(queue,int) or str(queue).isdigit():
+            return int(queue) if int(queue) in ids else None
+        return names.get(str(queue).strip().lower())
+
+    def name(self,queueid,refresh=True):
+        """Queue name of an id, None if unknown"""
+        names, ids = self.__maps(refresh)
+        return ids.get(int(queueid))
+
+    def known(self,queue):
+        """True/False if the loaded directory has queue, None if not loaded yet (never calls RT)"""
+        if self.__loaded is None: return None
+        return self.resolve(queue,refresh=False) is not None
+
+    def items(self):
+        """Sorted list of (id, name)"""
+        names, ids = self.__maps()
+        return sorted(ids.items())
+
+    def invalidate(self):
+        """Forget the directory, the next lookup rediscovers it"""
+        with self.__lock:
+            self.__loaded = None
+
+class RequestStats():
+    """
+    Thread-safe per endpoint request statistics. Endpoints are REST paths
+    with ids replaced ('ticket/<id>/show', 'search/ticket', 'ticket/new').
+    Per endpoint: requests, errors, retries, bytes_out, bytes_in, latency
+    sum and a cumulative latency histogram (seconds, Prometheus style).
+
+    Hooks are called after every request as
+    hook(endpoint, latency, status, bytes_out, bytes_in, error).
+    """
+
+    BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0)
+
+    def __init__(self):
+        self.hooks = []
+        self.__endpoints = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(surl):
+        """Endpoint name of a request URL"""
+        if '/REST/1.0/' not in surl: return 'login'
+        parts = surl.split('/REST/1.0/',1)[1].split('?',1)[0].strip('/').split('/')
+        if parts[0] == 'ticket' and len(parts) > 1 and parts[1] != 'new':
+            parts[1] = '<id>'
+            if len(parts) > 3 and parts[2] == 'attachments': parts[3] = '<aid>'
+        elif parts[0] == 'queue' and len(parts) > 1:
+            parts[1] = '<n>'
+        elif parts[0] == 'user' and len(parts) > 1:
+            parts[1] = '<name>'
+        return '/'.join(parts)
+
+    def __entry(self,endpoint):
+        entry = self.__endpoints.get(endpoint)
+        if entry is None:
+            entry = {'requests': 0,'errors': 0,'retries': 0,'bytes_out': 0,'bytes_in': 0,
+                     'latency_sum': 0.0,'latency_max': 0.0,'buckets': [0]*(len(self.BUCKETS)+1)}
+            self.__endpoints[endpoint] = entry
+        return entry
+
+    def record(self,endpoint,latency,status,bytes_out,bytes_in,error=None):
+        """Record one request (one attempt, retries are recorded separately)"""
+        with self.__lock:
+            entry = self.__entry(endpoint)
+            entry['requests'] += 1
+            if error is not None: entry['errors'] += 1
+            entry['bytes_out'] += bytes_out
+            entry['bytes_in'] += bytes_in
+            entry['latency_sum'] += latency
+            entry['latency_max'] = max(entry['latency_max'],latency)
+            for n, bound in enumerate(self.BUCKETS):
+                if latency <= bound: break
+            else:
+                n = len(self.BUCKETS)
+            entry['buckets'][n] += 1
+        for hook in self.hooks:
+            hook(endpoint,latency,status,bytes_out,bytes_in,error)
+
+    def retry(self,endpoint):
+        """Count one retry of a request to endpoint"""
+        with self.__lock:
+            self.__entry(endpoint)['retries'] += 1
+
+    def reset(self):
+        with self.__lock:
+            self.__endpoints.clear()
+
+    def snapshot(self):
+        """Copy of the statistics: {endpoint: {requests, errors, retries, bytes_out, bytes_in, latency_sum, latency_max, latency_avg, histogram}}"""
+        result = {}
+        with self.__lock:
+            for endpoint, entry in self.__endpoints.items():
+                d = dict(entry)
+                del d['buckets']
+                d['latency_avg'] = entry['latency_sum']/entry['requests'] if entry['requests'] else 0.0
+                total, histogram = 0, OrderedDict()
+                for bound, count in zip(self.BUCKETS+(float('inf'),),entry['buckets']):
+                    total += count
+                    histogram[bound] = total
+                d['histogram'] = histogram
+                result[endpoint] = d
+        return result
+
+    def total(self):
+        """Total number of requests over all endpoints"""
+        with self.__lock:
+            return sum(entry['requests'] for entry in self.__endpoints.values())
+
+    def prometheus(self,prefix='rtir4rest'):
+        """Statistics in the Prometheus text exposition format"""
+        lines = []
+        snapshot = self.snapshot()
+        for name, key, kind in (('requests_total','requests','counter'),('errors_total','errors','counter'),
+                                ('retries_total','retries','counter'),('sent_bytes_total','bytes_out','counter'),
+                                ('received_bytes_total','bytes_in','counter')):
+            lines.append('# TYPE '+prefix+'_'+name+' '+kind)
+            for endpoint in sorted(snapshot):
+                lines.append('%s_%s{endpoint="%s"} %d' % (prefix,name,endpoint,snapshot[endpoint][key]))
+        lines.append('# TYPE '+prefix+'_request_seconds histogram')
+        for endpoint in sorted(snapshot):
+            entry = snapshot[endpoint]
+            for bound, count in entry['histogram'].items():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_request_seconds_bucket{endpoint="%s",le="%s"} %d' % (prefix,endpoint,le,count))
+            lines.append('%s_request_seconds_sum{endpoint="%s"} %.6f' % (prefix,endpoint,entry['latency_sum']))
+            lines.append('%s_request_seconds_count{endpoint="%s"} %d' % (prefix,endpoint,entry['requests']))
+        return '\n'.join(lines)+'\n'
+
+class RateLimiter():
+    """
+    Client-side token bucket rate limits per operation class:
+    search, show (tickets, attachments, queues, users), edit (edit,
+    comment, take), create and other (login/logout). Rates are requests
+    per second, None means unlimited. `rate` is the default for classes
+    not given explicitly, `burst` the bucket size (default: one second).
+
+    RTIR4REST(usr,pwd,url,rate_limiter=RateLimiter(rate=20,search=2,create=5))
+    """
+
+    OPERATIONS = ('search','show','edit','create','other')
+
+    def __init__(self,rate=None,search=None,show=None,edit=None,create=None,other=None,burst=None):
+        rates = {'search': search,'show': show,'edit': edit,'create': create,'other': other}
+        self.__buckets = {}
+        for operation in self.OPERATIONS:
+            r = rates[operation] if rates[operation] is not None else rate
+            if r: self.__buckets[operation] = TokenBucket(r,burst)
+
+    @staticmethod
+    def operation(surl):
+        """Operation class of a request URL"""
+        if '/REST/1.0/' not in surl: return 'other'
+        path = surl.split('/REST/1.0/',1)[1].split('?',1)[0]
+        if path.startswith('search/'): return 'search'
+        if path.startswith('ticket/new'): return 'create'
+        if path.endswith('/edit') or path.endswith('/comment') or path.endswith('/take'): return 'edit'
+        if path.startswith('ticket/') or path.startswith('queue/') or path.startswith('user/'): return 'show'
+        return 'other'
+
+    def bucket(self,operation):
+        """TokenBucket of the operation class (None if unlimited)"""
+        return self.__buckets.get(operation)
+
+    def acquire(self,operation):
+        """Block until a request of the operation class may be sent"""
+        bucket = self.__buckets.get(operation)
+        if bucket is not None: bucket.acquire()
+
+    def reserve(self,operation):
+        """Take a token now, return the seconds to wait before sending (for asyncio)"""
+        bucket = self.__buckets.get(operation)
+        return bucket.reserve() if bucket is not None else 0
+
+class TokenBucket():
+    """Thread-safe token bucket: rate tokens per second, up to burst tokens"""
+
+    def __init__(self,rate,burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1,rate))
+        self.__tokens = self.burst
+        self.__stamp = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token (possibly borrowing ahead), return seconds until it is available"""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst,self.__tokens+(now-self.__stamp)*self.rate)
+            self.__stamp = now
+            self.__tokens -= 1
+            return 0 if self.__tokens >= 0 else -self.__tokens/self.rate
+
+    def acquire(self):
+        """Block until one token is available"""
+        wait = self.reserve()
+        if wait > 0: time.sleep(wait)
+
+class AdaptiveLimiter():
+    """
+    Adaptive concurrency limit (AIMD). Every `window` requests the limit
+    grows by one if RT looked healthy, and is cut by `decrease` when the
+    average latency exceeded target_latency or the error rate (5xx, 429,
+    timeouts, connection errors) exceeded error_rate.
+
+    RTIR4REST(usr,pwd,url,workers=32,concurrency_limiter=AdaptiveLimiter(initial=8,maximum=32))
+    """
+
+    def __init__(self,initial=8,minimum=1,maximum=64,target_latency=1.0,error_rate=0.05,window=20,decrease=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.error_rate = error_rate
+        self.window = window
+        self.decrease = decrease
+        self.limit = max(minimum,min(maximum,initial))
+        self.inflight = 0
+        self.__count = 0
+        self.__errors = 0
+        self.__latency = 0.0
+        self.__cond = threading.Condition()
+        self.__waiters = deque() # (loop, future) of coroutines in aacquire()
+
+    def try_acquire(self):
+        """Take a slot if one is free. Returns True or False."""
+        with self.__cond:
+            if self.inflight >= self.limit: return False
+            self.inflight += 1
+            return True
+
+    def acquire(self):
+        """Block until a slot is free"""
+        with self.__cond:
+            while self.inflight >= self.limit:
+                self.__cond.wait()
+            self.inflight += 1
+
+    async def aacquire(self):
+        """acquire() for coroutines: waits for release() to hand over a slot, without blocking or polling the loop"""
+        import asyncio
+        with self.__cond:
+            if self.inflight < self.limit and not self.__waiters:
+                self.inflight += 1
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self.__waiters.append((asyncio.get_running_loop(),waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self.__cond:
+                if waiter.done() and not waiter.cancelled():
+                    self.inflight -= 1 # the slot was handed over already: pass it on
+                    self.__wake()
+                elif (waiter.get_loop(),waiter) in self.__waiters:
+                    self.__waiters.remove((waiter.get_loop(),waiter))
+            raise
+
+    def __wake(self):
+        """Hand free slots to waiting coroutines in FIFO order (called with the lock held)"""
+        while self.__waiters and self.inflight < self.limit:
+            loop, waiter = self.__waiters.popleft()
+            self.inflight += 1
+            loop.call_soon_threadsafe(self.__handover,waiter)
+
+    def __handover(self,waiter):
+        if not waiter.done():
+            waiter.set_result(True)
+            return
+        with self.__cond: # cancelled meanwhile
+            self.inflight -= 1
+            self.__wake()
+
+    def release(self,latency,error=False):
+        """Free a slot and feed back the request latency (seconds) and outcome"""
+        with self.__cond:
+            self.inflight -= 1
+            self.__count += 1
+            self.__latency += latency
+            if error: self.__errors += 1
+            if self.__count >= self.window:
+                if self.__errors > self.error_rate*self.__count or self.__latency/self.__count > self.target_latency:
+                    self.limit = max(self.minimum,int(self.limit*self.decrease))
+                else:
+                    self.limit = min(self.maximum,self.limit+1)
+                self.__count = self.__errors = 0
+                self.__latency = 0.0
+            self.__wake()
+            self.__cond.notify_all()
+
+class BulkIntake():
+    """
+    Bulk incident intake. Runs autocreate_ticket() style incidents from an
+    iterable of specs with `workers` tickets in flight. The iterable is
+    read only as fast as tickets finish (backpressure). Each ticket is
+    created already in its queue with classification and IP set, then
+    replied, commented and resolved: 5 requests, 3 without reply text
+    (one is the search that records the newest matching ticket before
+    the create).
+
+    A spec is a dict (email, subject, abusetext, comment, ip,
+    classification, optional queue, constituency and key) or a tuple in
+    autocreate_ticket() argument order. Every finished stage is appended
+    to the journal (JSON lines) under the spec key. A rerun with the same
+    journal skips finished incidents, continues half done ones and, for a
+    crash during a create, adopts the ticket RT created after the recorded
+    newest match instead of creating a duplicate. Older tickets for the
+    same incident are never adopted.
+
+    intake = BulkIntake(rtir,workers=16,journal='intake.journal')
+    summary = intake.run(specs)  # {'created': .., 'resumed': .., 'skipped': .., 'failed': .., 'rate': ..}
+    """
+
+    STAGES = ('begin','created','replied','commented','done')
+    KEYS = ('email','subject','abusetext','comment','ip','classification')
+
+    def __init__(self,rtir,workers=8,journal=None,queue='Incidents',dedupe=False,report=None,report_interval=10.0):
+        self.rtir = rtir
+        self.workers = workers
+        self.journal = journal
+        self.queue = queue
+        self.dedupe = dedupe
+        self.report = report if report is not None else self.print_report
+        self.report_interval = report_interval
+        self.__state = {}
+        self.__lock = threading.Lock()
+        self.__counts = {'created': 0,'resumed': 0,'skipped': 0,'failed': 0}
+        self.__started = time.monotonic()
+        if journal and os.path.exists(journal):
+            with open(journal) as f:
+                for sline in f:
+                    try:
+                        record = json.loads(sline)
+                    except ValueError:
+                        continue # torn last line after a crash
+                    self.__state[record['key']] = (record['stage'],record.get('id',''),record.get('guard'))
+
+    def spec(self,item):
+        """Normalise a spec (dict or tuple) to a dict with a key"""
+        spec = dict(zip(self.KEYS,item)) if isinstance(item,(tuple,list)) else dict(item)
+        for name in self.KEYS:
+            spec.setdefault(name,'')
+        if not spec.get('key'):
+            digest = hashlib.sha1('\x00'.join([str(spec[name]) for name in ('email','subject','ip','classification')]).encode('utf-8'))
+            spec['key'] = digest.hexdigest()
+        return spec
+
+    def __log(self,key,stage,sticketid='',guard=None):
+        with self.__lock:
+            self.__state[key] = (stage,sticketid,guard)
+            if self.journal:
+                record = {'key': key,'stage': stage,'id': sticketid}
+                if guard is not None: record['guard'] = guard
+                with open(self.journal,'a') as f:
+                    f.write(json.dumps(record)+'\n')
+
+    def __check(self,value):
+        """Raise the error of the last call (the client prints and returns '' by default)"""
+        if self.rtir.last_error is not None: raise self.rtir.last_error
+        return value
+
+    def __matches(self,spec):
+        """Sorted ids of the tickets with the Requestor, Subject and IP of spec"""
+        query = "Requestor = '%s' AND Subject = '%s' AND 'CF.{IP}' = '%s'" % tuple([spec[name].strip().replace("'","\\'")
+                                                                                  for name in ('email','subject','ip')])
+        return self.__check(self.rtir.search_ticket_ids(query))
+
+    def __adopt(self,spec,guard):
+        """Ticket a crashed run created for spec (the first match newer than guard), '' if none"""
+        if guard is None: return '' # no recorded high-water id: only a new ticket is safe
+        found = [ticketid for ticketid in self.__matches(spec) if ticketid > guard]
+        return str(found[0]) if found else ''
+
+    def process(self,spec):
+        """Run the remaining stages of one spec. Returns (outcome, ticket id)."""
+        rtir = self.rtir
+        key = spec['key']
+        stage, sticketid, guard = self.__state.get(key,('','',None))
+        if stage == 'done': return 'skipped', sticketid
+        outcome = 'resumed' if stage else 'created'
+        if stage == 'begin':
+            sticketid = self.__adopt(spec,guard)
+            if sticketid: self.__log(key,'created',sticketid)
+        if not sticketid:
+            if self.dedupe and rtir.ip_index is not None:
+                found = rtir.ip_index.lookup_value(spec['ip'])
+                if found:
+                    self.__log(key,'done',str(max(found)))
+                    return 'skipped', str(max(found))
+            self.__log(key,'begin',guard=max(self.__matches(spec) or [0]))
+            fields = TicketEdit().set_cf('Classification',spec['classification']).set_cf('IP',spec['ip'])
+            if not spec['abusetext']: fields.set('Status','resolved')
+            sticketid = self.__check(rtir.create_ticket(spec['email'],spec['subject'],'',spec.get('constituency',''),
+                                                        queue=spec.get('queue') or self.queue,fields=fields))
+            self.__log(key,'created',sticketid)
+            if rtir.ip_index is not None: rtir.ip_index.created(sticketid,spec['ip'],'resolved')
+            stage = 'created'
+        if stage in ('begin','created') and spec['abusetext']:
+            self.__check(rtir.reply_ticket(sticketid,spec['abusetext']))
+            self.__log(key,'replied',sticketid)
+        if stage != 'commented' and spec['comment']:
+            self.__check(rtir.comment_ticket(sticketid,spec['comment']))
+            self.__log(key,'commented',sticketid)
+        if spec['abusetext']:
+            self.__check(rtir.update_ticket(sticketid,Status='resolved'))
+        self.__log(key,'done',sticketid)
+        return outcome, sticketid
+
+    def __count(self,outcome):
+        with self.__lock:
+            self.__counts[outcome] = self.__counts.get(outcome,0)+1
+
+    def summary(self):
+        """Counts so far, with seconds and rate (incidents per second)"""
+        with self.__lock:
+            summary = dict(self.__counts)
+        summary['seconds'] = time.monotonic()-self.__started
+        done = sum([summary.get(outcome,0) for outcome in ('created','resumed')])
+        summary['rate'] = done/summary['seconds'] if summary['seconds'] else 0.0
+        return summary
+
+    def print_report(self,summary):
+        print('> intake: %d created, %d resumed, %d skipped, %d failed, %.1f/s' % (summary.get('created',0),
+              summary.get('resumed',0),summary.get('skipped',0),summary.get('failed',0),summary['rate']))
+
+    def run(self,specs,on_result=None):
+        """Process all specs. on_result(TicketResult) is called per spec (id = spec key, value = ticket id). Returns summary()."""
+        self.__counts = {'created': 0,'resumed': 0,'skipped': 0,'failed': 0}
+        self.__started = time.monotonic()
+        slots = threading.BoundedSemaphore(self.workers*2)
+        def work(spec):
+            try:
+                outcome, sticketid = self.process(spec)
+                result = TicketResult(spec['key'],sticketid)
+            except Exception as e:
+                outcome, result = 'failed', TicketResult(spec['key'],None,e)
+            finally:
+                slots.release()
+            self.__count(outcome)
+            if on_result is not None: on_result(result)
+        last = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for item in specs:
+                slots.acquire()
+                pool.submit(work,self.spec(item))
+                if self.report and time.monotonic()-last >= self.report_interval:
+                    self.report(self.summary())
+                    last = time.monotonic()
+        summary = self.summary()
+        if self.report: self.report(summary)
+        return summary
+
+class BulkRunner():
+    """
+    Multi-process bulk ticket changes (python -m rtir4rest bulk). Jobs are
+    dicts with the ticket id, an action and its arguments: comment, reply,
+    classification, ip, and for 'update' any other key as a ticket field
+    (Status, Owner, CF.{Customer}). Actions are take, close, reopen,
+    comment, reply, classify, set_ip and update, joined with '+'
+    ('take+comment+classify+close'); the RTIR4REST method names
+    (take_comment_classify_close_ticket) work as well.
+
+    Jobs are sharded by ticket id over `processes` processes, each with its
+    own logged-in RTIR4REST session and `threads` tickets in flight. All jobs
+    of a ticket run in one shard, in order: comments and replies first, then
+    all field changes (a take as 'Owner: <user>') in one /edit POST, so
+    take+comment+classify+close costs 2 requests instead of 5. rate caps
+    the requests per second of all processes together (an equal share per
+    process). Finished tickets are appended to the journal (<journal>.<shard>,
+    JSON lines), and a rerun skips them. Each shard reports its throughput
+    and errors.
+
+    runner = BulkRunner(url,user,password,processes=8,threads=8,rate=200,journal='cleanup.journal')
+    summary = runner.run(BulkRunner.read_jobs('cleanup.csv',action='take+comment+close'))
+    """
+
+    ACTIONS = ('take','close','reopen','comment','reply','classify','set_ip','update')
+    ALIASES = {'take_or_steal_ticket': 'take','close_ticket': 'close','reopen_ticket': 'take+reopen',
+               'comment_ticket': 'comment','reply_ticket': 'reply','set_ticket_classification': 'classify',
+               'set_ticket_ip': 'set_ip','update_ticket': 'update','take_comment_close_ticket': 'take+comment+close',
+               'take_comment_classify_close_ticket': 'take+comment+classify+close',
+               'take_reply_comment_classify_close_ticket': 'take+reply+comment+classify+close'}
+    ARGUMENTS = ('id','action','comment','reply','classification','ip')
+    FAILED = re.compile(r'^# (?:Ticket \d+ does not exist|Could not|You are not allowed|Permission Denied).*$',re.M)
+
+    def __init__(self,rtir_full_url,rtir_user,rtir_password,processes=4,threads=8,rate=None,journal=None,
+                 report=None,report_interval=10.0,**options):
+        self.url = rtir_full_url
+        self.user = rtir_user
+        self.password = rtir_password
+        self.processes = processes
+        self.threads = threads
+        self.rate = rate
+        self.journal = journal
+        self.report = report if report is not None else self.print_report
+        self.report_interval = report_interval
+        self.options = options
+
+    @staticmethod
+    def read_jobs(path,action=None,format=None):
+        """Generator: jobs (dicts) from a CSV file with a header line or a JSON lines file ('-' reads stdin). action is the default for jobs without one."""
+        import csv
+        import sys
+        format = format or ('jsonl' if path.endswith(('.jsonl','.json','.ndjson')) else 'csv')
+        f = sys.stdin if path == '-' else open(path,newline='')
+        try:
+            rows = csv.DictReader(f) if format == 'csv' else (json.loads(sline) for sline in f if sline.strip())
+            for row in rows:
+                job = dict((str(k).strip(),v) for k, v in row.items() if k is not None and v not in (None,''))
+                if action and not job.get('action'): job['action'] = action
+                yield job
+        finally:
+            if f is not sys.stdin: f.close()
+
+    @classmethod
+    def actions(cls,action):
+        """List of the basic actions of an action string"""
+        actions = []
+        for name in str(action or '').replace(' ','').split('+'):
+            for name in cls.ALIASES.get(name,name).split('+'):
+                if name not in cls.ACTIONS: raise ValueError('unknown bulk action: %r' % name)
+                if name not in actions: actions.append(name)
+        if not actions: raise ValueError('bulk job without action')
+        return actions
+
+    @classmethod
+    def plan(cls,jobs):
+        """Merge the jobs of one ticket: (messages [(action, text)], TicketEdit, take)"""
+        messages, edit, take = [], TicketEdit(), False
+        for job in jobs:
+            for action in cls.actions(job.get('action')):
+                if action == 'take': take = True
+                elif action == 'close': edit.set('Status','resolved')
+                elif action == 'reopen': edit.set('Status','open')
+                elif action == 'comment': messages.append(('comment',job.get('comment','')))
+                elif action == 'reply': messages.append(('correspond',job.get('reply','')))
+                elif action == 'classify':
+                    take = True
+                    edit.set('Queue','Incidents').set_cf('Classification',job.get('classification',''))
+                elif action == 'set_ip':
+                    take = True
+                    edit.set('Queue','Incidents').set_cf('IP',job.get('ip',''))
+                else:
+                    edit.update(dict((k,v) for k, v in job.items() if k not in cls.ARGUMENTS))
+        return messages, edit, take
+
+    def done_ids(self):
+        """Ticket ids the journal records as finished"""
+        import glob
+        done = set()
+        if not self.journal: return done
+        for path in [self.journal]+glob.glob(glob.escape(self.journal)+'.*'):
+            if not os.path.isfile(path): continue
+            with open(path) as f:
+                for sline in f:
+                    try:
+                        record = json.loads(sline)
+                    except ValueError:
+                        continue # torn last line after a crash
+                    if record.get('ok'): done.add(str(record['id']))
+        return done
+
+    def shards(self,jobs):
+        """Group jobs per ticket (validating their actions), drop journaled tickets and split by ticket id. Returns (shards, skipped)."""
+        tickets = OrderedDict()
+        for job in jobs:
+            sticketid = str(job.get('id','')).strip().replace('ticket/','')
+            if not sticketid.isdigit(): raise ValueError('bulk job without a numeric ticket id: %r' % job)
+            self.actions(job.get('action'))
+            tickets.setdefault(sticketid,[]).append(job)
+        done = self.done_ids()
+        shards = [OrderedDict() for n in range(self.processes)]
+        skipped = 0
+        for sticketid, ticket_jobs in tickets.items():
+            if sticketid in done:
+                skipped += 1
+                continue
+            shards[int(sticketid) % self.processes][sticketid] = ticket_jobs
+        return shards, skipped
+
+    @staticmethod
+    def run_shard(shard,tickets,url,user,password,threads,rate,journal,options,progress,interval):
+        """Process entry point: one session, threads tickets in flight, progress messages on the progress queue"""
+        counts = {'shard': shard,'tickets': len(tickets),'done': 0,'failed': 0,'requests': 0,'errors': {}}
+        started = time.monotonic()
+        lock = threading.Lock()
+        options = dict(options)
+        if rate: options['rate_limiter'] = RateLimiter(rate=rate)
+        options.setdefault('raise_errors',True)
+        rtir = RTIR4REST(user,password,url,workers=threads,**options)
+        log = open(journal+'.'+str(shard),'a') if journal else None
+        def send(kind):
+            counts['seconds'] = time.monotonic()-started
+            counts['requests'] = rtir.request_stats.total()
+            progress.put((kind,dict(counts,errors=dict(counts['errors']))))
+        def check(value):
+            if rtir.last_error is not None: raise rtir.last_error
+            failed = BulkRunner.FAILED.search(value)
+            if failed: raise RTIRError(failed.group(0)[2:])
+            return value
+        def apply(sticketid):
+            try:
+                messages, edit, take = BulkRunner.plan(tickets[sticketid])
+                for action, text in messages:
+                    if action == 'comment': check(rtir.comment_ticket(sticketid,text))
+                    else: check(rtir.reply_ticket(sticketid,text))
+                if take: edit.set('Owner',rtir.user)
+                if len(edit): check(rtir.update_ticket(sticketid,edit))
+                record, outcome = {'id': sticketid,'ok': True}, None
+            except Exception as e:
+                record, outcome = {'id': sticketid,'ok': False,'error': str(e)}, type(e).__name__+': '+str(e).split('\n')[0][:80]
+            with lock:
+                if outcome is None:
+                    counts['done'] += 1
+                else:
+                    counts['failed'] += 1
+                    counts['errors'][outcome] = counts['errors'].get(outcome,0)+1
+                if log is not None:
+                    log.write(json.dumps(record)+'\n')
+                    log.flush()
+        try:
+            if not rtir.login():
+                raise RTIRError('login failed for '+user)
+            ids = list(tickets)
+            last = time.monotonic()
+            for start in range(0,len(ids),threads*8):
+                rtir.map_tickets(apply,ids[start:start+threads*8],workers=threads)
+                if start+threads*8 < len(ids) and time.monotonic()-last >= interval:
+                    send('progress')
+                    last = time.monotonic()
+            rtir.logout()
+        except Exception as e:
+            outcome = type(e).__name__+': '+str(e).split('\n')[0][:80]
+            counts['errors'][outcome] = counts['errors'].get(outcome,0)+1
+            counts['failed'] = len(tickets)-counts['done']
+        finally:
+            if log is not None: log.close()
+            send('done')
+
+    def print_report(self,shard):
+        errors = ', '.join(['%s x%d' % (error,count) for error, count in sorted(shard['errors'].items())])
+        print('> shard %d: %d/%d done, %d failed, %d requests, %.1f tickets/s%s' % (shard['shard'],shard['done'],
+              shard['tickets'],shard['failed'],shard['requests'],shard['rate'],' ('+errors+')' if errors else ''))
+
+    def run(self,jobs):
+        """Run all jobs. Returns {'tickets','done','failed','skipped','requests','seconds','rate','shards': [per shard counts]}"""
+        import multiprocessing
+        import queue
+        shards, skipped = self.shards(jobs)
+        started = time.monotonic()
+        progress = multiprocessing.Queue()
+        rate = self.rate/float(self.processes) if self.rate else None
+        workers = {}
+        for shard, tickets in enumerate(shards):
+            if not tickets: continue
+            workers[shard] = multiprocessing.Process(target=BulkRunner.run_shard,name='rtir4rest-bulk-'+str(shard),
+                                                     args=(shard,tickets,self.url,self.user,self.password,self.threads,
+                                                           rate,self.journal,self.options,progress,self.report_interval))
+            workers[shard].start()
+        results = {}
+        while len(results) < len(workers):
+            try:
+                kind, counts = progress.get(timeout=1.0)
+            except queue.Empty:
+                for shard, process in workers.items():
+                    if shard not in results and not process.is_alive() and progress.empty():
+                        results[shard] = {'shard': shard,'tickets': len(shards[shard]),'done': 0,'requests': 0,
+                                          'failed': len(shards[shard]),'seconds': time.monotonic()-started,
+                                          'errors': {'exit code '+str(process.exitcode): 1}}
+                        if self.report: self.report(dict(results[shard],rate=0.0))
+                continue
+            counts['rate'] = counts['done']/counts['seconds'] if counts['seconds'] else 0.0
+            if kind == 'done': results[counts['shard']] = counts
+            if self.report: self.report(counts)
+        for process in workers.values():
+            process.join()
+        summary = {'tickets': sum([len(tickets) for tickets in shards])+skipped,'skipped': skipped,
+                   'shards': [results[shard] for shard in sorted(results)]}
+        for key in ('done','failed','requests'):
+            summary[key] = sum([shard[key] for shard in summary['shards']])
+        summary['seconds'] = time.monotonic()-started
+        summary['rate'] = summary['done']/summary['seconds'] if summary['seconds'] else 0.0
+        return summary
+
+class SessionPool():
+    """
+    Logged-in sessions for several service accounts. Each call goes to the
+    session with the fewest calls in flight (round robin on ties), which
+    spreads load and per-user rate limits over the accounts. Sessions log
+    in again on their own when RT expires them. accounts are (user,
+    password) or (user, password, dict of client options) tuples; kwargs
+    are options for every client (RTIR4REST, or client=AsyncRTIR4REST with
+    alogin()/alogout() and awaited calls).
+
+    pool = SessionPool([('svc1','pw1'),('svc2','pw2',{'rate_limiter': RateLimiter(rate=10)})],url,workers=8)
+    pool.login()
+    pool.get_ticket_owner('123')    # any client method
+    pool.close_tickets(ids)         # ids split over all sessions
+    """
+
+    def __init__(self,accounts,rtir_full_url,client=None,**kwargs):
+        client = client or RTIR4REST
+        self.sessions = []
+        for account in accounts:
+            options = dict(kwargs)
+            if len(account) > 2: options.update(account[2])
+            self.sessions.append(client(account[0],account[1],rtir_full_url,**options))
+        self.users = [account[0] for account in accounts]
+        self.__healthy = [True]*len(self.sessions)
+        self.__inflight = [0]*len(self.sessions)
+        self.__calls = [0]*len(self.sessions)
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def login(self):
+        """Log in all sessions concurrently. Returns the number of logged-in sessions."""
+        with ThreadPoolExecutor(max_workers=len(self.sessions)) as pool:
+            self.__healthy = list(pool.map(lambda session: bool(session.login()),self.sessions))
+        return sum(self.__healthy)
+
+    def logout(self):
+        """Log out all sessions"""
+        for session in self.sessions:
+            session.logout()
+
+    async def alogin(self):
+        """Log in all AsyncRTIR4REST sessions concurrently. Returns the number of logged-in sessions."""
+        import asyncio
+        self.__healthy = [bool(ok) for ok in await asyncio.gather(*[session.login() for session in self.sessions])]
+        return sum(self.__healthy)
+
+    async def alogout(self):
+        """Log out and close all AsyncRTIR4REST sessions"""
+        for session in self.sessions:
+            await session.logout()
+            await session.close()
+
+    def acquire(self):
+        """Index of the least busy healthy session (counted as in flight until release())"""
+        with self.__lock:
+            candidates = [n for n in range(len(self.sessions)) if self.__healthy[n]] or list(range(len(self.sessions)))
+            start = self.__next
+            n = min(candidates,key=lambda n: (self.__inflight[n],(n-start) % len(self.sessions)))
+            self.__next = (n+1) % len(self.sessions)
+            self.__inflight[n] += 1
+            self.__calls[n] += 1
+            return n
+
+    def release(self,n):
+        with self.__lock:
+            self.__inflight[n] -= 1
+
+    def __getattr__(self,name):
+        if name.startswith('_') or not callable(getattr(type(self.sessions[0]),name,None)):
+            raise AttributeError(name)
+        import inspect
+        if inspect.iscoroutinefunction(getattr(type(self.sessions[0]),name)):
+            async def call(*args,**kwargs):
+                n = self.acquire()
+                try:
+                    return await getattr(self.sessions[n],name)(*args,**kwargs)
+                finally:
+                    self.release(n)
+        else:
+            def call(*args,**kwargs):
+                n = self.acquire()
+                try:
+                    return getattr(self.sessions[n],name)(*args,**kwargs)
+                finally:
+                    self.release(n)
+        return call
+
+    def map_tickets(self,fn,ids,*args,**kwargs):
+        """RTIR4REST.map_tickets() with the ids split over all healthy sessions. fn is a method name. Returns TicketResult list in id order."""
+        ids = [str(sticketid) for sticketid in ids]
+        healthy = [n for n in range(len(self.sessions)) if self.__healthy[n]] or [0]
+        shards = [ids[k::len(healthy)] for k in range(len(healthy))]
+        def run(k):
+            n = healthy[k]
+            with self.__lock:
+                self.__inflight[n] += 1
+                self.__calls[n] += len(shards[k])
+            try:
+                return self.sessions[n].map_tickets(fn,shards[k],*args,**kwargs)
+            finally:
+                self.release(n)
+        with ThreadPoolExecutor(max_workers=len(healthy)) as pool:
+            shard_results = list(pool.map(run,range(len(healthy))))
+        results = [None]*len(ids)
+        for k, shard in enumerate(shard_results):
+            results[k::len(healthy)] = shard
+        return results
+
+    def close_tickets(self,ids,workers=None):
+        """Close (resolve) tickets concurrently on all sessions. Returns TicketResult list."""
+        return self.map_tickets('close_ticket',ids,workers=workers)
+
+    def comment_tickets(self,ids,commenttext,workers=None):
+        """Comment tickets concurrently on all sessions. Returns TicketResult list."""
+        return self.map_tickets('comment_ticket',ids,commenttext,workers=workers)
+
+    def take_comment_close_tickets(self,ids,comment,workers=None):
+        """take_comment_close_ticket() concurrently on all sessions. Returns TicketResult list."""
+        return self.map_tickets('take_comment_close_ticket',ids,comment,workers=workers)
+
+    def stats(self):
+        """Per account: calls, in flight, relogins and healthy"""
+        with self.__lock:
+            return dict([(self.users[n],{'calls': self.__calls[n],'inflight': self.__inflight[n],
+                                         'relogins': self.sessions[n].relogins,'healthy': self.__healthy[n]})
+                         for n in range(len(self.sessions))])
+
+class WriteBehind():
+    """
+    Write-behind queue for ticket changes. Field updates are merged per
+    ticket (the last value of a field wins), comments and replies are kept
+    in order. A background worker flushes when max_pending actions are
+    queued or the oldest one is max_delay seconds old. Per ticket a flush
+    sends the comments/replies first and then all field changes in one
+    /edit POST. A take is folded into that edit as 'Owner: <user>', so no
+    owner lookup and no take request are needed. Every action returns a
+    concurrent.futures.Future. flush() waits until everything queued so far
+    is written, and close() flushes and stops the worker. Reads do not see
+    queued changes before they are flushed.
+
+    with WriteBehind(rtir,max_pending=200,max_delay=2.0) as wb:
+        wb.comment_ticket('123','Spam run')
+        wb.set_ticket_classification('123','Spam')
+        f = wb.close_ticket('123')   # 2 requests for the three calls
+    f.result()
+    """
+
+    def __init__(self,rtir,max_pending=100,max_delay=1.0,workers=None):
+        self.rtir = rtir
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.workers = workers
+        self.flushes = 0
+        self.requests = 0
+        self.merged = 0
+        self.__pending = OrderedDict() # sticketid -> [TicketEdit, [(action, text, future)], [edit futures], take]
+        self.__count = 0
+        self.__oldest = None
+        self.__closed = False
+        self.__lock = threading.Condition()
+        self.__flush_lock = threading.Lock()
+        self.__worker = threading.Thread(target=self.__run,name='rtir4rest-writebehind',daemon=True)
+        self.__worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def __queue(self,sticketid,fields=None,message=None,take=False):
+        future = Future()
+        with self.__lock:
+            if self.__closed: raise RTIRError('WriteBehind is closed')
+            sticketid = str(sticketid)
+            entry = self.__pending.get(sticketid)
+            if entry is None:
+                entry = self.__pending[sticketid] = [TicketEdit(),[],[],False]
+            if fields:
+                self.merged += len([field for field in TicketEdit(fields).fields if field in entry[0].fields])
+                entry[0].update(fields)
+            if message is not None:
+                entry[1].append(message+(future,))
+            else:
+                entry[2].append(future)
+            entry[3] = entry[3] or take
+            self.__count += 1
+            if self.__oldest is None: self.__oldest = time.monotonic()
+            self.__lock.notify_all()
+        return future
+
+    def update_ticket(self,sticketid,edit=None,take=False,**fields):
+        """Queue field changes (TicketEdit, dict or keywords as in RTIR4REST.update_ticket)"""
+        return self.__queue(sticketid,TicketEdit(edit).update(fields),take=take)
+
+    def comment_ticket(self,sticketid,commenttext):
+        """Queue an internal comment"""
+        return self.__queue(sticketid,message=('comment',commenttext))
+
+    def reply_ticket(self,sticketid,bodytext):
+        """Queue a reply to the requestors"""
+        return self.__queue(sticketid,message=('correspond',bodytext))
+
+    def take_or_steal_ticket(self,sticketid):
+        """Queue taking the ticket (Owner: logged in user)"""
+        return self.__queue(sticketid,take=True)
+
+    def set_ticket_classification(self,sticketid,classification):
+        """Queue take, Queue: Incidents and classification"""
+        return self.__queue(sticketid,{'Queue': 'Incidents','CF-Classification': classification},take=True)
+
+    def set_ticket_ip(self,sticketid,ipaddress):
+        """Queue take, Queue: Incidents and IP-address"""
+        return self.__queue(sticketid,{'Queue': 'Incidents','CF-IP': ipaddress},take=True)
+
+    def close_ticket(self,sticketid):
+        """Queue Status: resolved"""
+        return self.__queue(sticketid,{'Status': 'resolved'})
+
+    def __check(self,value):
+        """Raise the error of the last call (the client prints and returns '' by default)"""
+        if self.rtir.last_error is not None: raise self.rtir.last_error
+        return value
+
+    def __write(self,sticketid,entry):
+        """Write one ticket's merged batch, resolving its futures"""
+        edit, messages, futures, take = entry
+        try:
+            if not self.rtir.user: raise RTIRError('not logged in')
+            for action, text, future in messages:
+                if action == 'comment':
+                    result = self.__check(self.rtir.comment_ticket(sticketid,text))
+                else:
+                    result = self.__check(self.rtir.reply_ticket(sticketid,text))
+                future.set_result(result)
+            if take: edit.set('Owner',self.rtir.user)
+            result = self.__check(self.rtir.update_ticket(sticketid,edit)) if len(edit) else ''
+            for future in futures:
+                future.set_result(result)
+        except Exception as e:
+            for future in [message[2] for message in messages]+futures:
+                if not future.done(): future.set_exception(e)
+        return len(messages)+(1 if len(edit) else 0)
+
+    def flush(self):
+        """Write everything queued so far and wait for it. Returns the number of requests sent."""
+        with self.__flush_lock:
+            with self.__lock:
+                batch = self.__pending
+                self.__pending = OrderedDict()
+                self.__count = 0
+                self.__oldest = None
+            if not batch: return 0
+            results = self.rtir.map_tickets(lambda sticketid: self.__write(sticketid,batch[sticketid]),
+                                            list(batch),workers=self.workers)
+            sent = sum([result.value for result in results if result.ok])
+            with self.__lock:
+                self.flushes += 1
+                self.requests += sent
+            return sent
+
+    def __run(self):
+        while True:
+            with self.__lock:
+                while not self.__closed:
+                    if self.__count >= self.max_pending: break
+                    if self.__oldest is not None:
+                        wait = self.__oldest+self.max_delay-time.monotonic()
+                        if wait <= 0: break
+                        self.__lock.wait(wait)
+                    else:
+                        self.__lock.wait()
+                if self.__closed and not self.__pending: return
+            self.flush()
+
+    def close(self):
+        """Flush everything and stop the worker"""
+        with self.__lock:
+            self.__closed = True
+            self.__lock.notify_all()
+        self.__worker.join()
+        self.flush()
+
+    def stats(self):
+        """queued (pending actions), flushes, requests sent and merged (overwritten field values)"""
+        with self.__lock:
+            return {'queued': self.__count,'flushes': self.flushes,'requests': self.requests,'merged': self.merged}
+
+class SingleFlight():
+    """
+    Coalesces identical concurrent calls: while a call for a key is in
+    flight, later callers with the same key wait for its result (or
+    exception) instead of running their own. do() is for threads, ado()
+    for coroutines. Counters: leaders (calls run), coalesced (calls that
+    waited) and coalesced per endpoint.
+    """
+
+    class Call():
+        __slots__ = ('event','result','error')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.__calls = {}
+        self.__tasks = {}
+        self.__lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.endpoints = {}
+
+    def __count(self,leader,endpoint):
+        if leader:
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            self.endpoints[endpoint] = self.endpoints.get(endpoint,0)+1
+
+    def do(self,key,fn,endpoint=''):
+        """Return fn(), shared with the callers of the same key already in flight"""
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader: call = self.__calls[key] = self.Call()
+            self.__count(leader,endpoint)
+        if not leader:
+            call.event.wait()
+            if call.error is not None: raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.event.set()
+
+    async def ado(self,key,fn,endpoint=''):
+        """Return await fn(), shared with the coroutines of the same key already in flight"""
+        import asyncio
+        with self.__lock:
+            future = self.__tasks.get(key)
+            leader = future is None
+            if leader: future = self.__tasks[key] = asyncio.get_running_loop().create_future()
+            self.__count(leader,endpoint)
+        if not leader:
+            return await asyncio.shield(future)
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # retrieved: no 'never retrieved' warning without waiters
+            raise
+        finally:
+            with self.__lock:
+                del self.__tasks[key]
+
+    def stats(self):
+        """leaders, coalesced and coalesced per endpoint"""
+        with self.__lock:
+            return {'leaders': self.leaders,'coalesced': self.coalesced,'endpoints': dict(self.endpoints)}
+
+    def reset(self):
+        """Zero the counters"""
+        with self.__lock:
+            self.leaders = 0
+            self.coalesced = 0
+            self.endpoints = {}
+
+class PoolDiscards():
+    """Counts urllib3 'Connection pool is full, discarding connection' events per host (RTIR4REST.pool_stats())"""
+
+    __counts = {}
+    __lock = threading.Lock()
+    __installed = False
+
+    class Handler(logging.Handler):
+        def emit(self,record):
+            if record.getMessage().startswith('Connection pool is full') and record.args:
+                PoolDiscards.add(str(record.args[0]))
+
+    @classmethod
+    def install(cls):
+        """Attach the counting handler to the urllib3 pool logger (once)"""
+        with cls.__lock:
+            if cls.__installed: return
+            logging.getLogger('urllib3.connectionpool').addHandler(cls.Handler(logging.WARNING))
+            cls.__installed = True
+
+    @classmethod
+    def add(cls,host):
+        with cls.__lock:
+            cls.__counts[host] = cls.__counts.get(host,0)+1
+
+    @classmethod
+    def count(cls,host):
+        with cls.__lock:
+            return cls.__counts.get(host,0)
+
+class Transport(abc.ABC):
+    """
+    HTTP layer of RTIR4REST (RTIR4REST(...,transport='requests'|'urllib3'|Transport instance)).
+    setup() receives the client options; request() returns a response with
+    status_code, reason, headers, content, text, cookies, request (.url, .body),
+    iter_lines(), iter_content() and close() (a requests.Response fits) and
+    raises RTIRConnectTimeout, RTIRTimeout or RTIRConnectionError.
+    RequestsTransport is the default, Urllib3Transport skips the requests
+    layer, MemoryTransport(handler) calls a handler in-process (FakeRT.handle).
+    """
+
+    name = ''
+
+    def setup(self,user,password,headers,proxies=None,verify=False,ssl_context=None,pool_connections=10,pool_block=False):
+        """Client options: credentials (HTTP basic auth), default headers, proxies dict, TLS and pool settings"""
+        self.headers = dict(headers)
+        self.proxies = proxies or {}
+        self.verify = verify
+        self.ssl_context = ssl_context
+        self.pool_connections = pool_connections
+        self.pool_block = pool_block
+        self.cookies = {}
+        self.set_auth(user,password)
+
+    def set_auth(self,user,password):
+        """HTTP basic auth credentials (user None: no Authorization header)"""
+        self.auth = None
+        if user:
+            import base64
+            self.auth = 'Basic '+base64.b64encode((user+':'+password).encode('utf-8')).decode('ascii')
+
+    @abc.abstractmethod
+    def request(self,method,url,data=None,params=None,stream=False,timeout=None):
+        """Send one request and return the response"""
+
+    def resize(self,maxsize):
+        """Grow the connection pool to maxsize connections per host"""
+
+    def clear_cookies(self):
+        self.cookies.clear()
+
+    def close(self):
+        """Close all connections (the transport stays usable)"""
+
+    def pool_stats(self):
+        return {}
+
+    def encode(self,url,data,params):
+        """URL with params and the form encoded body (bytes or None)"""
+        from urllib.parse import urlencode
+        if params:
+            url += ('&' if '?' in url else '?')+(params if isinstance(params,str) else urlencode(params,doseq=True))
+        if data is None: return url, None
+        if isinstance(data,dict): data = urlencode(data,doseq=True)
+        return url, data.encode('utf-8') if isinstance(data,str) else data
+
+    def request_headers(self,body):
+        """Default headers plus cookies, Authorization and the form Content-Type"""
+        headers = dict(self.headers)
+        if self.cookies: headers['Cookie'] = '; '.join([name+'='+value for name, value in self.cookies.items()])
+        if self.auth: headers['Authorization'] = self.auth
+        if body is not None: headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return headers
+
+    def store_cookies(self,values):
+        """Keep name=value of Set-Cookie header values"""
+        for value in values:
+            name, sep, value = value.split(';',1)[0].partition('=')
+            if sep: self.cookies[name.strip()] = value.strip()
+
+    @staticmethod
+    def pool_manager_stats(managers):
+        """pool_stats() of urllib3 PoolManagers"""
+        stats = {}
+        for manager in managers:
+            pools = manager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None or pool.pool is None: continue
+                idle = len([conn for conn in list(pool.pool.queue) if conn is not None])
+                stats[pool.scheme+'://'+pool.host+':'+str(pool.port)] = {
+                    'maxsize': pool.pool.maxsize,'connections': pool.num_connections,'idle': idle,
+                    'in_use': pool.pool.maxsize-pool.pool.qsize(),'requests': pool.num_requests,
+                    'discarded': PoolDiscards.count(pool.host)}
+        return stats
+
+class TransportResponse():
+    """Response of Urllib3Transport and MemoryTransport (the parts of requests.Response that RTIR4REST uses)"""
+
+    __slots__ = ('status_code','reason','headers','cookies','request','__content','__raw')
+
+    class Sent():
+        __slots__ = ('url','body')
+
+        def __init__(self,url,body):
+            self.url = url
+            self.body = body
+
+    def __init__(self,status_code,reason,headers,content,url,body,cookies,raw=None):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.cookies = cookies
+        self.request = self.Sent(url,body)
+        self.__content = content
+        self.__raw = raw
+
+    @property
+    def content(self):
+        if self.__content is None:
+            self.__content = b''.join(self.iter_content(65536))
+        return self.__content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8','replace')
+
+    def iter_content(self,chunk_size=1):
+        if self.__raw is None:
+            content = self.__content or b''
+            for start in range(0,len(content),chunk_size):
+                yield content[start:start+chunk_size]
+            return
+        raw, self.__raw = self.__raw, None
+        try:
+            for chunk in raw.stream(chunk_size,decode_content=True):
+                yield chunk
+        finally:
+            raw.release_conn()
+
+    def iter_lines(self,chunk_size=65536):
+        if self.__raw is None:
+            for line in self.content.splitlines():
+                yield line
+            return
+        pending = b''
+        for chunk in self.iter_content(chunk_size):
+            lines = (pending+chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip(b'\r')
+        if pending: yield pending
+
+    def close(self):
+        if self.__raw is not None:
+            self.__raw.release_conn()
+            self.__raw = None
+
+class StreamedResponse():
+    """Streamed response whose first chunk (head, holding the RT status line) was already read; iter_content() and iter_lines() replay it"""
+
+    def __init__(self,response,chunk_size=65536):
+        self.response = response
+        self.__chunks = response.iter_content(chunk_size)
+        self.head = b''
+        for chunk in self.__chunks:
+            self.head += chunk
+            if b'\n' in self.head.lstrip() or len(self.head) >= 256: break
+
+    def __getattr__(self,name):
+        return getattr(self.response,name)
+
+    def iter_content(self,chunk_size=1):
+        head, self.head = self.head, b''
+        if head: yield head
+        for chunk in self.__chunks:
+            yield chunk
+
+    def iter_lines(self,chunk_size=65536):
+        pending = b''
+        for chunk in self.iter_content(chunk_size):
+            lines = (pending+chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip(b'\r')
+        if pending: yield pending
+
+    def close(self):
+        self.response.close()
+
+class RequestsTransport(Transport):
+    """Transport on a requests.Session (the default)"""
+
+    name = 'requests'
+
+    def setup(self,user,password,headers,**kwargs):
+        import requests
+        from requests.packages.urllib3.exceptions import InsecureRequestWarning
+        requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+        PoolDiscards.install()
+        self.__requests = requests
+        self.__session = requests.Session()
+        Transport.setup(self,user,password,headers,**kwargs)
+        self.__session.headers = dict(headers)
+
+    def set_auth(self,user,password):
+        Transport.set_auth(self,user,password)
+        self.__session.auth = (user, password) if user else None
+
+    def resize(self,maxsize):
+        adapter = self.__requests.adapters.HTTPAdapter(pool_connections=self.pool_connections,
+                                                       pool_maxsize=maxsize,pool_block=self.pool_block)
+        if self.ssl_context is not None:
+            adapter.poolmanager.connection_pool_kw['ssl_context'] = self.ssl_context
+        # the old adapter is not closed: other threads may have requests in flight on it; it goes with its last user
+        self.__session.mount('https://',adapter)
+        self.__session.mount('http://',adapter)
+
+    def request(self,method,url,data=None,params=None,stream=False,timeout=None):
+        exceptions = self.__requests.exceptions
+        try:
+            return self.__session.request(method, url, data=data, params=params, stream=stream,
+                                          timeout=timeout, verify=self.verify, proxies=self.proxies)
+        except exceptions.ConnectTimeout as e:
+            raise RTIRConnectTimeout(str(e),url)
+        except exceptions.Timeout as e:
+            raise RTIRTimeout(str(e),url)
+        except exceptions.ConnectionError as e:
+            raise RTIRConnectionError(str(e),url)
+
+    def clear_cookies(self):
+        self.__session.cookies.clear()
+
+    def close(self):
+        self.__session.close()
+
+    def pool_stats(self):
+        return self.pool_manager_stats([adapter.poolmanager for adapter in set(self.__session.adapters.values())])
+
+class Urllib3Transport(Transport):
+    """Transport straight on a urllib3 PoolManager: no requests Session, hooks or cookie jar per call"""
+
+    name = 'urllib3'
+    max_redirects = 5
+
+    def setup(self,user,password,headers,**kwargs):
+        import urllib3
+        self.__urllib3 = urllib3
+        PoolDiscards.install()
+        Transport.setup(self,user,password,headers,**kwargs)
+        if not self.verify: urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        self.__managers = {}
+        self.__maxsize = 1
+
+    def resize(self,maxsize):
+        urllib3 = self.__urllib3
+        options = {'num_pools': self.pool_connections,'maxsize': maxsize,'block': self.pool_block,
+                   'cert_reqs': 'CERT_REQUIRED' if self.verify else 'CERT_NONE'}
+        if isinstance(self.verify,str): options['ca_certs'] = self.verify
+        if self.ssl_context is not None: options['ssl_context'] = self.ssl_context
+        managers = {}
+        direct = urllib3.PoolManager(**options)
+        for scheme in ('http','https'):
+            proxy = self.proxies.get(scheme)
+            managers[scheme] = urllib3.ProxyManager(proxy,**options) if proxy else direct
+        self.__managers = managers # in-flight requests keep the old managers until they finish
+        self.__maxsize = maxsize
+
+    def request(self,method,url,data=None,params=None,stream=False,timeout=None):
+        urllib3 = self.__urllib3
+        errors = urllib3.exceptions
+        if not self.__managers: self.resize(self.__maxsize)
+        if isinstance(timeout,tuple): timeout = urllib3.Timeout(connect=timeout[0],read=timeout[1])
+        elif timeout is not None: timeout = urllib3.Timeout(timeout)
+        url, body = self.encode(url,data,params)
+        for hop in range(self.max_redirects+1):
+            manager = self.__managers['https' if url.startswith('https:') else 'http']
+            try:
+                raw = manager.urlopen(method,url,body=body,headers=self.request_headers(body),timeout=timeout,
+                                      retries=False,redirect=False,preload_content=not stream,decode_content=True)
+            except errors.NewConnectionError as e:
+                raise RTIRConnectionError(str(e),url)
+            except errors.ConnectTimeoutError as e:
+                raise RTIRConnectTimeout(str(e),url)
+            except (errors.ReadTimeoutError,errors.TimeoutError) as e:
+                raise RTIRTimeout(str(e),url)
+            except errors.HTTPError as e:
+                raise RTIRConnectionError(str(e),url)
+            self.store_cookies(raw.headers.getlist('Set-Cookie'))
+            location = raw.get_redirect_location()
+            if not location or hop == self.max_redirects: break
+            raw.drain_conn()
+            raw.release_conn()
+            from urllib.parse import urljoin
+            url = urljoin(url,location)
+            if raw.status in (301,302,303) and method == 'POST':
+                method, body = 'GET', None
+        if stream:
+            return TransportResponse(raw.status,raw.reason,raw.headers,None,url,body,dict(self.cookies),raw)
+        return TransportResponse(raw.status,raw.reason,raw.headers,raw.data,url,body,dict(self.cookies))
+
+    def close(self):
+        for manager in set(self.__managers.values()):
+            manager.clear()
+
+    def pool_stats(self):
+        return self.pool_manager_stats(set(self.__managers.values()))
+
+class MemoryTransport(Transport):
+    """
+    In-process transport for tests: handler(method,path,query,form,headers)
+    returns (status, body bytes, headers dict); FakeRT(...).handle fits.
+
+    rtir = RTIR4REST('root','password','http://fake',transport=MemoryTransport(FakeRT(tickets=100).handle))
+    """
+
+    name = 'memory'
+
+    def __init__(self,handler):
+        self.handler = handler
+
+    def request(self,method,url,data=None,params=None,stream=False,timeout=None):
+        from urllib.parse import parse_qs, urlsplit
+        url, body = self.encode(url,data,params)
+        parts = urlsplit(url)
+        if isinstance(data,dict):
+            form = dict(data)
+        else:
+            form = dict((k,v[0]) for k, v in parse_qs((body or b'').decode('utf-8'),keep_blank_values=True).items())
+        try:
+            status, content, headers = self.handler(method,parts.path,parse_qs(parts.query,keep_blank_values=True),
+                                                    form,self.request_headers(body))
+        except Exception as e:
+            raise RTIRConnectionError(str(e),url)
+        headers = dict(headers)
+        if 'Set-Cookie' in headers: self.store_cookies([headers['Set-Cookie']])
+        headers['Content-Length'] = str(len(content))
+        from http import HTTPStatus
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+        return TransportResponse(status,reason,headers,content,url,body,dict(self.cookies))
+
+TRANSPORTS = {'requests': RequestsTransport,'urllib3': Urllib3Transport}
+
+class TicketResult():
+    """Outcome of one ticket in a batch operation: .id, .value and .error (None on success)"""
+
+    __slots__ = ('id','value','error')
+
+    def __init__(self,sticketid,value=None,error=None):
+        self.id = sticketid
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return '<TicketResult #%s error %r>' % (self.id,self.error)
+        return '<TicketResult #%s %r>' % (self.id,self.value)
+
+class Attachment():
+    """One entry of a ticket attachment index: .id, .name, .content_type, .size (bytes, approximate for k/M sizes)"""
+
+    __slots__ = ('id','name','content_type','size')
+    __line = re.compile(r'^\s*(?:Attachments:\s*)?(\d+):\s*(.*?)\s*\(([^()\s]+) / ([\d.]+)([bkMG]?)\),?\s*$')
+    __units = {'': 1,'b': 1,'k': 1024,'M': 1024**2,'G': 1024**3}
+
+    def __init__(self,attachmentid,name,content_type,size):
+        self.id = attachmentid
+        self.name = name
+        self.content_type = content_type
+        self.size = size
+
+    @classmethod
+    def parse_list(cls,text):
+        """Attachment list of a 'ticket/<id>/attachments' response"""
+        attachments = []
+        for sline in text.splitlines():
+            m = cls.__line.match(sline)
+            if m:
+                name = m.group(2) if m.group(2) != '(Unnamed)' else ''
+                size = int(float(m.group(4))*cls.__units[m.group(5)])
+                attachments.append(cls(int(m.group(1)),name,m.group(3),size))
+        return attachments
+
+    def __repr__(self):
+        return '<Attachment #%d %s %d bytes>' % (self.id,self.content_type,self.size)
+
+class TicketEdit():
+    """
+    Collects field changes for one ticket and renders them as a single
+    /edit payload. Setting a field again replaces the earlier value.
+    Custom fields are sent as 'CF-<name>'.
+
+    edit = TicketEdit().set('Queue','Incidents').set_cf('IP','10.0.0.1')
+    rtir.update_ticket('123',edit.set('Status','resolved'))
+    """
+
+    def __init__(self,fields=None,**kwargs):
+        self.fields = OrderedDict()
+        self.update(fields)
+        self.update(kwargs)
+
+    def __field_name(self,field):
+        if field.startswith('CF.{') and field.endswith('}'):
+            return 'CF-'+field[4:-1]
+        if field.startswith('CF_'):
+            return 'CF-'+field[3:]
+        return field
+
+    def set(self,field,value):
+        """Set a field ('Owner', 'Status', 'CF-IP', 'CF.{IP}'). Returns self."""
+        field = self.__field_name(field)
+        self.fields.pop(field,None)
+        self.fields[field] = value
+        return self
+
+    def set_cf(self,name,value):
+        """Set custom field CF.{name}. Returns self."""
+        return self.set('CF-'+name,value)
+
+    def update(self,fields):
+        """Set all fields of a dict (or another TicketEdit). Returns self."""
+        if isinstance(fields,TicketEdit):
+            fields = fields.fields
+        if fields:
+            for field, value in fields.items():
+                self.set(field,value)
+        return self
+
+    def content(self,sticketid=''):
+        """RT REST 'content' text for the edit"""
+        s = 'id: ' + str(sticketid) + '\n' if sticketid else ''
+        for field, value in self.fields.items():
+            s += field + ': ' + str(value).strip().replace('\n','\n ') + '\n'
+        return s
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return '<TicketEdit %r>' % dict(self.fields)
+
+class ChangeFeed():
+    """
+    Incremental change feed. Each poll searches only tickets with
+    LastUpdated at or after the high-water mark and returns the new or
+    changed ones as Ticket records, oldest change first. Tickets already
+    returned with the same LastUpdated (ticks landing on the same second)
+    are dropped. With state_file the mark survives restarts. A poll with a
+    failed request keeps the mark and sets feed.last_error.
+
+    feed = ChangeFeed(rtir,"Queue='Incident Reports'",state_file='feed.json')
+    for ticket in feed: print(ticket.id,ticket.status)   # polls every interval seconds
+    async for ticket in ChangeFeed(async_rtir): ...
+    """
+
+    DATE_FORMAT = '%a %b %d %H:%M:%S %Y'
+
+    def __init__(self,rtir,query='',state_file=None,since=None,interval=60,overlap=0,page_size=500):
+        self.rtir = rtir
+        self.query = query
+        self.state_file = state_file
+        self.interval = interval
+        self.overlap = overlap
+        self.page_size = page_size
+        self.mark = since
+        self.last_error = None
+        self.__seen = {}
+        self.__lock = threading.Lock()
+        if state_file and os.path.exists(state_file):
+            self.load()
+
+    @classmethod
+    def timestamp(cls,value):
+        """RT date ('Mon Jan 01 08:00:01 2018') as 'YYYY-MM-DD HH:MM:SS', '' if not set"""
+        try:
+            return time.strftime('%Y-%m-%d %H:%M:%S',time.strptime(value.strip(),cls.DATE_FORMAT))
+        except (ValueError, AttributeError):
+            return ''
+
+    def search_query(self):
+        """TicketSQL of the next poll"""
+        if not self.mark: return self.query or 'id > 0'
+        mark = self.mark
+        if self.overlap:
+            mark = time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(time.mktime(time.strptime(mark,'%Y-%m-%d %H:%M:%S'))-self.overlap))
+        query = "LastUpdated >= '"+mark+"'"
+        return query+' AND ('+self.query+')' if self.query else query
+
+    def __changes(self,tickets,failed):
+        """Drop already seen tickets, advance the mark (unless the poll failed) and forget old entries"""
+        changes = []
+        for ticket in tickets:
+            stamp = self.timestamp(ticket.last_updated)
+            if self.__seen.get(ticket.id) == stamp: continue
+            self.__seen[ticket.id] = stamp
+            changes.append((stamp,ticket.id,ticket))
+        changes.sort(key=lambda change: change[:2])
+        if changes and not failed:
+            self.mark = max(self.mark or '',changes[-1][0])
+            floor = self.search_query().split("'")[1] if self.mark else ''
+            self.__seen = dict([(ticketid,stamp) for ticketid, stamp in self.__seen.items() if stamp >= floor])
+        return [change[2] for change in changes]
+
+    def poll(self,save=True):
+        """Search once and return the list of new or changed tickets. A failed search keeps the mark."""
+        with self.__lock:
+            failed = None
+            tickets = []
+            try:
+                for ticket in self.rtir.search_tickets_full(self.search_query(),page_size=self.page_size,strict=True):
+                    tickets.append(ticket)
+            except Exception as e:
+                failed = e
+            self.last_error = failed # the mark stays where it was, so the next poll fetches the missed tickets
+            changes = self.__changes(tickets,failed is not None)
+            if changes and save and self.state_file: self.save()
+            return changes
+
+    async def apoll(self,save=True):
+        """Search once with an AsyncRTIR4REST client"""
+        failed = None
+        tickets = []
+        try:
+            async for ticket in self.rtir.search_tickets_full(self.search_query(),page_size=self.page_size,strict=True):
+                tickets.append(ticket)
+        except Exception as e:
+            failed = e
+        self.last_error = failed
+        changes = self.__changes(tickets,failed is not None)
+        if changes and save and self.state_file: self.save()
+        return changes
+
+    def __iter__(self):
+        while True:
+            for ticket in self.poll():
+                yield ticket
+            time.sleep(self.interval)
+
+    async def __aiter__(self):
+        import asyncio
+        while True:
+            for ticket in await self.apoll():
+                yield ticket
+            await asyncio.sleep(self.interval)
+
+    def save(self):
+        """Write mark and seen tickets to state_file (atomic replace)"""
+        state = {'mark': self.mark, 'seen': self.__seen}
+        with open(self.state_file+'.tmp','w') as f:
+            json.dump(state,f)
+        os.replace(self.state_file+'.tmp',self.state_file)
+
+    def load(self):
+        """Read mark and seen tickets from state_file"""
+        with open(self.state_file) as f:
+            state = json.load(f)
+        self.mark = state.get('mark')
+        self.__seen = dict([(int(ticketid),stamp) for ticketid, stamp in state.get('seen',{}).items()])
+
+    def reset(self,since=None):
+        """Start over from since (None = all matching tickets)"""
+        self.mark = since
+        self.__seen = {}
+
+class IPIndex():
+    """
+    In-memory prefix index of CF.{IP} values (IPv4 and IPv6 addresses,
+    CIDR networks and 'a-b' ranges) to ticket ids. Entries are kept per
+    (version, prefix length) in dicts keyed by the network bits, so an
+    address lookup is one dict probe per prefix length in use, and network
+    queries use bisect over the sorted keys. statuses limits the index to
+    tickets in those states (e.g. ('new','open')).
+
+    index = IPIndex.build(rtir,"Status='new' OR Status='open'",statuses=('new','open'))
+    index.lookup('10.1.2.3')        # -> {1234}
+    index.lookup('10.1.0.0/16')     # tickets with an address or network overlapping it
+    index.lookup_many(addresses)    # -> {address: set of ids}
+    index.update(feed.poll())       # feed without a Status filter, so closed tickets drop out
+    """
+
+    def __init__(self,statuses=None):
+        self.statuses = set([status.lower() for status in statuses]) if statuses else None
+        self.__prefixes = {}  # (version,prefixlen) -> {network bits: set of ticket ids}
+        self.__sorted = {}
+        self.__tickets = {}
+        self.__lock = threading.RLock()
+
+    @classmethod
+    def build(cls,rtir,query,statuses=None,page_size=500):
+        """Index the tickets of a bulk search"""
+        index = cls(statuses)
+        index.update(rtir.search_tickets_full(query,page_size=page_size))
+        return index
+
+    @staticmethod
+    def parse(value):
+        """ip_network list of a CF.{IP} value; unparsable parts are skipped"""
+        import ipaddress
+        networks = []
+        for sip in re.split(r'[\s,;]+',value or ''):
+            try:
+                if '-' in sip:
+                    first, last = sip.split('-',1)
+                    networks += ipaddress.summarize_address_range(ipaddress.ip_address(first),ipaddress.ip_address(last))
+                elif sip:
+                    networks.append(ipaddress.ip_network(sip,strict=False))
+            except ValueError:
+                continue
+        return networks
+
+    @staticmethod
+    def __key(network):
+        return (network.version,network.prefixlen),int(network.network_address) >> (network.max_prefixlen-network.prefixlen)
+
+    def add(self,ticketid,value):
+        """Index ticket id under the addresses of value (no status check)"""
+        ticketid = int(ticketid)
+        with self.__lock:
+            for network in self.parse(value):
+                prefix, bits = self.__key(network)
+                entries = self.__prefixes.setdefault(prefix,{})
+                if not bits in entries: self.__sorted.pop(prefix,None)
+                entries.setdefault(bits,set()).add(ticketid)
+                self.__tickets.setdefault(ticketid,set()).add((prefix,bits))
+
+    def remove(self,ticketid):
+        """Drop a ticket from the index"""
+        ticketid = int(ticketid)
+        with self.__lock:
+            for prefix, bits in self.__tickets.pop(ticketid,()):
+                entries = self.__prefixes[prefix]
+                entries[bits].discard(ticketid)
+                if not entries[bits]:
+                    del entries[bits]
+                    self.__sorted.pop(prefix,None)
+                    if not entries: del self.__prefixes[prefix]
+
+    def created(self,ticketid,value,status):
+        """Index a ticket just created with status (skipped if the index excludes that status)"""
+        if self.statuses is None or status.lower() in self.statuses:
+            self.add(ticketid,value)
+
+    def update(self,tickets):
+        """Re-index Ticket records (from a search or ChangeFeed.poll()). Returns the number indexed."""
+        n = 0
+        with self.__lock:
+            for ticket in tickets:
+                self.remove(ticket.id)
+                if self.statuses is not None and ticket.status.lower() not in self.statuses: continue
+                self.add(ticket.id,ticket.cf.get('IP',''))
+                n += 1
+        return n
+
+    def __keys(self,prefix):
+        keys = self.__sorted.get(prefix)
+        if keys is None:
+            keys = self.__sorted[prefix] = sorted(self.__prefixes[prefix])
+        return keys
+
+    @staticmethod
+    def __address(ip):
+        """(version, prefixlen, integer) of an address string, None if it is not a plain address"""
+        family, version, maxlen = (socket.AF_INET6,6,128) if ':' in ip else (socket.AF_INET,4,32)
+        try:
+            return version, maxlen, int.from_bytes(socket.inet_pton(family,ip),'big')
+        except (OSError, ValueError):
+            return None
+
+    def lookup(self,ip):
+        """Ticket ids for an address (entries containing it) or a network (entries overlapping it)"""
+        address = self.__address(ip) if isinstance(ip,str) else None
+        if address is not None:
+            version, maxlen, low = address
+            ids = set()
+            with self.__lock:
+                for prefix, entries in self.__prefixes.items():
+                    if prefix[0] == version:
+                        ids.update(entries.get(low >> (maxlen-prefix[1]),()))
+            return ids
+        import ipaddress
+        network = ipaddress.ip_network(ip,strict=False)
+        version = network.version
+        maxlen = network.max_prefixlen
+        low = int(network.network_address)
+        high = int(network.broadcast_address)
+        ids = set()
+        with self.__lock:
+            for prefix, entries in self.__prefixes.items():
+                if prefix[0] != version: continue
+                shift = maxlen-prefix[1]
+                if prefix[1] <= network.prefixlen:
+                    ids.update(entries.get(low >> shift,()))
+                else:
+                    keys = self.__keys(prefix)
+                    for bits in keys[bisect.bisect_left(keys,low >> shift):bisect.bisect_right(keys,high >> shift)]:
+                        ids.update(entries[bits])
+        return ids
+
+    def lookup_many(self,ips):
+        """{ip: set of ticket ids} for many addresses or networks (unparsable ones map to an empty set)"""
+        found = {}
+        for ip in ips:
+            try:
+                found[ip] = self.lookup(ip)
+            except ValueError:
+                found[ip] = set()
+        return found
+
+    def lookup_value(self,value):
+        """Ticket ids overlapping any address of a CF.{IP} style value ('10.0.0.1, 10.0.1.0/24')"""
+        ids = set()
+        for network in self.parse(value):
+            ids |= self.lookup(network)
+        return ids
+
+    def __contains__(self,ip):
+        return bool(self.lookup(ip))
+
+    def __len__(self):
+        return len(self.__tickets)
+
+class TicketStore():
+    """
+    Local SQLite read replica of RT tickets. Parsed fields are stored in
+    columns (dates as 'YYYY-MM-DD HH:MM:SS') with indexes on status, owner,
+    queue, created, CF.{Classification} and CF.{IP} (ticket_ips, one row
+    per address). load() fills it from a bulk search, sync() applies only
+    tickets changed since the last sync (ChangeFeed mark kept in the
+    database). query() answers from the replica and refreshes entries older
+    than max_age seconds from RT.
+
+    store = TicketStore('tickets.db',rtir)
+    store.load()
+    store.sync()
+    store.query(ip='10.1.0.0/16',classification='Spam',created_after='2017-01-01',created_before='2018-01-01')
+    """
+
+    DATE_SLOTS = ('created','starts','started','due','resolved','told','last_updated')
+    __columns = ('id',)+tuple(Ticket.FIELDS.values())+('classification','ip','cf','raw','synced')
+    __schema = [
+        'CREATE TABLE IF NOT EXISTS tickets (id INTEGER PRIMARY KEY, '+
+        ', '.join([slot+' TEXT' for slot in Ticket.FIELDS.values()])+
+        ', classification TEXT, ip TEXT, cf TEXT, raw TEXT, synced REAL)',
+        'CREATE TABLE IF NOT EXISTS ticket_ips (ticket_id INTEGER, ip TEXT, ip_version INTEGER, ip_packed BLOB)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE INDEX IF NOT EXISTS tickets_status ON tickets (status)',
+        'CREATE INDEX IF NOT EXISTS tickets_owner ON tickets (owner)',
+        'CREATE INDEX IF NOT EXISTS tickets_queue ON tickets (queue)',
+        'CREATE INDEX IF NOT EXISTS tickets_created ON tickets (created)',
+        'CREATE INDEX IF NOT EXISTS tickets_classification ON tickets (classification)',
+        'CREATE INDEX IF NOT EXISTS ticket_ips_ip ON ticket_ips (ip)',
+        'CREATE INDEX IF NOT EXISTS ticket_ips_packed ON ticket_ips (ip_version,ip_packed)',
+        'CREATE INDEX IF NOT EXISTS ticket_ips_ticket ON ticket_ips (ticket_id)']
+
+    def __init__(self,path,rtir=None,max_age=None):
+        import sqlite3
+        self.path = path
+        self.rtir = rtir
+        self.max_age = max_age
+        self.__db = sqlite3.connect(path,check_same_thread=False)
+        self.__lock = threading.RLock()
+        self.last_error = None
+        with self.__lock, self.__db:
+            for sql in self.__schema:
+                self.__db.execute(sql)
+
+    def close(self):
+        """Close the database"""
+        with self.__lock:
+            self.__db.close()
+
+    def __row(self,ticket,synced):
+        row = [ticket.id]
+        for slot in Ticket.FIELDS.values():
+            value = getattr(ticket,slot)
+            row.append(ChangeFeed.timestamp(value) if slot in self.DATE_SLOTS else value)
+        row += [ticket.cf.get('Classification',''),ticket.cf.get('IP',''),json.dumps(ticket.cf),ticket.raw,synced]
+        return row
+
+    @staticmethod
+    def ip_list(value):
+        """Addresses of a CF.{IP} value as (text, version, packed bytes) tuples"""
+        import ipaddress
+        ips = []
+        for sip in re.split(r'[\s,;]+',value or ''):
+            try:
+                address = ipaddress.ip_address(sip)
+            except ValueError:
+                continue
+            ips.append((sip,address.version,address.packed))
+        return ips
+
+    def put(self,tickets):
+        """Insert or replace Ticket records (one transaction). Returns the number stored."""
+        if isinstance(tickets,Ticket): tickets = [tickets]
+        synced = time.time()
+        n = 0
+        sql = 'INSERT OR REPLACE INTO tickets ('+','.join(self.__columns)+') VALUES ('+','.join(['?']*len(self.__columns))+')'
+        with self.__lock, self.__db:
+            for ticket in tickets:
+                if ticket is None or not ticket.id: continue
+                self.__db.execute(sql,self.__row(ticket,synced))
+                self.__db.execute('DELETE FROM ticket_ips WHERE ticket_id = ?',(ticket.id,))
+                self.__db.executemany('INSERT INTO ticket_ips (ticket_id,ip,ip_version,ip_packed) VALUES (?,?,?,?)',
+                                      [(ticket.id,sip,version,packed) for sip, version, packed in self.ip_list(ticket.cf.get('IP'))])
+                n += 1
+        return n
+
+    def delete(self,ticketid):
+        """Remove a ticket from the replica"""
+        with self.__lock, self.__db:
+            self.__db.execute('DELETE FROM tickets WHERE id = ?',(int(ticketid),))
+            self.__db.execute('DELETE FROM ticket_ips WHERE ticket_id = ?',(int(ticketid),))
+
+    def load(self,query='',page_size=500):
+        """Fill the replica from a bulk search and start sync(query) from there. Returns the number of tickets stored."""
+        feed = ChangeFeed(self.rtir,query)
+        tickets = list(self.rtir.search_tickets_full(feed.search_query(),page_size=page_size))
+        stamps = [ChangeFeed.timestamp(ticket.last_updated) for ticket in tickets]
+        if stamps and self.rtir.last_error is None and max(stamps) > (self.meta('mark:'+query) or ''):
+            self.meta('mark:'+query,max(stamps))
+        return self.put(tickets)
+
+    def meta(self,key,value=None):
+        """Get (value None) or set a meta entry"""
+        with self.__lock, self.__db:
+            if value is not None:
+                self.__db.execute('INSERT OR REPLACE INTO meta (key,value) VALUES (?,?)',(key,value))
+                return value
+            row = self.__db.execute('SELECT value FROM meta WHERE key = ?',(key,)).fetchone()
+        return row[0] if row else None
+
+    def sync(self,query=''):
+        """Store tickets changed in RT since the last sync. Returns the number of tickets stored."""
+        feed = ChangeFeed(self.rtir,query,since=self.meta('mark:'+query))
+        n = self.put(feed.poll(save=False))
+        if feed.mark: self.meta('mark:'+query,feed.mark)
+        return n
+
+    def __select(self,where,args,order,limit):
+        sql = 'SELECT id, raw, synced FROM tickets'
+        if where: sql += ' WHERE '+' AND '.join(where)
+        sql += ' ORDER BY '+order
+        if limit: sql += ' LIMIT '+str(int(limit))
+        with self.__lock:
+            return self.__db.execute(sql,args).fetchall()
+
+    def __stale(self,rows,max_age):
+        if max_age is None or self.rtir is None: return []
+        oldest = time.time()-max_age
+        return [ticketid for ticketid, raw, synced in rows if synced < oldest]
+
+    def __fetch(self,sticketid):
+        """get_ticket() for map_tickets(), which reports its errors; None only when RT answers that the ticket does not exist"""
+        if not self.rtir.user: raise RTIRError('not logged in')
+        return self.rtir.get_ticket(sticketid)
+
+    def refresh(self,ids,workers=None):
+        """Fetch tickets from RT into the replica, dropping the ones RT says do not exist. On errors the
+        local rows are kept and the error is printed and kept in self.last_error. Returns the failed TicketResults."""
+        for sticketid in ids:
+            self.rtir.ticketcache.invalidate(str(sticketid))
+        failed = []
+        for result in self.rtir.map_tickets(self.__fetch,ids,workers=workers):
+            if not result.ok:
+                failed.append(result)
+            elif result.value is None:
+                self.delete(result.id)
+            else:
+                self.put(result.value)
+        self.last_error = failed[0].error if failed else None
+        if failed: print('> Error in TicketStore.refresh() : %d of %d tickets not refreshed:' % (len(failed),len(ids)),failed[0].error)
+        return failed
+
+    def get(self,ticketid,max_age=-1):
+        """Ticket from the replica, fetched from RT if missing or older than max_age (default self.max_age)"""
+        if max_age == -1: max_age = self.max_age
+        rows = self.__select(['id = ?'],[int(ticketid)],'id',1)
+        if self.rtir is not None and (not rows or self.__stale(rows,max_age)):
+            self.refresh([int(ticketid)])
+            rows = self.__select(['id = ?'],[int(ticketid)],'id',1)
+        return Ticket.from_text(rows[0][1]) if rows else None
+
+    def query(self,status=None,owner=None,queue=None,classification=None,ip=None,created_after=None,
+              created_before=None,where=None,args=(),order='id',limit=None,max_age=-1):
+        """
+        Tickets matching all given filters. status/owner/queue/classification
+        take a value or a list, ip an address or a CIDR network, created_* a
+        'YYYY-MM-DD[ HH:MM:SS]' bound (after inclusive, before exclusive) and
+        where/args extra SQL. Entries older than max_age are refreshed from RT.
+        """
+        if max_age == -1: max_age = self.max_age
+        clauses = []
+        values = []
+        for column, value in (('status',status),('owner',owner),('queue',queue),('classification',classification)):
+            if value is None: continue
+            if isinstance(value,str): value = [value]
+            clauses.append(column+' IN ('+','.join(['?']*len(value))+')')
+            values += list(value)
+        if ip is not None:
+            import ipaddress
+            network = ipaddress.ip_network(ip,strict=False)
+            clauses.append('id IN (SELECT ticket_id FROM ticket_ips WHERE ip_version = ? AND ip_packed BETWEEN ? AND ?)')
+            values += [network.version,network.network_address.packed,network.broadcast_address.packed]
+        if created_after is not None:
+            clauses.append('created >= ?')
+            values.append(created_after)
+        if created_before is not None:
+            clauses.append('created < ?')
+            values.append(created_before)
+        if where:
+            clauses.append('('+where+')')
+            values += list(args)
+        rows = self.__select(clauses,values,order,limit)
+        stale = self.__stale(rows,max_age)
+        if stale:
+            self.refresh(stale)
+            rows = self.__select(clauses,values,order,limit)
+        return [Ticket.from_text(raw) for ticketid, raw, synced in rows]
+
+    def count(self):
+        """Number of tickets in the replica"""
+        with self.__lock:
+            return self.__db.execute('SELECT COUNT(*) FROM tickets').fetchone()[0]
+
+class TicketExport():
+    """
+    Streaming ticket export to JSON lines, CSV or Parquet (optional
+    dependency: pip install pyarrow). Ticket ids stream in from the search
+    in id order. Records are fetched page_size at a time in one format=l
+    search with only the projected fields, and the first content_type
+    message of each ticket is fetched with `workers` tickets in flight.
+    Rows are written in id order as they complete, so memory stays
+    constant however many tickets match.
+
+    fields are ticket items (rtir.ticket_items, default all). The columns
+    are id, the fields and Message, the Content of the message
+    (message=False leaves out the message and its 2 requests per ticket).
+    Every batch_size rows the output is flushed and the last exported id
+    saved to <path>.state. A rerun
+    continues after that id: it resumes an interrupted export, or it adds
+    the new tickets of a finished one. JSONL and CSV are appended to, and
+    Parquet writes a directory of part-NNNNN.parquet files (one per
+    part_rows rows). resume=False starts over.
+
+    export = TicketExport(rtir,"Queue = 'Incidents'",'incidents.jsonl',fields=['Subject','Status','CF.{IP}'])
+    summary = export.run()   # {'exported': .., 'rows': .., 'last_id': .., 'seconds': .., 'rate': ..}
+    """
+
+    FORMATS = ('jsonl','csv','parquet')
+
+    def __init__(self,rtir,query,path,format=None,fields=None,message=True,content_type='text/plain',workers=None,
+                 page_size=500,batch_size=1000,part_rows=100000,resume=True):
+        self.rtir = rtir
+        self.query = query
+        self.path = path
+        self.format = format or self.guess_format(path)
+        if self.format not in self.FORMATS: raise ValueError('unknown export format: %r' % self.format)
+        items = dict((item.lower(),item) for item in rtir.ticket_items if item != 'id')
+        fields = fields or list(items.values())
+        unknown = [field for field in fields if field.lower().strip() not in items]
+        if unknown: raise ValueError('unknown ticket items: '+', '.join(unknown))
+        self.fields = [items[field.lower().strip()] for field in fields]
+        self.message = message
+        self.columns = ['id']+self.fields+(['Message'] if message else [])
+        self.content_type = content_type
+        self.workers = workers or 8
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.part_rows = part_rows
+        self.resume = resume
+        self.state_file = os.path.join(path,'_state.json') if self.format == 'parquet' else path+'.state'
+        self.state = None
+
+    @staticmethod
+    def guess_format(path):
+        """Format by file extension: .jsonl/.json/.ndjson, .csv, anything else is a Parquet directory"""
+        if path.endswith(('.jsonl','.json','.ndjson')): return 'jsonl'
+        if path.endswith('.csv'): return 'csv'
+        return 'parquet'
+
+    def __check(self,value):
+        """Raise the error of the last call (the client prints and returns '' by default)"""
+        if self.rtir.last_error is not None: raise self.rtir.last_error
+        return value
+
+    def load_state(self):
+        """Saved progress of an earlier run, None if there is none (or resume=False)"""
+        if not self.resume or not os.path.exists(self.state_file): return None
+        with open(self.state_file) as f:
+            state = json.load(f)
+        if state.get('columns') != self.columns or state.get('format') != self.format:
+            raise RTIRError('export columns or format changed since the last run; use resume=False to start over')
+        return state
+
+    def save_state(self):
+        tmp = self.state_file+'.tmp'
+        with open(tmp,'w') as f:
+            json.dump(self.state,f)
+        os.replace(tmp,self.state_file)
+
+    def __pages(self,after):
+        """Generator: Ticket records in id order, fetched page_size per request"""
+        query = '('+self.query+') AND id > '+str(after) if after else self.query
+        page = []
+        for ticketid, subject in self.rtir.iter_search(query,sort=True):
+            page.append(ticketid)
+            if len(page) >= self.page_size:
+                for ticket in self.__page(page): yield ticket
+                page = []
+        self.__check(None)
+        if page:
+            for ticket in self.__page(page): yield ticket
+
+    def __page(self,page):
+        tickets = self.__check(self.rtir.search_tickets_range(self.query,page[0],page[-1],fields=self.fields))
+        return sorted(tickets,key=lambda ticket: ticket.id)
+
+    def __row(self,ticket):
+        """Output row of one ticket (fetches its first message)"""
+        row = OrderedDict([('id',ticket.id)])
+        for field in self.fields:
+            row[field] = ticket.get(field)
+        if self.message:
+            row['Message'] = rt_content(self.__check(self.rtir.get_ticket_message(str(ticket.id),self.content_type,first=True)))
+        return row
+
+    def rows(self,after=0):
+        """Generator: rows (OrderedDicts) of the tickets with id > after in id order, workers tickets in flight"""
+        import collections
+        if not self.message:
+            for ticket in self.__pages(after): yield self.__row(ticket)
+            return
+        window = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for ticket in self.__pages(after):
+                window.append(pool.submit(self.__row,ticket))
+                if len(window) >= self.workers*2: yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+
+    def __open(self):
+        state = self.state
+        if self.format == 'parquet':
+            import glob
+            os.makedirs(self.path,exist_ok=True)
+            for path in glob.glob(os.path.join(glob.escape(self.path),'part-*.parquet')):
+                if int(os.path.basename(path)[5:10]) >= state['part']: os.remove(path) # unfinished part
+            self.__buffer = []
+            self.__writer = None
+            self.__part_rows = 0
+            return
+        if not os.path.exists(self.path): open(self.path,'w').close()
+        self.__file = open(self.path,'r+',newline='',encoding='utf-8')
+        self.__file.truncate(state['offset']) # rows written after the last saved state are exported again
+        self.__file.seek(state['offset'])
+        if self.format == 'csv':
+            import csv
+            self.__csv = csv.DictWriter(self.__file,self.columns)
+            if not state['offset']: self.__csv.writeheader()
+
+    def __write(self,row):
+        if self.format == 'jsonl':
+            self.__file.write(json.dumps(row,ensure_ascii=False)+'\n')
+        elif self.format == 'csv':
+            self.__csv.writerow(row)
+        else:
+            self.__buffer.append(row)
+
+    def __flush_parquet(self,last_id,rows,close):
+        """Write the buffered rows as row groups; close the part (and save the state) every part_rows rows"""
+        import pyarrow
+        import pyarrow.parquet
+        written = rows-len(self.__buffer)
+        while self.__buffer:
+            # a row group never crosses a part boundary, whatever batch_size is
+            chunk = self.__buffer[:self.part_rows-self.__part_rows]
+            self.__buffer = self.__buffer[len(chunk):]
+            columns = [pyarrow.array([row['id'] for row in chunk],type=pyarrow.int64())]
+            columns += [pyarrow.array([row[column] for row in chunk],type=pyarrow.string()) for column in self.columns[1:]]
+            table = pyarrow.Table.from_arrays(columns,names=self.columns)
+            if self.__writer is None:
+                path = os.path.join(self.path,'part-%05d.parquet' % self.state['part'])
+                self.__writer = pyarrow.parquet.ParquetWriter(path,table.schema)
+            self.__writer.write_table(table)
+            self.__part_rows += len(chunk)
+            written += len(chunk)
+            if self.__part_rows >= self.part_rows: self.__close_part(chunk[-1]['id'],written)
+        if self.__writer is not None and close: self.__close_part(last_id,rows)
+
+    def __close_part(self,last_id,rows):
+        self.__writer.close()
+        self.__writer = None
+        self.__part_rows = 0
+        self.state['part'] += 1
+        self.state.update({'last_id': last_id,'rows': rows})
+        self.save_state()
+
+    def __commit(self,last_id,rows,close=False):
+        """Make the rows so far durable and record the last exported id"""
+        if self.format == 'parquet':
+            self.__flush_parquet(last_id,rows,close)
+            return
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.state.update({'last_id': last_id,'rows': rows,'offset': self.__file.tell()})
+        self.save_state()
+        if close: self.__file.close()
+
+    def run(self):
+        """Export all (remaining) tickets. Returns {'exported','rows' (in the output),'last_id','resumed','seconds','rate'}."""
+        if self.format == 'parquet':
+            import pyarrow.parquet # fail before any request if pyarrow is missing
+        started = time.monotonic()
+        state = self.load_state()
+        resumed = state is not None
+        self.state = state or {'format': self.format,'columns': self.columns,'query': self.query,'last_id': 0,
+                               'rows': 0,'offset': 0,'part': 0}
+        self.__open()
+        last_id, rows, exported = self.state['last_id'], self.state['rows'], 0
+        try:
+            for row in self.rows(last_id):
+                self.__write(row)
+                last_id, rows, exported = row['id'], rows+1, exported+1
+                if not exported % self.batch_size:
+                    self.__commit(last_id,rows)
+        finally:
+            self.__commit(last_id,rows,close=True)
+        seconds = time.monotonic()-started
+        return {'exported': exported,'rows': rows,'last_id': last_id,'resumed': resumed,'seconds': seconds,
+                'rate': exported/seconds if seconds else 0.0}
+
+class TicketCache():
+    """
+    Bounded LRU ticket cache with per-entry TTL. Thread-safe.
+    Entries hold the parsed Ticket and its LastUpdated value.
+    """
+
+    def __init__(self,maxsize=1024,ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.RLock()
+        self.__writes = 0
+        self.__cleared = 0
+        self.__generations = {}
+
+    def generation(self,key=None):
+        """Write generation of key: the count of invalidations when it was last invalidated (or cleared). Without key, the current count."""
+        with self.__lock:
+            if key is None: return self.__writes
+            return max(self.__generations.get(str(key),0),self.__cleared)
+
+    def get(self,key,default=None):
+        """Return cached value for key (and mark it recently used), else default"""
+        key = str(key)
+        with self.__lock:
+            entry = self.__data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if self.ttl and entry[0] < time.monotonic():
+                del self.__data[key]
+                self.misses += 1
+                return default
+            self.__data.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self,key,value,lastupdated='',generation=None):
+        """Store value for key, evicting the least recently used entries when full.
+        With generation (taken before fetching value), a value fetched before the key was last invalidated is not stored."""
+        key = str(key)
+        with self.__lock:
+            if generation is not None and max(self.__generations.get(key,0),self.__cleared) > generation: return
+            self.__data[key] = (time.monotonic()+(self.ttl or 0),lastupdated,value)
+            self.__data.move_to_end(key)
+            while self.maxsize and len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+                self.evictions += 1
+
+    def lastupdated(self,key):
+        """LastUpdated value stored with the entry, or ''"""
+        with self.__lock:
+            entry = self.__data.get(str(key))
+            return entry[1] if entry else ''
+
+    def invalidate(self,key):
+        """Drop a single entry and bump its write generation"""
+        with self.__lock:
+            self.__writes += 1
+            self.__generations[str(key)] = self.__writes
+            self.__data.pop(str(key),None)
+
+    def clear(self):
+        """Drop all entries and bump every write generation (counters are kept)"""
+        with self.__lock:
+            self.__writes += 1
+            self.__cleared = self.__writes
+            self.__generations.clear()
+            self.__data.clear()
+
+    def stats(self):
+        """Counters snapshot"""
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self.__data), 'maxsize': self.maxsize}
+
+    def __contains__(self,key):
+        with self.__lock:
+            return str(key) in self.__data
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__data)
+
+class AsyncRTIR4REST():
+    """
+    AsyncRTIR4REST
+    --------------
+
+    asyncio version of RTIR4REST running on aiohttp (optional dependency:
+    pip install aiohttp). Same method names, every network method is a
+    coroutine. Connections are kept alive in one pooled aiohttp session and
+    at most `concurrency` requests are in flight at any time.
+
+    >>> Basic Usage <<<
+    async with AsyncRTIR4REST(usr,pwd,url,concurrency=50) as rtir:
+        if await rtir.login():
+            tickets = await asyncio.gather(*[rtir.get_ticket(i) for i in id_list])
+    """
+
+    __failures = contextvars.ContextVar('rtir4rest_failures',default=None)
+
+    def __init__(self,rtir_user,rtir_password,rtir_full_url,useragent='Mozilla/5.0.2018',proxy_dict={},
+                 cache_size=1024,cache_ttl=300,concurrency=50,retry_policy=None,raise_errors=False,
+                 rate_limiter=None,concurrency_limiter=None,request_stats=None,ip_index=None,
+                 keep_alive=True,verify=False,ssl_context=None,relogin=True,single_flight=True):
+        """Initializing AsyncRTIR4REST"""
+        self.__loggedin = False
+        self.__session = None
+        self.__relogin_enabled = relogin
+        self.__login_lock = None
+        self.__login_generation = 0
+        self.relogins = 0
+        self.singleflight = SingleFlight() if single_flight else None
+        self.__keep_alive = keep_alive
+        if ssl_context is None and verify:
+            import ssl
+            ssl_context = ssl.create_default_context(cafile=verify if isinstance(verify,str) else None)
+        self.__ssl = ssl_context if ssl_context is not None else False
+        self.__semaphore = None
+        self.__concurrency = concurrency
+        self.__useragent = useragent
+        self.__auth = {'user': rtir_user, 'pass': rtir_password}
+        self.__rtir_base_url = rtir_full_url.rstrip('/')
+        self.__proxy = proxy_dict.get('https' if self.__rtir_base_url.startswith('https') else 'http')
+        self.ticketcache = TicketCache(cache_size,cache_ttl)
+        self.attachmentcache = TicketCache(cache_size,cache_ttl)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.__raise_errors = raise_errors
+        self.__last_error = contextvars.ContextVar('rtir4rest_last_error',default=None)
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.request_stats = request_stats or RequestStats()
+        self.queues = QueueDirectory(self)
+        self.ip_index = ip_index
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*exc):
+        await self.logout()
+        await self.close()
+
+    def __open(self):
+        """Create the aiohttp session (must run inside the event loop)"""
+        import asyncio
+        if self.__session is None or self.__session.closed:
+            import aiohttp
+            if self.__keep_alive:
+                connector = aiohttp.TCPConnector(limit=self.__concurrency,ssl=self.__ssl,keepalive_timeout=60)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.__concurrency,ssl=self.__ssl,force_close=True)
+            self.__session = aiohttp.ClientSession(connector=connector,
+                                                   cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                                   auth=aiohttp.BasicAuth(self.__auth['user'],self.__auth['pass']),
+                                                   headers={'User-Agent': self.__useragent,'referer': self.__rtir_base_url})
+            self.__semaphore = asyncio.Semaphore(self.__concurrency)
+            self.__login_lock = asyncio.Lock()
+        return self.__session
+
+    async def close(self):
+        """Close the aiohttp session and its connections"""
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def __post(self,surl,where,data=None,params=None,write=False,generation=None):
+        """POST to surl under self.retry_policy, return the response text ('' on errors, see RTIR4REST)"""
+        try:
+            return await self.__request(surl,data,params,write,generation)
+        except Exception as e:
+            return self.__error(where,e,'')
+
+    def __error(self,where,e,default):
+        """Record e as last_error (and as a failure of the running map_tickets() task), then raise it (raise_errors=True) or print it and return default"""
+        self.__last_error.set(e)
+        failures = self.__failures.get()
+        if failures is not None: failures.append(e)
+        if self.__raise_errors: raise e
+        print('> Error in '+where+'() :',e)
+        return default
+
+    @property
+    def last_error(self):
+        """Exception of the last failed call in this task, None if the last request succeeded"""
+        return self.__last_error.get()
+
+    async def __request(self,surl,data,params,write,generation=None):
+        """One request with timeouts and backoff retries. Raises RTIRError. Identical concurrent reads of the same cache generation share one request."""
+        self.__last_error.set(None)
+        if self.singleflight is None or write:
+            return await self.__request_retry(surl,data,params,write)
+        endpoint = RequestStats.endpoint(surl)
+        if endpoint in ('login','logout'):
+            return await self.__request_retry(surl,data,params,write)
+        key = (surl,repr(params),repr(data),generation)
+        return await self.singleflight.ado(key,lambda: self.__request_retry(surl,data,params,write),endpoint)
+
+    async def __request_retry(self,surl,data,params,write):
+        """The retry loop of __request()"""
+        import asyncio
+        import aiohttp
+        session = self.__open()
+        policy = self.retry_policy
+        timeout = aiohttp.ClientTimeout(sock_connect=policy.connect_timeout,sock_read=policy.read_timeout)
+        operation = RateLimiter.operation(surl)
+        endpoint = RequestStats.endpoint(surl)
+        self.__last_error.set(None)
+        generation = self.__login_generation
+        relogged = not self.__relogin_enabled or not self.__loggedin or endpoint in ('login','logout')
+        attempt = 0
+        while True:
+            if not attempt: policy.deposit()
+            try:
+                status, reason, text = await self.__send(session,surl,operation,endpoint,data=data,params=params,
+                                                         proxy=self.__proxy,timeout=timeout)
+                if status < 400:
+                    line = parse_rt_status(text[:256])
+                    if line[0].startswith('RT/') and line[1] == '401' and not relogged:
+                        relogged = True
+                        if await self.__relogin(generation): continue # replay: RT did not run the request
+                    if line[0].startswith('RT/') and line[1] != '200':
+                        raise RTIRResponseError(' '.join(line),surl,int(line[1]) if line[1].isdigit() else None)
+                    return text
+                error, safe = RTIRHTTPError('HTTP '+str(status)+' '+str(reason),surl,status), False
+                if not status in policy.retry_status: raise error
+            except asyncio.TimeoutError as e:
+                error, safe = RTIRTimeout(str(e) or 'timeout',surl), False
+            except aiohttp.ClientConnectorError as e:
+                error, safe = RTIRConnectionError(str(e),surl), True
+            except aiohttp.ClientError as e:
+                error, safe = RTIRConnectionError(str(e),surl), False
+            if not (safe or not write or policy.retry_writes) or not policy.allow_retry(attempt):
+                raise error
+            self.request_stats.retry(endpoint)
+            await asyncio.sleep(policy.delay(attempt))
+            attempt += 1
+
+    async def __send(self,session,surl,operation,endpoint,**kwargs):
+        """session.post() behind the rate limiter, the concurrency limiter and the semaphore, recorded in self.request_stats"""
+        import asyncio
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.reserve(operation)
+            if wait > 0: await asyncio.sleep(wait)
+        limiter = self.concurrency_limiter
+        if limiter is not None: await limiter.aacquire()
+        started = time.monotonic()
+        try:
+            async with self.__semaphore:
+                async with session.post(surl,**kwargs) as r:
+                    body = await r.read()
+                    status, reason = r.status, r.reason
+                    text = body.decode(r.get_encoding(),'replace')
+        except Exception as e:
+            latency = time.monotonic()-started
+            if limiter is not None: limiter.release(latency,True)
+            self.request_stats.record(endpoint,latency,None,0,0,e)
+            raise
+        latency = time.monotonic()-started
+        if limiter is not None: limiter.release(latency,status >= 500 or status == 429)
+        bytes_out = len(surl)+sum(len(str(k))+len(str(v))+2 for k,v in (kwargs.get('data') or {}).items())
+        self.request_stats.record(endpoint,latency,status,bytes_out,len(body),'HTTP '+str(status) if status >= 400 else None)
+        return status, reason, text
+
+    def stats(self):
+        """Per endpoint request statistics (see RTIR4REST.stats)"""
+        return self.request_stats.snapshot()
+
+    def __rest(self,path):
+        return self.__rtir_base_url+'/REST/1.0/'+path
+
+    def __rtir_text_format(self,intxt):
+        """Function: Prepare text for RTIR Text (trailing space)"""
+        return intxt.replace('\n','\n ') + '\n'
+
+    async def __authenticate(self,where):
+        """POST the credentials to the login page and check the result. Returns: True or False"""
+        text = await self.__post(self.__rtir_base_url,where,data=self.__auth)
+        if 'username or password is incorrect' in text:
+            print('*** Username or Password is incorrect ***')
+        if '<title>Login</title>' in text:
+            print('*** Failed to Login ***')
+        self.__loggedin = '<title>RT at a glance</title>' in text
+        if self.__loggedin: self.__login_generation += 1
+        return self.__loggedin
+
+    async def __relogin(self,generation):
+        """Log in again after RT rejected the session, once for all tasks that saw the same session expire"""
+        async with self.__login_lock:
+            if generation != self.__login_generation: return self.__loggedin
+            self.relogins += 1
+            self.__session.cookie_jar.clear()
+            return await self.__authenticate('relogin')
+
+    async def login(self):
+        """Function: Login, Create Session, Get Cookie. Returns: True or False"""
+        if not self.__loggedin:
+            self.__open()
+            async with self.__login_lock:
+                if not self.__loggedin: await self.__authenticate('login')
+        return self.__loggedin
+
+    async def logout(self):
+        """Function: Clear Session and Cookie. Returns: True or False"""
+        if self.__loggedin:
+            await self.__post(self.__rest('logout'),'logout',data={'content': ''})
+            self.__loggedin = False
+            self.ticketcache.clear()
+            return True
+        return False
+
+    async def search_tickets(self,query,raw=False):
+        """Search tickets using the RTIR search criteria. Returns 'id: Subject' lines."""
+        if not self.__loggedin: return ''
+        text = await self.__post(self.__rest('search/ticket'),'search_tickets',params={'query': query})
+        if raw: return text.strip()
+        return rt_kv_lines(text)
+
+    async def search_ticket_ids(self,query):
+        """Search tickets, return a sorted list of int ticket ids (format=i)"""
+        if not self.__loggedin: return []
+        params = {'query': query, 'format': 'i', 'orderby': '+id'}
+        text = await self.__post(self.__rest('search/ticket'),'search_ticket_ids',params=params)
+        return parse_rt_ids(text)
+
+    async def search_tickets_full(self,query,fields=None,page_size=500,strict=False):
+        """Async generator: yield Ticket records fetched in bulk (format=l). Full records fill the ticket cache.
+        Stops at the first failed request; strict=True raises its error instead."""
+        if not self.__loggedin: return
+        surl = self.__rest('search/ticket')
+        try:
+            id_list = parse_rt_ids(await self.__request(surl,None,{'query': query,'format': 'i','orderby': '+id'},False))
+        except Exception as e:
+            self.__error('search_tickets_full',e,None)
+            if strict: raise
+            return
+        for n in range(0,len(id_list),page_size):
+            page = id_list[n:n+page_size]
+            params = {'query': '('+query+') AND id >= '+str(page[0])+' AND id <= '+str(page[-1]),
+                      'format': 'l', 'orderby': '+id'}
+            if fields: params['fields'] = ','.join(fields)
+            generation = self.ticketcache.generation()
+            try:
+                text = await self.__request(surl,None,params,False,generation)
+            except Exception as e:
+                self.__error('search_tickets_full',e,None)
+                if strict: raise
+                return
+            status = text.split('\n',1)[0]
+            for record, chunk in parse_rt_records(text,raw=True):
+                if not record.get('id','').startswith('ticket/'): continue
+                ticket = Ticket(record,status+'\n\n'+chunk)
+                if not fields:
+                    self.ticketcache.set(str(ticket.id),ticket,ticket.last_updated,generation)
+                yield ticket
+
+    async def get_all_new_open_tickets(self):
+        """Get all New and Open tickets of all users. Returns: separated string."""
+        return await self.search_tickets("(Status='new' OR Status='open')")
+
+    async def get_queue(self,queueid):
+        """Get a queue as a dict of its fields, None if it does not exist"""
+        if not self.__loggedin: return None
+        text = await self.__post(self.__rest('queue/'+str(queueid)),'get_queue')
+        for record in parse_rt_records(text):
+            if 'Name' in record and record.get('id','').startswith('queue/'):
+                record['id'] = int(record['id'][6:])
+                return record
+        return None
+
+    async def resolve_queue(self,queue):
+        """Queue id of a queue name (or id), None if unknown. Loads the queue directory once."""
+        if self.queues.stale: await self.queues.arefresh()
+        return self.queues.resolve(queue,refresh=False)
+
+    async def get_ticket(self,sticketid):
+        """Get the ticket as a parsed Ticket record (None if it does not exist). Served from self.ticketcache when fresh."""
+        if not self.__loggedin: return None
+        sticketid = str(sticketid)
+        ticket = self.ticketcache.get(sticketid)
+        if ticket is None:
+            generation = self.ticketcache.generation(sticketid)
+            surl = self.__rest('ticket/'+sticketid+'/show')
+            text = (await self.__post(surl,'get_ticket',generation=generation)).strip()
+            if not 'id: ticket/' in text:
+                if not text or 'does not exist' in text: return None # '' when __post() reported an error
+                return self.__error('get_ticket',RTIRResponseError(rt_body(text).split('\n',1)[0],surl),None)
+            ticket = Ticket.from_text(text)
+            self.ticketcache.set(sticketid,ticket,ticket.last_updated,generation)
+        return ticket
+
+    async def get_ticket_info(self,sticketid,raw=False):
+        """Get all information about the ticket."""
+        ticket = await self.get_ticket(sticketid)
+        if ticket is None: return ''
+        if raw: return ticket.raw
+        return rt_kv_lines(ticket.raw)
+
+    async def get_ticket_item(self,sticketid,ticketitem):
+        """Get the ticket item ('Owner', 'CF.{IP}', ...)"""
+        ticket = await self.get_ticket(sticketid)
+        if ticket is None: return ''
+        return ticket.get(ticketitem.strip())
+
+    async def get_ticket_queue(self,sticketid):
+        return await self.get_ticket_item(sticketid,'Queue')
+
+    async def get_ticket_status(self,sticketid):
+        return await self.get_ticket_item(sticketid,'Status')
+
+    async def get_ticket_owner(self,sticketid):
+        return await self.get_ticket_item(sticketid,'Owner')
+
+    async def get_ticket_requestors(self,sticketid):
+        return await self.get_ticket_item(sticketid,'Requestors')
+
+    async def get_ticket_subject(self,sticketid):
+        return await self.get_ticket_item(sticketid,'Subject')
+
+    async def get_ticket_ip(self,sticketid):
+        return await self.get_ticket_item(sticketid,'CF.{IP}')
+
+    async def get_ticket_classification(self,sticketid):
+        return await self.get_ticket_item(sticketid,'CF.{Classification}')
+
+    async def get_ticket_attachments(self,sticketid):
+        """Get the ticket attachment index as a list of Attachment records. Cached per ticket."""
+        if not self.__loggedin: return []
+        sticketid = str(sticketid)
+        attachments = self.attachmentcache.get(sticketid)
+        if attachments is None:
+            generation = self.attachmentcache.generation(sticketid)
+            text = await self.__post(self.__rest('ticket/'+sticketid+'/attachments'),'get_ticket_attachments',generation=generation)
+            attachments = Attachment.parse_list(text)
+            if text: self.attachmentcache.set(sticketid,attachments,'',generation)
+        return attachments
+
+    async def get_ticket_message_by_id(self,sticketid,smessageid):
+        """Get message by id for the ticket"""
+        if not self.__loggedin: return ''
+        text = await self.__post(self.__rest('ticket/'+str(sticketid)+'/attachments/'+str(smessageid)),'get_ticket_message_by_id')
+        return ''.join([sline+'\n' for sline in text.strip().splitlines() if not 'RT/' in sline])
+
+    async def get_ticket_message(self,sticketid,content_type='text/plain',first=False):
+        """Get primary message (text/plain) for the ticket: the latest one, or the first one with first=True"""
+        attachments = [a for a in await self.get_ticket_attachments(sticketid) if content_type in a.content_type]
+        if not attachments: return ''
+        attachment = attachments[0 if first else -1]
+        text = await self.__post(self.__rest('ticket/'+str(sticketid)+'/attachments/'+str(attachment.id)),'get_ticket_message')
+        return rt_body(text)
+
+    async def get_ticket_messages(self,sticketid,ids=None,content_type='text/plain'):
+        """Get several messages concurrently. Returns OrderedDict id -> message."""
+        import asyncio
+        if ids is None:
+            ids = [a.id for a in await self.get_ticket_attachments(sticketid) if content_type in a.content_type]
+        ids = [str(messageid) for messageid in ids]
+        messages = await asyncio.gather(*[self.get_ticket_message_by_id(sticketid,messageid) for messageid in ids])
+        return OrderedDict(zip(ids,messages))
+
+    async def take_ticket(self,sticketid):
+        """Take UNowned ticket"""
+        return await self.__action(sticketid,'take','take_ticket',{'content': 'Action: take'})
+
+    async def steal_ticket(self,sticketid):
+        """Steal Owned ticket"""
+        return await self.__action(sticketid,'take','steal_ticket',{'content': 'Action: steal'})
+
+    async def take_or_steal_ticket(self,sticketid):
+        """Take or Steal ticket depending on ownership"""
+        owner = (await self.get_ticket_owner(sticketid)).lower().strip()
+        user = self.__auth['user'].lower().strip()
+        if 'nobody' in owner:
+            await self.take_ticket(sticketid)
+        elif not user in owner:
+            await self.steal_ticket(sticketid)
+
+    async def __action(self,sticketid,action,where,payload):
+        """POST payload to ticket/<id>/<action> and invalidate the cached ticket"""
+        if not self.__loggedin: return ''
+        sticketid = str(sticketid)
+        text = await self.__post(self.__rest('ticket/'+sticketid+'/'+action),where,data=payload,write=True)
+        self.ticketcache.invalidate(sticketid)
+        self.attachmentcache.invalidate(sticketid)
+        return text.strip()
+
+    async def comment_ticket(self,sticketid,commenttext):
+        """Create a internal Comment to the ticket"""
+        params = 'id: '+str(sticketid)+'\nAction: comment\nText: '+self.__rtir_text_format(commenttext)
+        return await self.__action(sticketid,'comment','comment_ticket',{'content': params})
+
+    async def reply_ticket(self,sticketid,bodytext,cc='',bcc=''):
+        """Create a reply and send to requesters via RTIR"""
+        params = 'id: '+str(sticketid)+'\nAction: correspond\nText: '+self.__rtir_text_format(bodytext)
+        if len(cc): params += 'Cc: '+cc.strip()+'\n'
+        if len(bcc): params += 'Bcc: '+bcc.strip()+'\n'
+        return await self.__action(sticketid,'comment','reply_ticket',{'content': params})
+
+    async def create_ticket(self,abusemail,subj,bodytxt,constituency='',cc='',admincc='',queue='Incident Reports',fields=None):
+        """Create a new ticket with basic data. The abuseemail is the Correspondents. Returns the ticket id.
+        Retried only with retry_policy.retry_creates, after checking whether the ticket was created after all (see RTIR4REST)."""
+        import asyncio
+        if not self.__loggedin: return ''
+        if self.queues.known(queue) is False:
+            return self.__error('create_ticket',RTIRError('Queue '+str(queue)+' does not exist'),'')
+        surl = self.__rest('ticket/new')
+        params = 'id: ticket/new\nQueue: '+queue+'\nRequestor: '+abusemail.strip()+'\n'
+        params += 'Owner: '+self.__auth['user']+'\n'
+        if len(cc): params += 'Cc: '+cc.strip()+'\n'
+        if len(admincc): params += 'AdminCc: '+admincc.strip()+'\n'
+        params += 'Subject: '+subj.strip()+'\nText: '+self.__rtir_text_format(bodytxt)
+        params += 'CF-Customer: '+abusemail.strip()+'\nCF-Reporter Type: External\n'
+        if len(constituency): params += 'CF-Constituency: '+constituency+'\n'
+        if fields: params += TicketEdit(fields).content()
+        policy = self.retry_policy
+        guard = query = None
+        if policy.retry_creates:
+            query = "Requestor = '"+self.__quote(abusemail.strip())+"' AND Subject = '"+self.__quote(subj.strip())+"'"
+            existing = await self.search_ticket_ids(query)
+            if self.last_error is None: guard = max(existing or [0]) # no guard, no retry: older tickets must not be adopted
+        attempt = 0
+        while True:
+            try:
+                text = await self.__request(surl,{'content': params},None,True)
+                sline = rt_body(text).split('\n',1)[0] # '# Ticket 888888 created.'
+                if not sline.endswith('created.'): raise RTIRError(sline.lstrip('# '),surl)
+                return sline.split(' ')[2].strip()
+            except (RTIRTimeout,RTIRConnectionError,RTIRHTTPError) as e:
+                if guard is None or (e.status and not e.status in policy.retry_status) or not policy.allow_retry(attempt):
+                    return self.__error('create_ticket',e,'')
+                created = [ticketid for ticketid in await self.search_ticket_ids(query) if ticketid > guard]
+                if self.last_error is not None: return self.__error('create_ticket',e,'') # unknown whether it was created
+                if created: return str(created[0])
+                await asyncio.sleep(policy.delay(attempt))
+                attempt += 1
+            except Exception as e:
+                return self.__error('create_ticket',e,'')
+
+    def __quote(self,value):
+        """Escape a value for a single-quoted TicketSQL string"""
+        return value.replace('\\','\\\\').replace("'","\\'")
+
+    async def update_ticket(self,sticketid,edit=None,**fields):
+        """Apply several field changes in one /edit POST (see RTIR4REST.update_ticket)"""
+        if not isinstance(edit,TicketEdit):
+            edit = TicketEdit(edit)
+        edit.update(fields)
+        if not len(edit): return ''
+        text = await self.__action(sticketid,'edit','update_ticket',{'content': edit.content(sticketid)})
+        return rt_body(text)
+
+    async def set_ticket_owner(self,sticketid,owner):
+        """Set the owner of the ticket. Must be a valid user."""
+        return await self.update_ticket(sticketid,Owner=owner)
+
+    async def set_ticket_queue(self,sticketid,queue):
+        """Take and set Queue in one edit"""
+        return await self.update_ticket(sticketid,Owner=self.__auth['user'],Queue=queue)
+
+    async def set_ticket_classification(self,sticketid,classification):
+        """Take, set Queue: Incidents and the classification in one edit"""
+        return await self.update_ticket(sticketid,{'Owner': self.__auth['user'],'Queue': 'Incidents','CF-Classification': classification})
+
+    async def set_ticket_ip(self,sticketid,ipaddress):
+        """Take, set Queue: Incidents and the IP-address in one edit"""
+        return await self.update_ticket(sticketid,{'Owner': self.__auth['user'],'Queue': 'Incidents','CF-IP': ipaddress})
+
+    async def reopen_ticket(self,sticketid):
+        """Take and set the ticket status to open in one edit"""
+        return await self.update_ticket(sticketid,Owner=self.__auth['user'],Status='open')
+
+    async def close_ticket(self,sticketid):
+        """Update ticket to Resolved (closed)"""
+        return await self.update_ticket(sticketid,Status='resolved')
+
+    async def take_comment_close_ticket(self,sticketid,comment):
+        """Comment, then Take and Close the Ticket in one edit (2 requests)."""
+        await self.comment_ticket(sticketid,comment)
+        return await self.update_ticket(sticketid,Owner=self.__auth['user'],Status='resolved')
+
+    async def take_comment_classify_close_ticket(self,sticketid,comment,classification):
+        """Comment, then Take, Classify, and Close the Ticket in one edit (2 requests)."""
+        await self.comment_ticket(sticketid,comment)
+        edit = TicketEdit().set('Owner',self.__auth['user']).set('Queue','Incidents').set_cf('Classification',classification).set('Status','resolved')
+        return await self.update_ticket(sticketid,edit)
+
+    async def take_reply_comment_classify_close_ticket(self,sticketid,bodytext,comment,classification):
+        """Reply, Comment, then Take, Classify, and Close the Ticket in one edit (3 requests)."""
+        await self.reply_ticket(sticketid,bodytext)
+        await self.comment_ticket(sticketid,comment)
+        edit = TicketEdit().set('Owner',self.__auth['user']).set('Queue','Incidents').set_cf('Classification',classification).set('Status','resolved')
+        return await self.update_ticket(sticketid,edit)
+
+    async def autocreate_ticket(self,email,subject,abusetext,comment,ipaddress,classification,dedupe=False):
+        """Create, Reply, Comment, set Incidents as Queue, Classify, Set IP-address, and Close a ticket in one go (see RTIR4REST)."""
+        if dedupe and self.ip_index is not None:
+            found = self.ip_index.lookup_value(ipaddress)
+            if found: return str(max(found))
+        sticketid = await self.create_ticket(email,subject,'')
+        if len(sticketid):
+            await self.reply_ticket(sticketid,abusetext)
+            await self.comment_ticket(sticketid,comment)
+            edit = TicketEdit().set('Queue','Incidents').set_cf('Classification',classification)
+            edit.set_cf('IP',ipaddress).set('Status','resolved')
+            await self.update_ticket(sticketid,edit)
+            if self.ip_index is not None: self.ip_index.created(sticketid,ipaddress,'resolved')
+        return sticketid
+
+    async def map_tickets(self,fn,ids,*args,**kwargs):
+        """Run coroutine fn(sticketid,*args) for every ticket id concurrently. Returns TicketResult list in id order."""
+        import asyncio
+        if isinstance(fn,str): fn = getattr(self,fn)
+        async def run(sticketid):
+            failures = []
+            self.__failures.set(failures) # run() is its own task, so the list is private to this ticket
+            try:
+                value = await fn(sticketid,*args,**kwargs)
+            except Exception as e:
+                return TicketResult(sticketid,None,e)
+            return TicketResult(sticketid,value,failures[0] if failures else None)
+        return await asyncio.gather(*[run(str(sticketid)) for sticketid in ids])
+
+    async def close_tickets(self,ids):
+        """Close (resolve) tickets concurrently. Returns TicketResult list."""
+        return await self.map_tickets(self.close_ticket,ids)
+
+    async def comment_tickets(self,ids,commenttext):
+        """Comment tickets concurrently. Returns TicketResult list."""
+        return await self.map_tickets(self.comment_ticket,ids,commenttext)
+## End Class
+
+def main(argv=None):
+    """Command line: python -m rtir4rest bulk|export [options]"""
+    import argparse
+    connection = argparse.ArgumentParser(add_help=False)
+    connection.add_argument('--url',default=os.environ.get('RTIR_URL'),help='RT base URL (default $RTIR_URL)')
+    connection.add_argument('--user',default=os.environ.get('RTIR_USER'),help='RT user (default $RTIR_USER)')
+    connection.add_argument('--password',default=os.environ.get('RTIR_PASSWORD'),help='RT password (default $RTIR_PASSWORD)')
+    connection.add_argument('--transport',default='requests',choices=sorted(TRANSPORTS),help='HTTP transport')
+    connection.add_argument('--verify',default=False,help='CA bundle path or "true" to check the server certificate')
+    parser = argparse.ArgumentParser(prog='python -m rtir4rest',description='RTIR4REST command line tools')
+    commands = parser.add_subparsers(dest='command')
+    bulk = commands.add_parser('bulk',parents=[connection],help='apply ticket jobs from CSV or JSON lines over a process pool')
+    bulk.add_argument('jobs',help="CSV (header line) or JSON lines file, '-' for stdin")
+    bulk.add_argument('--action',help="action for jobs without one, e.g. 'take+comment+close'")
+    bulk.add_argument('--format',choices=('csv','jsonl'),help='job file format (default by file extension)')
+    bulk.add_argument('--processes',type=int,default=os.cpu_count() or 4,help='worker processes, one session each')
+    bulk.add_argument('--threads',type=int,default=8,help='tickets in flight per process (default 8)')
+    bulk.add_argument('--rate',type=float,help='requests per second over all processes')
+    bulk.add_argument('--journal',help='progress journal; a rerun skips finished tickets')
+    bulk.add_argument('--report-interval',type=float,default=10.0,help='seconds between shard reports (default 10)')
+    export = commands.add_parser('export',parents=[connection],help='stream tickets and their first message to JSONL, CSV or Parquet')
+    export.add_argument('query',help="RT ticket query, e.g. \"Queue = 'Incidents'\"")
+    export.add_argument('output',help='.jsonl or .csv file, or a Parquet directory')
+    export.add_argument('--format',choices=TicketExport.FORMATS,help='output format (default by file extension)')
+    export.add_argument('--fields',help='comma separated ticket items (default all)')
+    export.add_argument('--no-message',action='store_true',help='leave out the first text/plain message')
+    export.add_argument('--workers',type=int,default=8,help='tickets in flight (default 8)')
+    export.add_argument('--restart',action='store_true',help='ignore the saved state and export everything again')
+    args = parser.parse_args(argv)
+    if args.command not in ('bulk','export'):
+        parser.print_help()
+        return 2
+    if not (args.url and args.user and args.password):
+        parser.error('--url, --user and --password (or $RTIR_URL, $RTIR_USER, $RTIR_PASSWORD) are required')
+    verify = True if str(args.verify).lower() == 'true' else args.verify
+    if args.command == 'export':
+        rtir = RTIR4REST(args.user,args.password,args.url,workers=args.workers,transport=args.transport,verify=verify,
+                         raise_errors=True)
+        try:
+            exporter = TicketExport(rtir,args.query,args.output,format=args.format,workers=args.workers,
+                                    fields=[field.strip() for field in args.fields.split(',')] if args.fields else None,
+                                    message=not args.no_message,resume=not args.restart)
+        except ValueError as e:
+            parser.error(str(e))
+        if not rtir.login(): return 1
+        summary = exporter.run()
+        rtir.logout()
+        print('> export: %d tickets exported (%d in %s), last id %d, %.1f s, %.1f tickets/s' % (summary['exported'],
+              summary['rows'],args.output,summary['last_id'],summary['seconds'],summary['rate']))
+        return 0
+    runner = BulkRunner(args.url,args.user,args.password,processes=args.processes,threads=args.threads,rate=args.rate,
+                        journal=args.journal,report_interval=args.report_interval,transport=args.transport,verify=verify)
+    try:
+        summary = runner.run(BulkRunner.read_jobs(args.jobs,action=args.action,format=args.format))
+    except ValueError as e:
+        parser.error(str(e))
+    print('> bulk: %d tickets, %d done, %d failed, %d skipped, %d requests, %.1f s, %.1f tickets/s' % (summary['tickets'],
+          summary['done'],summary['failed'],summary['skipped'],summary['requests'],summary['seconds'],summary['rate']))
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
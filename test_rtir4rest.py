@@ -0,0 +1,652 @@
+"""Tests of rtir4rest against FakeRT, in-process through MemoryTransport (run: python -m pytest -q)"""
+
+import json
+import os
+
+import pytest
+
+from fakert import FakeRT
+from rtir4rest import RTIR4REST, ChangeFeed, MemoryTransport, RetryPolicy, RTIRHTTPError, TicketStore, WriteBehind
+
+
+def client(rt,**kwargs):
+    kwargs.setdefault('retry_policy',RetryPolicy(backoff=0,backoff_max=0))
+    transport = MemoryTransport(lambda *request: rt.handle(*request)) # tests may replace rt.handle
+    rtir = RTIR4REST('root','password','http://fake.rt',transport=transport,**kwargs)
+    assert rtir.login()
+    return rtir
+
+@pytest.fixture
+def rt():
+    return FakeRT(tickets=20,seed=1)
+
+
+def test_session_expiry_relogin(rt):
+    rt.require_cookie = True
+    rtir = client(rt)
+    assert rtir.get_ticket_subject(1) == 'Incident Report #1'
+    rt.expire_sessions()
+    assert rtir.get_ticket_subject(2) == 'Incident Report #2'
+    assert rtir.relogins == 1
+    assert rtir.last_error is None
+
+def test_session_expiry_without_relogin(rt):
+    rt.require_cookie = True
+    rtir = client(rt,relogin=False)
+    rt.expire_sessions()
+    assert rtir.get_ticket_subject(2) == ''
+    assert '401' in str(rtir.last_error)
+
+def test_retries_ride_out_errors(rt):
+    rtir = client(rt,retry_policy=RetryPolicy(retries=10,backoff=0,backoff_max=0,budget_min=1000))
+    rt.error_rate = 0.3
+    results = rtir.map_tickets(rtir.get_ticket,range(1,21))
+    assert [result.value.id for result in results if result.ok] == list(range(1,21))
+    assert rtir.last_error is None
+    assert rt.total_requests() > 21
+
+def test_errors_without_retries(rt):
+    rtir = client(rt,retry_policy=RetryPolicy(retries=0))
+    rt.error_rate = 1.0
+    assert rtir.get_ticket(1) is None
+    assert isinstance(rtir.last_error,RTIRHTTPError)
+    results = rtir.close_tickets([1,2])
+    assert [result.ok for result in results] == [False,False]
+    assert all(isinstance(result.error,RTIRHTTPError) for result in results)
+    with pytest.raises(RTIRHTTPError):
+        client(rt,retry_policy=RetryPolicy(retries=0),raise_errors=True)
+
+def test_change_feed_resumes_after_failed_poll(rt,tmp_path):
+    rtir = client(rt)
+    state = str(tmp_path/'feed.json')
+    feed = ChangeFeed(rtir,state_file=state,page_size=5)
+    assert len(feed.poll()) == 20
+    rtir.update_ticket(3,Status='open')
+    rtir.update_ticket(4,Status='open')
+    handle = rt.handle
+    def failing(method,path,query,form,headers):
+        if path.endswith('/search/ticket') and query.get('format') == ['l']: return 502, b'', {}
+        return handle(method,path,query,form,headers)
+    rt.handle = failing
+    mark = feed.mark
+    feed.poll()
+    assert feed.mark == mark
+    assert feed.last_error is not None
+    rt.handle = handle
+    resumed = ChangeFeed(rtir,state_file=state)
+    assert sorted([ticket.id for ticket in resumed.poll()]) == [3,4]
+    assert resumed.last_error is None
+    assert resumed.poll() == []
+
+def test_ticket_store_load_and_refresh(rt,tmp_path):
+    rt.tickets[5].cf['IP'] = '10.1.2.3, 2001:db8::1'
+    rtir = client(rt)
+    store = TicketStore(str(tmp_path/'tickets.db'),rtir)
+    assert store.load() == 20
+    assert [ticket.id for ticket in store.query(ip='10.1.0.0/16')] == [5]
+    assert [ticket.id for ticket in store.query(ip='2001:db8::/32')] == [5]
+    rtir.update_ticket(6,Status='open')
+    del rt.tickets[7]
+    assert store.refresh([6,7]) == []
+    assert store.get(6,max_age=None).status == 'open'
+    assert store.get(7,max_age=None) is None
+    rt.error_rate = 1.0
+    rtir.retry_policy = RetryPolicy(retries=0)
+    failed = store.refresh([8])
+    assert [result.id for result in failed] == ['8']
+    assert store.last_error is not None
+    assert store.get(8,max_age=None).id == 8
+
+def test_write_behind_merges_per_ticket(rt):
+    rtir = client(rt)
+    with WriteBehind(rtir,max_pending=1000,max_delay=60) as wb:
+        rt.reset_stats()
+        futures = [wb.comment_ticket(1,'first'),wb.set_ticket_classification(1,'Spam'),
+                   wb.set_ticket_ip(1,'10.0.0.1'),wb.close_ticket(1),wb.close_ticket(2)]
+        assert wb.flush() == 3
+    assert all(future.result() is not None for future in futures)
+    assert wb.merged == 1
+    assert rt.stats() == {'ticket/<id>/comment': 1,'ticket/<id>/edit': 2}
+    ticket = rtir.get_ticket(1)
+    assert (ticket.status, ticket.owner, ticket.queue) == ('resolved','root','Incidents')
+    assert (ticket.cf['Classification'], ticket.cf['IP']) == ('Spam','10.0.0.1')
+
+def failing(rt,when,status=502,after=False):
+    """Make rt answer status to the requests matching when(method,path,query); after=True fails them after handling (lost responses)"""
+    handle = rt.handle
+    def handler(method,path,query,form,headers):
+        if not when(method,path,query): return handle(method,path,query,form,headers)
+        if after: handle(method,path,query,form,headers)
+        return status, b'', {}
+    rt.handle = handler
+    return handle
+
+def once(when):
+    """when() that matches only the first matching request"""
+    hits = []
+    def match(*request):
+        if hits or not when(*request): return False
+        hits.append(request)
+        return True
+    return match
+
+def creates(method,path,query):
+    return path.endswith('/ticket/new')
+
+def guard_searches(method,path,query):
+    return path.endswith('/search/ticket') and query.get('format') == ['i']
+
+def test_create_ticket_retry_after_lost_response(rt):
+    rtir = client(rt,retry_policy=RetryPolicy(backoff=0,backoff_max=0,retry_creates=True))
+    failing(rt,once(creates),after=True)
+    assert rtir.create_ticket('abuse5@example.org','Incident Report #6','body') == '21'
+    assert len(rt.tickets) == 21
+    assert rtir.last_error is None
+
+def test_create_ticket_never_adopts_older_tickets(rt):
+    rtir = client(rt,retry_policy=RetryPolicy(backoff=0,backoff_max=0,retry_creates=True))
+    failing(rt,guard_searches)
+    failing(rt,once(creates))
+    assert rtir.create_ticket('abuse5@example.org','Incident Report #6','body') == ''
+    assert isinstance(rtir.last_error,RTIRHTTPError)
+    assert len(rt.tickets) == 20
+
+def run_async(rt,main,**kwargs):
+    """Run main(rtir) with a logged-in AsyncRTIR4REST against rt served over HTTP"""
+    import asyncio
+    from rtir4rest import AsyncRTIR4REST
+    kwargs.setdefault('retry_policy',RetryPolicy(retries=0,backoff=0,backoff_max=0))
+    async def session():
+        async with AsyncRTIR4REST('root','password',rt.url,**kwargs) as rtir:
+            assert await rtir.login()
+            return await main(rtir)
+    with rt:
+        return asyncio.run(session())
+
+def test_async_last_error_is_per_task(rt):
+    import asyncio, time
+    handle = rt.handle
+    def handler(method,path,query,form,headers):
+        if path.endswith('/ticket/1/show'): return 502, b'', {}
+        if path.endswith('/ticket/2/show'): time.sleep(0.2)
+        return handle(method,path,query,form,headers)
+    rt.handle = handler
+    async def fetch(rtir,sticketid):
+        ticket = await rtir.get_ticket(sticketid)
+        await asyncio.sleep(0.4) # the other task finishes meanwhile
+        return ticket, rtir.last_error
+    async def main(rtir):
+        return await asyncio.gather(fetch(rtir,1),fetch(rtir,2))
+    (ticket1, error1), (ticket2, error2) = run_async(rt,main)
+    assert ticket1 is None and isinstance(error1,RTIRHTTPError)
+    assert ticket2.id == 2 and error2 is None
+
+def test_async_map_tickets_reports_errors(rt):
+    async def main(rtir):
+        rt.error_rate = 1.0
+        return await rtir.close_tickets([1,2])
+    results = run_async(rt,main)
+    assert [result.ok for result in results] == [False,False]
+
+def test_async_create_ticket_retry(rt):
+    policy = RetryPolicy(retries=1,backoff=0,backoff_max=0,retry_creates=True)
+    failing(rt,once(creates),after=True)
+    async def create(rtir):
+        return await rtir.create_ticket('abuse5@example.org','Incident Report #6','body'), rtir.last_error
+    assert run_async(rt,create,retry_policy=policy) == ('21',None)
+    assert len(rt.tickets) == 21
+
+def test_async_create_ticket_never_adopts_older_tickets(rt):
+    policy = RetryPolicy(retries=1,backoff=0,backoff_max=0,retry_creates=True)
+    failing(rt,guard_searches)
+    failing(rt,once(creates))
+    async def create(rtir):
+        return await rtir.create_ticket('abuse5@example.org','Incident Report #6','body'), rtir.last_error
+    sticketid, error = run_async(rt,create,retry_policy=policy)
+    assert sticketid == '' and isinstance(error,RTIRHTTPError)
+    assert len(rt.tickets) == 20
+
+def test_ticket_cache_lru_and_ttl(monkeypatch):
+    from rtir4rest import TicketCache
+    import rtir4rest
+    now = [1000.0]
+    monkeypatch.setattr(rtir4rest.time,'monotonic',lambda: now[0])
+    cache = TicketCache(maxsize=2,ttl=10)
+    cache.set('1','one')
+    cache.set('2','two')
+    assert cache.get('1') == 'one' # 2 is now the least recently used
+    cache.set('3','three')
+    assert ('2' in cache, cache.get(1), cache.get('3')) == (False,'one','three')
+    now[0] += 11
+    assert cache.get('1') is None
+    assert cache.stats() == {'hits': 3,'misses': 1,'evictions': 1,'size': 1,'maxsize': 2}
+
+def test_ticket_cache_generation_skips_stale_values():
+    from rtir4rest import TicketCache
+    cache = TicketCache()
+    generation = cache.generation('1')
+    cache.invalidate('1') # a write lands while the read is in flight
+    cache.set('1','stale',generation=generation)
+    assert cache.get('1') is None
+    cache.set('1','fresh',generation=cache.generation('1'))
+    assert cache.get('1') == 'fresh'
+    generation = cache.generation()
+    cache.clear()
+    cache.set('2','stale',generation=generation)
+    assert '2' not in cache
+
+def test_get_ticket_served_from_cache(rt):
+    rtir = client(rt)
+    rtir.get_ticket(1)
+    rt.reset_stats()
+    assert rtir.get_ticket_subject(1) == 'Incident Report #1'
+    assert rt.total_requests() == 0
+    rtir.update_ticket(1,Subject='changed')
+    assert rtir.get_ticket_subject(1) == 'changed'
+
+def test_cache_validate(rt):
+    rtir = client(rt,cache_validate=True,retry_policy=RetryPolicy(retries=0))
+    assert rtir.get_ticket(1).status == 'new'
+    with rt.lock:
+        rt.tickets[1].fields['Status'] = 'open'
+        rt.tickets[1].touch(rt.now())
+    assert rtir.get_ticket(1).status == 'open'
+    failing(rt,lambda method,path,query: path.endswith('/search/ticket'))
+    assert rtir.get_ticket(1) is None
+    assert isinstance(rtir.last_error,RTIRHTTPError)
+
+def test_messages_with_an_empty_attachment_body(rt):
+    rtir = client(rt)
+    aid = rt.add_attachment(1,'second message','text/plain')
+    handle = rt.handle
+    rt.handle = lambda method,path,query,form,headers: ((200,b'',{}) if path.endswith('/attachments/'+str(aid))
+                                                        else handle(method,path,query,form,headers))
+    assert rtir.get_ticket_message_by_id(1,str(aid)) == ''
+    messages = rtir.get_ticket_messages(1)
+    assert list(messages) == [rtir.get_ticket_message_id_list(1).split(',')[0],str(aid)]
+    assert 'Report body 1' in list(messages.values())[0]
+    assert list(messages.values())[1] == ''
+    assert rtir.last_error is None
+
+def test_bulk_intake_resume_adopts_only_new_tickets(rt,tmp_path):
+    from rtir4rest import BulkIntake
+    rtir = client(rt,retry_policy=RetryPolicy(retries=0))
+    spec = {'email': 'abuse@example.net','subject': 'Spam run','abusetext': 'Stop it','comment': 'seen','ip': '10.9.8.7',
+            'classification': 'Spam'}
+    older = rt.add_ticket('abuse@example.net','Spam run','an earlier incident')
+    rt.tickets[older].cf['IP'] = '10.9.8.7'
+    journal = str(tmp_path/'intake.journal')
+    handle = failing(rt,creates,after=True) # the create reaches RT, the answer is lost
+    summary = BulkIntake(rtir,workers=1,journal=journal,report=lambda summary: None).run([spec])
+    assert summary['failed'] == 1
+    crashed = max(rt.tickets)
+    assert crashed > older
+    rt.handle = handle
+    results = []
+    summary = BulkIntake(rtir,workers=1,journal=journal,report=lambda summary: None).run([spec],on_result=results.append)
+    assert (summary['resumed'], summary['created']) == (1,0)
+    assert results[0].value == str(crashed)
+    assert max(rt.tickets) == crashed
+    assert rtir.get_ticket(crashed).status == 'resolved'
+    assert BulkIntake(rtir,journal=journal,report=lambda summary: None).run([spec])['skipped'] == 1
+
+def test_bulk_intake_resume_without_a_created_ticket(rt,tmp_path):
+    from rtir4rest import BulkIntake
+    rtir = client(rt,retry_policy=RetryPolicy(retries=0))
+    spec = ('abuse@example.net','Spam run','','','10.9.8.7','Spam')
+    older = rt.add_ticket('abuse@example.net','Spam run','an earlier incident')
+    rt.tickets[older].cf['IP'] = '10.9.8.7'
+    journal = str(tmp_path/'intake.journal')
+    handle = failing(rt,creates) # the create never reaches RT
+    assert BulkIntake(rtir,journal=journal,report=lambda summary: None).run([spec])['failed'] == 1
+    rt.handle = handle
+    results = []
+    BulkIntake(rtir,journal=journal,report=lambda summary: None).run([spec],on_result=results.append)
+    assert int(results[0].value) == max(rt.tickets) > older
+
+def test_composites_fold_the_take_into_the_edit(rt):
+    rtir = client(rt)
+    rt.reset_stats()
+    rtir.take_comment_classify_close_ticket('1','handled','Spam')
+    assert rt.stats() == {'ticket/<id>/comment': 1,'ticket/<id>/edit': 1}
+    ticket = rtir.get_ticket(1)
+    assert (ticket.owner, ticket.queue, ticket.status, ticket.cf['Classification']) == ('root','Incidents','resolved','Spam')
+    rt.reset_stats()
+    rtir.set_ticket_ip('2','10.0.0.2')
+    assert rt.stats() == {'ticket/<id>/edit': 1}
+    assert (rtir.get_ticket_owner(2), rtir.get_ticket_item(2,'CF.{IP}')) == ('root','10.0.0.2')
+
+def test_ticket_store_refreshes_stale_rows(rt,tmp_path):
+    rtir = client(rt)
+    store = TicketStore(str(tmp_path/'tickets.db'),rtir,max_age=3600)
+    store.load()
+    rtir.update_ticket(9,Status='open')
+    assert store.query(status='open') == []
+    rt.reset_stats()
+    assert [ticket.id for ticket in store.query(status=['new','open'],max_age=0)][:10] == list(range(1,11))
+    assert rt.stats() == {'ticket/<id>/show': 20}
+    assert [ticket.id for ticket in store.query(status='open')] == [9]
+
+@pytest.mark.parametrize('transport',['requests','urllib3'])
+def test_pool_resize_with_requests_in_flight(transport):
+    import threading
+    rt = FakeRT(tickets=40,latency=0.02)
+    with rt:
+        rtir = RTIR4REST('root','password',rt.url,transport=transport,workers=2,cache_size=1,
+                         retry_policy=RetryPolicy(retries=0))
+        assert rtir.login()
+        resizing = threading.Event()
+        def resize():
+            for maxsize in range(3,40):
+                rtir.transport.resize(maxsize)
+                resizing.wait(0.005)
+        thread = threading.Thread(target=resize)
+        thread.start()
+        results = rtir.map_tickets(rtir.get_ticket,list(range(1,41))*3,workers=16)
+        thread.join()
+    assert [result.error for result in results if not result.ok] == []
+
+def test_token_bucket_and_operation_classes(monkeypatch):
+    import rtir4rest
+    from rtir4rest import RateLimiter
+    now = [100.0]
+    monkeypatch.setattr(rtir4rest.time,'monotonic',lambda: now[0])
+    limiter = RateLimiter(rate=10,search=2)
+    assert [limiter.reserve('search') for n in range(3)] == [0,0,0.5]
+    now[0] += 1.5
+    assert limiter.reserve('search') == 0
+    assert limiter.reserve('create') == 0 and RateLimiter().reserve('create') == 0
+    assert [RateLimiter.operation('http://rt/REST/1.0/'+path) for path in ('search/ticket?query=x','ticket/new',
+            'ticket/5/comment','ticket/5/show','queue/1','logout')] == ['search','create','edit','show','show','other']
+
+def test_adaptive_limiter_aimd():
+    from rtir4rest import AdaptiveLimiter
+    limiter = AdaptiveLimiter(initial=4,maximum=5,window=2,target_latency=1.0)
+    assert [limiter.try_acquire() for n in range(5)] == [True,True,True,True,False]
+    limiter.release(0.1)
+    limiter.release(0.1)
+    assert limiter.limit == 5
+    limiter.release(0.1,error=True)
+    limiter.release(2.0)
+    assert (limiter.limit, limiter.inflight) == (2,0)
+
+def test_adaptive_limiter_async_waiters():
+    import asyncio
+    from rtir4rest import AdaptiveLimiter
+    limiter = AdaptiveLimiter(initial=2,maximum=2,window=1000)
+    running = []
+    peak = []
+    async def work(n):
+        await limiter.aacquire()
+        running.append(n)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(n)
+        limiter.release(0.01)
+        return n
+    async def main():
+        tasks = [asyncio.ensure_future(work(n)) for n in range(10)]
+        await asyncio.sleep(0)
+        tasks[5].cancel() # a cancelled waiter must not keep its slot
+        return await asyncio.gather(*tasks,return_exceptions=True)
+    results = asyncio.run(main())
+    assert [result for result in results if isinstance(result,int)] == [0,1,2,3,4,6,7,8,9]
+    assert max(peak) == 2
+    assert limiter.inflight == 0
+
+def test_async_client_under_the_adaptive_limiter(rt):
+    import asyncio
+    from rtir4rest import AdaptiveLimiter
+    limiter = AdaptiveLimiter(initial=3,maximum=3)
+    async def main(rtir):
+        return await asyncio.gather(*[rtir.get_ticket(n) for n in range(1,21)])
+    tickets = run_async(rt,main,concurrency_limiter=limiter)
+    assert [ticket.id for ticket in tickets] == list(range(1,21))
+    assert limiter.inflight == 0
+
+SHOW = '''RT/4.2.9 200 Ok
+
+id: ticket/42
+Queue: Incidents
+Owner: Nobody
+Subject: Phishing: bank login
+Status: open
+Requestors: a@example.org
+LastUpdated: Mon Jan 01 08:00:42 2018
+CF.{Status}: not the ticket status
+CF.{IP}: 10.0.0.1
+CF.{Description}: first line
+  second line
+  
+  after a blank line
+CF.{Resolution}:
+'''
+
+def test_parse_rt_records_single_pass():
+    from rtir4rest import parse_rt_records
+    record, = parse_rt_records(SHOW)
+    assert record['id'] == 'ticket/42'
+    assert record['Subject'] == 'Phishing: bank login' # only the first colon separates key and value
+    assert record['CF.{Description}'] == 'first line\nsecond line\n\nafter a blank line'
+    assert record['CF.{Resolution}'] == ''
+    text = 'RT/4.2.9 200 Ok\n\nid: ticket/1\nStatus: new\n\n--\n\nid: ticket/2\nStatus: open\n# comment\n'
+    assert [r['Status'] for r in parse_rt_records(text)] == ['new','open']
+    assert [r['id'] for r in parse_rt_records(text.encode('utf-8').splitlines(True))] == ['ticket/1','ticket/2']
+    (record, chunk), second = parse_rt_records(text,raw=True)
+    assert chunk.strip() == 'id: ticket/1\nStatus: new'
+
+def test_response_helpers():
+    from rtir4rest import parse_rt_ids, parse_rt_search, parse_rt_status, rt_body, rt_content, rt_kv_lines
+    assert parse_rt_status('RT/4.2.9 401 Credentials required\n\n') == ['RT/4.2.9','401','Credentials required']
+    assert parse_rt_status(b'RT/4.2.9 200 Ok\n\nbody') == ['RT/4.2.9','200','Ok']
+    assert rt_body('RT/4.2.9 200 Ok\n\n# Ticket 7 created.\n\n') == '# Ticket 7 created.'
+    assert parse_rt_ids('RT/4.2.9 200 Ok\n\nticket/10\nticket/2\n') == [2,10]
+    assert list(parse_rt_search('RT/4.2.9 200 Ok\n\n5: Spam: again\n6: x\n')) == [(5,'Spam: again'),(6,'x')]
+    assert rt_kv_lines(SHOW).splitlines()[0] == 'id: ticket/42'
+    assert '  second line' in rt_kv_lines(SHOW)
+    assert rt_content('id: 9\nContent: Hello\n         \n             indented\n') == 'Hello\n\n    indented'
+
+def test_ticket_record():
+    from rtir4rest import Ticket
+    ticket = Ticket.from_text(SHOW)
+    assert (ticket.id, ticket.status, ticket.queue, ticket.subject) == (42,'open','Incidents','Phishing: bank login')
+    assert ticket.get('Status') == ticket['status'] == 'open' # the ticket field, not CF.{Status}
+    assert ticket.get('CF.{Status}') == ticket.cf['Status'] == 'not the ticket status'
+    assert ticket['CF-IP'] == ticket['CF.{IP}'] == '10.0.0.1'
+    assert ticket.get('CF.{Description}') == 'first line\nsecond line\n\nafter a blank line'
+    assert ticket.get('Nope','x') == 'x'
+    assert list(ticket.as_dict())[:3] == ['id','Queue','Owner']
+    assert Ticket.from_text('RT/4.2.9 200 Ok\n\n# Ticket 5 does not exist.').id == 0
+
+def test_ticket_items_match_exactly(rt):
+    rtir = client(rt)
+    rtir.update_ticket(3,Status='open')
+    assert rtir.get_ticket_status(3) == 'open'
+    assert rtir.get_ticket_item(3,'CF.{Status}') == '' # not a known ticket item
+    assert rtir.get_ticket_item(3,' status ') == 'open'
+
+def test_ip_index_lookups():
+    from rtir4rest import IPIndex
+    index = IPIndex()
+    index.add(1,'10.1.2.3')
+    index.add(2,'10.1.0.0/16, 192.0.2.10-192.0.2.20')
+    index.add(3,'2001:db8::/32; not-an-ip')
+    assert index.lookup('10.1.2.3') == {1,2}
+    assert index.lookup('10.1.9.9') == {2}
+    assert index.lookup('10.1.2.0/24') == {1,2} # entries overlapping a network
+    assert index.lookup('10.0.0.0/8') == {1,2}
+    assert index.lookup('192.0.2.15') == {2} and index.lookup('192.0.2.21') == set()
+    assert index.lookup('2001:db8::1') == {3} and '2001:db9::1' not in index
+    assert index.lookup_many(['10.1.2.3','bogus']) == {'10.1.2.3': {1,2}, 'bogus': set()}
+    assert index.lookup_value('192.0.2.0/28 2001:db8:1::1') == {2,3}
+    index.remove(2)
+    assert index.lookup('10.1.9.9') == set() and len(index) == 2
+
+def test_ip_index_statuses(rt):
+    from rtir4rest import IPIndex
+    with rt.lock:
+        rt.tickets[1].cf['IP'] = '10.0.0.1'
+        rt.tickets[2].cf['IP'] = '10.0.0.0/24'
+        rt.tickets[2].fields['Status'] = 'open'
+    rtir = client(rt)
+    index = IPIndex.build(rtir,"Status='new' OR Status='open'",statuses=('New','open'))
+    assert index.lookup('10.0.0.1') == {1,2}
+    rtir.update_ticket(2,Status='resolved')
+    assert index.update([rtir.get_ticket('2')]) == 0 # closed tickets drop out
+    assert index.lookup('10.0.0.1') == {1}
+    index.created(99,'10.0.0.1','resolved')
+    index.created(98,'10.0.0.1','new')
+    assert index.lookup('10.0.0.1') == {1,98}
+
+def test_bulk_runner_plan_and_shards(tmp_path):
+    from rtir4rest import BulkRunner
+    messages, edit, take = BulkRunner.plan([{'id': '5','action': 'take+comment+classify+close','comment': 'spam',
+                                             'classification': 'Spam'},{'id': '5','action': 'update','Priority': '3'}])
+    assert messages == [('comment','spam')] and take
+    assert dict(edit.fields) == {'Queue': 'Incidents','CF-Classification': 'Spam','Status': 'resolved','Priority': '3'}
+    assert BulkRunner.actions('take_comment_close_ticket') == ['take','comment','close']
+    with pytest.raises(ValueError):
+        BulkRunner.actions('take+delete')
+    journal = str(tmp_path/'bulk.journal')
+    with open(journal+'.1','w') as f:
+        f.write('{"id": "3", "ok": true}\n{"id": "5", "ok": false}\n{"id": "7", "o') # torn last line
+    runner = BulkRunner('http://fake.rt','root','password',processes=2,journal=journal)
+    jobs = [{'id': str(n),'action': 'close'} for n in range(1,9)]+[{'id': 'ticket/4','action': 'comment'}]
+    shards, skipped = runner.shards(jobs)
+    assert skipped == 1 # ticket 3 is journaled as done, 5 failed and runs again
+    assert [list(shard) for shard in shards] == [['2','4','6','8'],['1','5','7']]
+    assert len(shards[0]['4']) == 2
+    with pytest.raises(ValueError):
+        runner.shards([{'id': 'x','action': 'close'}])
+
+def test_bulk_runner_journal_resume(rt,tmp_path):
+    from rtir4rest import BulkRunner
+    journal = str(tmp_path/'bulk.journal')
+    jobs = [{'id': str(n),'action': 'take+comment+close','comment': 'done '+str(n)} for n in range(1,7)]
+    jobs.append({'id': '999','action': 'close'})
+    with rt:
+        runner = BulkRunner(rt.url,'root','password',processes=2,threads=2,journal=journal,report=False)
+        summary = runner.run(jobs)
+        assert (summary['tickets'], summary['done'], summary['failed'], summary['skipped']) == (7,6,1,0)
+        assert [shard['shard'] for shard in summary['shards']] == [0,1]
+        assert runner.done_ids() == set([str(n) for n in range(1,7)])
+        with rt.lock:
+            assert all([rt.tickets[n].fields['Status'] == 'resolved' for n in range(1,7)])
+            assert [rt.tickets[n].fields['Owner'] for n in (1,2)] == ['root','root']
+            assert rt.tickets[1].history[-1] == ('comment','done 1')
+        rt.reset_stats()
+        summary = runner.run(jobs) # a rerun only retries the failed ticket
+        assert (summary['tickets'], summary['done'], summary['failed'], summary['skipped']) == (7,0,1,6)
+        with rt.lock:
+            assert len([h for h in rt.tickets[1].history if h == ('comment','done 1')]) == 1
+
+def test_ticket_export_resumes_after_an_interruption(rt,tmp_path):
+    from rtir4rest import RTIRError, TicketExport
+    path = str(tmp_path/'export.jsonl')
+    rtir = client(rt,raise_errors=True)
+    export = TicketExport(rtir,"Queue = 'Incident Reports'",path,fields=['Subject','Status'],workers=2,page_size=4,
+                          batch_size=5)
+    handle = failing(rt,lambda method, path, query: '/ticket/13/attachments' in path)
+    with pytest.raises(RTIRError):
+        export.run()
+    rt.handle = handle
+    with open(path) as f:
+        ids = [json.loads(sline)['id'] for sline in f]
+    assert ids == list(range(1,len(ids)+1)) and ids[-1] < 13
+    with open(path,'a') as f:
+        f.write('{"id": 99, "torn') # rows written after the last saved state are dropped
+    summary = export.run()
+    assert summary['resumed'] and summary['rows'] == summary['last_id'] == 20
+    rt.add_ticket('late@example.org','Late report','Late body')
+    assert export.run()['exported'] == 1
+    with open(path) as f:
+        rows = [json.loads(sline) for sline in f]
+    assert [row['id'] for row in rows] == list(range(1,22))
+    assert rows[0] == {'id': 1,'Subject': 'Incident Report #1','Status': 'new','Message': 'Report body 1\nSecond line.'}
+
+def test_ticket_export_parquet_parts(rt,tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    from rtir4rest import RTIRError, TicketExport
+    path = str(tmp_path/'export')
+    rtir = client(rt,raise_errors=True)
+    export = TicketExport(rtir,"Queue = 'Incident Reports'",path,fields=['Subject'],message=False,page_size=4,
+                          batch_size=3,part_rows=7)
+    handle = failing(rt,lambda method, path, query: 'id >= 9 ' in query.get('query',[''])[0])
+    with pytest.raises(RTIRError):
+        export.run()
+    rt.handle = handle
+    open(os.path.join(path,'part-00009.parquet'),'w').close() # unfinished part of a crashed run
+    assert export.run()['rows'] == 20
+    for n in range(21,26):
+        rt.add_ticket('late@example.org','Late report '+str(n),'Late body')
+    assert export.run()['exported'] == 5
+    parts = sorted([name for name in os.listdir(path) if name.startswith('part-')])
+    tables = [parquet.read_table(os.path.join(path,name)) for name in parts]
+    assert all([0 < table.num_rows <= 7 for table in tables])
+    assert sum([table.column('id').to_pylist() for table in tables],[]) == list(range(1,26))
+    assert tables[0].column_names == ['id','Subject']
+
+def test_single_flight_coalesces_threads():
+    import threading
+    from rtir4rest import SingleFlight
+    flight, gate, calls = SingleFlight(), threading.Event(), []
+    def fetch():
+        calls.append(1)
+        gate.wait(5)
+        return 'result'
+    def fail():
+        gate.wait(5)
+        raise ValueError('shared')
+    results, errors = [], []
+    def call(key,fn):
+        try:
+            results.append(flight.do(key,fn,'ticket/<id>/show'))
+        except ValueError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=call,args=('a',fetch)) for n in range(4)]
+    threads += [threading.Thread(target=call,args=('b',fail)) for n in range(2)]
+    for thread in threads: thread.start()
+    while flight.stats()['coalesced'] < 4: gate.wait(0.01)
+    gate.set()
+    for thread in threads: thread.join()
+    assert results == ['result']*4 and len(calls) == 1
+    assert len(errors) == 2 and errors[0] is errors[1]
+    assert flight.stats() == {'leaders': 2,'coalesced': 4,'endpoints': {'ticket/<id>/show': 4}}
+    assert flight.do('a',lambda: 'again') == 'again' # nothing in flight: runs again
+    flight.reset()
+    assert flight.stats()['leaders'] == 0
+
+def test_single_flight_coroutines():
+    import asyncio
+    from rtir4rest import SingleFlight
+    flight, calls = SingleFlight(), []
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+    async def main():
+        return await asyncio.gather(*[flight.ado('a',fetch) for n in range(5)])
+    assert asyncio.run(main()) == [1]*5
+    assert flight.stats()['coalesced'] == 4
+
+def test_single_flight_reads_around_a_write(rt):
+    import threading
+    rtir = client(rt,single_flight=True)
+    handle, gate, shows = rt.handle, threading.Event(), []
+    def handler(method,path,query,form,headers):
+        response = handle(method,path,query,form,headers)
+        if path.endswith('/ticket/1/show'):
+            shows.append(path)
+            if len(shows) == 1: gate.wait(5) # the first read is answered before the write but arrives late
+        return response
+    rt.handle = handler
+    statuses = []
+    threads = [threading.Thread(target=lambda: statuses.append(rtir.get_ticket(1).status)) for n in range(3)]
+    for thread in threads: thread.start()
+    while rtir.singleflight.stats()['coalesced'] < 2: gate.wait(0.01)
+    rtir.update_ticket(1,Status='open')
+    assert rtir.get_ticket(1).status == 'open' # not shared with the read in flight
+    gate.set()
+    for thread in threads: thread.join()
+    assert statuses == ['new']*3 and len(shows) == 2
+    assert rtir.get_ticket(1).status == 'open' # the late read was not cached